@@ -4,12 +4,12 @@ from __future__ import unicode_literals
 
 from django.contrib.gis import admin
 
-from .models import Participant, TreatmentPhase, AppVersion, AppCode, AppPackageInfo
+from .models import Participant, TreatmentPhase, AppVersion, AppCode, AppPackageInfo, ExportWatermark, DailyUsage, MinuteUsageRollup, HourlyUsageRollup, TimezoneSpan
 
 @admin.register(Participant)
 class ParticipantAdmin(admin.OSMGeoAdmin):
     list_display = ('email_address', 'identifier', 'created', 'timezone', 'performance_last_updated', 'user_hash',)
-    search_fields = ['email_address', 'identifier', 'metadata',]
+    search_fields = ['email_address', 'identifier', 'performance_report',]
 
     list_filter = ('created', 'performance_last_updated', 'timezone', 'email_enabled')
 
@@ -42,3 +42,43 @@ class AppPackageInfoAdmin(admin.OSMGeoAdmin):
     list_display = ('original_package', 'replacement_package', 'sort_order',)
 
     search_fields = ['original_package', 'replacement_package']
+
+@admin.register(ExportWatermark)
+class ExportWatermarkAdmin(admin.OSMGeoAdmin):
+    list_display = ('generator', 'source', 'date_type', 'position', 'updated',)
+
+    search_fields = ['generator', 'source',]
+
+    list_filter = ('generator', 'date_type', 'updated',)
+
+@admin.register(DailyUsage)
+class DailyUsageAdmin(admin.OSMGeoAdmin):
+    list_display = ('participant', 'date', 'package', 'usage_ms', 'computed', 'latest_recorded', 'dirty',)
+
+    search_fields = ['participant__email_address', 'participant__identifier', 'package',]
+
+    list_filter = ('dirty', 'date', 'computed',)
+
+@admin.register(MinuteUsageRollup)
+class MinuteUsageRollupAdmin(admin.OSMGeoAdmin):
+    list_display = ('source', 'date', 'package', 'time_zone', 'computed', 'latest_recorded', 'dirty',)
+
+    search_fields = ['source', 'package',]
+
+    list_filter = ('dirty', 'date', 'computed',)
+
+@admin.register(HourlyUsageRollup)
+class HourlyUsageRollupAdmin(admin.OSMGeoAdmin):
+    list_display = ('participant', 'date', 'hour', 'usage_ms', 'computed', 'latest_recorded',)
+
+    search_fields = ['participant__email_address', 'participant__identifier',]
+
+    list_filter = ('date', 'weekday', 'hour', 'computed',)
+
+@admin.register(TimezoneSpan)
+class TimezoneSpanAdmin(admin.OSMGeoAdmin):
+    list_display = ('source', 'time_zone', 'start', 'last_seen',)
+
+    search_fields = ['source', 'time_zone',]
+
+    list_filter = ('time_zone', 'start',)
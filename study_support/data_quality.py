@@ -0,0 +1,543 @@
+# pylint: disable=line-too-long, no-member
+
+import datetime
+import json
+
+import arrow
+import pytz
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from passive_data_kit.models import DataSourceReference, DataGeneratorDefinition, DataPoint, DataSource
+
+from .export_context import chunked
+from .federation import FederationClient
+from .models import ExportWatermark, Participant, TreatmentPhase
+
+WATERMARK_GENERATOR = 'study-data-quality'
+
+# Report sections and the new data points that make them stale. The activity section holds
+# the observed counts and the latest point, and the phase section the budget, snooze, and
+# block checks for the current treatment phase.
+
+REPORT_SECTIONS = ('activity', 'phase',)
+
+# Sections recomputed on every update, as their recency fields (latest_ago, the rolling
+# observed counts, and the relaunch check) move with the clock even without new data.
+
+ALWAYS_RECOMPUTED_SECTIONS = ('activity',)
+
+REPORT_SECTION_GENERATORS = (
+    ('pdk-foreground-application', None, 'activity',),
+    ('daily-app-budget', None, 'phase',),
+    ('pdk-app-event', ('set-snooze-cost', 'app-usage-summary',), 'phase',),
+    ('app-snooze', None, 'phase',),
+)
+
+def includes_section(sections, section):
+    return sections is None or section in sections
+
+
+def report_sections(participant, now):
+    '''
+    Returns the sections of the participant's report to recompute, or None for
+    the whole report. Only reports written earlier on the same (server-local)
+    day are updated in part, as the overdue checks and treatment phases move
+    with the date even without new data, and the sections in
+    ALWAYS_RECOMPUTED_SECTIONS are always included.
+    '''
+
+    changes = participant.fetch_performance_changes()
+
+    if (not changes) or participant.performance_report is None or participant.performance_last_updated is None:
+        return None
+
+    if timezone.localtime(participant.performance_last_updated).date() != timezone.localtime(now).date():
+        return None
+
+    sections = tuple(section for section in REPORT_SECTIONS if section in changes or section in ALWAYS_RECOMPUTED_SECTIONS)
+
+    if sections == REPORT_SECTIONS:
+        return None
+
+    return sections
+
+
+def section_points_query():
+    # Returns a Q matching the points in REPORT_SECTION_GENERATORS (None if none are defined yet)
+    # and the report section of each generator definition.
+
+    sections_by_definition = {}
+
+    query = None
+
+    for identifier, secondary_identifiers, section in REPORT_SECTION_GENERATORS:
+        definition = DataGeneratorDefinition.objects.filter(generator_identifier=identifier).first()
+
+        if definition is None:
+            continue
+
+        sections_by_definition[definition.pk] = section
+
+        condition = Q(generator_definition=definition)
+
+        if secondary_identifiers is not None:
+            condition = condition & Q(secondary_identifier__in=secondary_identifiers)
+
+        if query is None:
+            query = condition
+        else:
+            query = query | condition
+
+    return query, sections_by_definition
+
+
+def mark_changed_participants(default_since):
+    '''
+    Scans the data points recorded since the previous scan (or default_since)
+    that feed the report and records, on each participant, which report
+    sections the new points affect. Returns the number of participants marked.
+    '''
+
+    # Concurrent runs (e.g. several update_participant_data_quality processes) take turns on the
+    # watermark row, so each scan starts where the previous one stopped.
+
+    with transaction.atomic():
+        watermark = ExportWatermark.objects.get_or_create(generator=WATERMARK_GENERATOR, source='', date_type='recorded', defaults={
+            'position': default_since,
+            'updated': timezone.now(),
+        })[0]
+
+        watermark = ExportWatermark.objects.select_for_update().get(pk=watermark.pk)
+
+        return mark_changes_since(watermark)
+
+
+def mark_changes_since(watermark):
+    # Marks the participants with points recorded after the watermark and advances it.
+
+    since = watermark.position
+
+    query, sections_by_definition = section_points_query()
+
+    if query is None:
+        return 0
+
+    reference_sections = {}
+    latest_scanned = None
+
+    for row in DataPoint.objects.filter(query, recorded__gt=since).order_by().values('source_reference_id', 'generator_definition_id').annotate(latest=Max('recorded')):
+        reference_sections.setdefault(row['source_reference_id'], set()).add(sections_by_definition[row['generator_definition_id']])
+
+        if latest_scanned is None or latest_scanned < row['latest']:
+            latest_scanned = row['latest']
+
+    changes = {}
+
+    for chunk in chunked(list(reference_sections.keys())):
+        for reference_id, source in DataSourceReference.objects.filter(pk__in=chunk).values_list('pk', 'source'):
+            changes[source] = reference_sections[reference_id]
+
+    marked = []
+
+    for chunk in chunked(list(changes.keys())):
+        for participant in Participant.objects.filter(identifier__in=chunk).only('pk', 'identifier', 'performance_changes'):
+            sections = changes[participant.identifier].union(participant.fetch_performance_changes())
+
+            participant.performance_changes = ','.join(section for section in REPORT_SECTIONS if section in sections)
+
+            marked.append(participant)
+
+    Participant.objects.bulk_update(marked, ['performance_changes'], batch_size=500)
+
+    if latest_scanned is not None:
+        watermark.position = latest_scanned
+        watermark.updated = timezone.now()
+        watermark.save()
+
+    return len(marked)
+
+
+class CohortMetrics: # pylint: disable=too-many-instance-attributes
+    '''
+    Prefetches what the data-quality report reads from the data points of a
+    set of participants, using a handful of grouped and conditionally aggregated
+    queries instead of a dozen per participant: data sources, observed counts
+    for the last two days, the IDs of the latest foreground, any, budget, and
+    usage-summary points, current treatment phases, and daily snooze and
+    snooze-cost counts. compile_performance_report then only looks values up.
+    With sections set, only what those report sections read is prefetched.
+    '''
+
+    def __init__(self, participants, now, sections=None): # pylint: disable=too-many-locals, too-many-branches
+        self.now = now
+        self.sections = sections
+
+        self.today_start = now - datetime.timedelta(days=1)
+        self.yesterday_start = now - datetime.timedelta(days=2)
+
+        self.foreground_definition = DataGeneratorDefinition.definition_for_identifier('pdk-foreground-application')
+        self.budget_definition = DataGeneratorDefinition.definition_for_identifier('daily-app-budget')
+        self.event_definition = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+        self.snooze_definition = DataGeneratorDefinition.definition_for_identifier('app-snooze')
+
+        participants = list(participants)
+
+        identifiers = [participant.identifier for participant in participants]
+
+        self.data_sources = {}
+        self.references = {}
+
+        for chunk in chunked(identifiers):
+            for data_source in DataSource.objects.filter(identifier__in=chunk).select_related('server', 'group'):
+                self.data_sources[data_source.identifier] = data_source
+
+        self.phases = {}
+
+        for chunk in chunked([participant.pk for participant in participants]):
+            if includes_section(sections, 'phase') is False:
+                break
+
+            for phase in TreatmentPhase.objects.filter(participant_id__in=chunk, start_date__lte=now.date(), treatment_active=True).order_by('participant_id', '-start_date'):
+                if (phase.participant_id in self.phases) is False:
+                    self.phases[phase.participant_id] = phase
+
+        earliest_phase = None
+
+        if self.phases:
+            earliest_phase = min(phase.start_date for phase in self.phases.values())
+
+        self.observed_counts = {}
+        self.latest_ids = {}
+        self.snooze_cost_days = {}
+        self.snooze_days = {}
+
+        point_ids = []
+
+        latest_kinds = self.latest_kinds()
+
+        for chunk in chunked(identifiers):
+            references = DataSourceReference.objects.filter(source__in=chunk).annotate(**latest_kinds)
+
+            reference_ids = []
+
+            for reference in references:
+                self.references[reference.source] = reference
+
+                reference_ids.append(reference.pk)
+
+                self.latest_ids[reference.pk] = {}
+
+                for kind in latest_kinds:
+                    self.latest_ids[reference.pk][kind] = getattr(reference, kind)
+
+                    if getattr(reference, kind) is not None:
+                        point_ids.append(getattr(reference, kind))
+
+            if includes_section(sections, 'activity'):
+                counts = DataPoint.objects.filter(source_reference_id__in=reference_ids, generator_definition=self.foreground_definition, created__gte=self.yesterday_start)
+
+                for row in counts.order_by().values('source_reference_id').annotate(today=Count('pk', filter=Q(created__gte=self.today_start)), yesterday=Count('pk', filter=Q(created__lt=self.today_start))):
+                    self.observed_counts[row['source_reference_id']] = (row['today'], row['yesterday'],)
+
+            if earliest_phase is not None:
+                snooze_costs = DataPoint.objects.filter(source_reference_id__in=reference_ids, generator_definition=self.event_definition, secondary_identifier='set-snooze-cost', created__date__gte=earliest_phase)
+
+                for row in snooze_costs.order_by().values('source_reference_id', 'created__date').annotate(count=Count('pk')):
+                    self.snooze_cost_days.setdefault(row['source_reference_id'], []).append((row['created__date'], row['count'],))
+
+                snoozes = DataPoint.objects.filter(source_reference_id__in=reference_ids, generator_definition=self.snooze_definition, created__date__gte=earliest_phase)
+
+                for row in snoozes.order_by().values('source_reference_id', 'created__date').annotate(count=Count('pk')):
+                    self.snooze_days.setdefault(row['source_reference_id'], []).append((row['created__date'], row['count'],))
+
+        self.points = {}
+
+        for chunk in chunked(point_ids):
+            self.points.update(DataPoint.objects.in_bulk(chunk))
+
+    def latest_kinds(self):
+        # Subqueries for the IDs of the latest points the prefetched sections read, by name.
+
+        latest_kinds = {}
+
+        if includes_section(self.sections, 'activity'):
+            latest_kinds['latest_foreground'] = self.latest_point_id(generator_definition=self.foreground_definition)
+            latest_kinds['latest_any'] = self.latest_point_id()
+
+        if includes_section(self.sections, 'phase'):
+            latest_kinds['latest_budget'] = self.latest_point_id(generator_definition=self.budget_definition)
+            latest_kinds['latest_usage_summary'] = self.latest_point_id(generator_definition=self.event_definition, secondary_identifier='app-usage-summary')
+
+        return latest_kinds
+
+    @staticmethod
+    def latest_point_id(**filters):
+        return Subquery(DataPoint.objects.filter(source_reference=OuterRef('pk'), **filters).order_by('-created').values('pk')[:1])
+
+    def covers(self, participant, sections=None):
+        if self.sections is not None:
+            if sections is None or [section for section in sections if section not in self.sections]:
+                return False
+
+        return participant.identifier in self.references or participant.identifier in self.data_sources
+
+    def data_source(self, identifier):
+        return self.data_sources.get(identifier, None)
+
+    def federated_server(self, identifier):
+        # Returns the remote server holding the participant's data, if their report comes from one.
+
+        data_source = self.data_source(identifier)
+
+        if data_source is not None and data_source.server is not None and data_source.server.source_metadata_url is not None:
+            return data_source.server
+
+        return None
+
+    def reference(self, identifier):
+        reference = self.references.get(identifier, None)
+
+        if reference is None:
+            reference = DataSourceReference.reference_for_source(identifier)
+
+        return reference
+
+    def observed(self, reference):
+        return self.observed_counts.get(reference.pk, (0, 0,))
+
+    def latest(self, reference, kind):
+        point_id = self.latest_ids.get(reference.pk, {}).get(kind, None)
+
+        if point_id is None:
+            return None
+
+        return self.points.get(point_id, None)
+
+    def latest_since(self, reference, kind, start_date):
+        # The latest point overall answers "the latest point created on or after start_date" too.
+
+        point = self.latest(reference, kind)
+
+        if point is not None and timezone.localtime(point.created).date() >= start_date:
+            return point
+
+        return None
+
+    def phase(self, participant):
+        return self.phases.get(participant.pk, None)
+
+    @staticmethod
+    def count_since(days, reference, start_date):
+        return sum(count for date, count in days.get(reference.pk, []) if date >= start_date)
+
+    def snooze_costs_since(self, reference, start_date):
+        return self.count_since(self.snooze_cost_days, reference, start_date)
+
+    def snoozes_since(self, reference, start_date):
+        return self.count_since(self.snooze_days, reference, start_date)
+
+
+def compile_performance_report(participant, now, cohort=None, sections=None): # pylint: disable=too-many-locals, too-many-branches, too-many-statements
+    '''
+    Builds the data-quality report for one participant: computed here for
+    local sources from the prefetched CohortMetrics (built for this participant
+    alone when not given), or fetched from the participant's study server
+    otherwise. With sections set (see report_sections), a local report only
+    recomputes those sections and keeps the rest of the stored report.
+    '''
+
+    if cohort is None or cohort.covers(participant, sections) is False:
+        cohort = CohortMetrics([participant], now, sections=sections)
+
+    full_source = cohort.data_source(participant.identifier)
+
+    performance_report = {}
+
+    if full_source is not None: # pylint: disable=too-many-nested-blocks
+        if full_source.server is None:
+            if sections is not None:
+                performance_report = participant.fetch_performance_report(default={})
+
+            participant.fetch_timezone(force_recalculate=True)
+            participant.fetch_last_cost(force_recalculate=True)
+
+            performance_report['group'] = 'Unknown'
+
+            source = cohort.reference(participant.identifier)
+
+            if full_source is not None:
+                performance_report['group'] = str(full_source.group)
+
+            if includes_section(sections, 'activity'):
+                today_count, yesterday_count = cohort.observed(source)
+
+                today_count = float(today_count)
+                performance_report['today_observed_count'] = today_count
+
+                yesterday_count = float(yesterday_count)
+                performance_report['yesterday_observed_count'] = yesterday_count
+
+                if today_count == 0:
+                    performance_report['today_observed_fraction'] = 0
+                elif yesterday_count == 0:
+                    performance_report['today_observed_fraction'] = 1
+                else:
+                    performance_report['today_observed_fraction'] = float(today_count) / float(yesterday_count)
+
+                latest = cohort.latest(source, 'latest_foreground')
+
+                if latest is not None:
+                    properties = latest.fetch_properties()
+
+                    here_tz = pytz.timezone(settings.TIME_ZONE)
+
+                    if 'timezone' in properties['passive-data-metadata']:
+                        here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+
+                    performance_report['latest_point'] = latest.created.astimezone(here_tz).isoformat()
+                    performance_report['latest_ago'] = (now - latest.created).total_seconds() # localize to server timezone
+
+                    if performance_report['latest_ago'] > 24 * 60 * 60:
+                        participant.send_relaunch_email()
+
+                    # Phone Dashboard/33 Passive Data Kit/1.0 (Android 9 SDK 28; samsung SM-G973U)
+
+                    if latest.user_agent is not None and 'Phone Dashboard' in latest.user_agent:
+                        tokens = latest.user_agent.split(' ')
+
+                        performance_report['app_version'] = ' '.join(tokens[:2])
+                        performance_report['platform_version'] = ' '.join(tokens[5:9]).replace('(', '').replace(';', '')
+                        performance_report['device_model'] = ' '.join(tokens[9:]).replace(')', '')
+                else:
+                    latest = cohort.latest(source, 'latest_any')
+
+                    if latest is not None:
+                        performance_report['latest_point'] = latest.created.isoformat()
+                        performance_report['latest_ago'] = (now - latest.created).total_seconds() # localize to server timezone
+
+                        if performance_report['latest_ago'] > 24 * 60 * 60:
+                            participant.send_relaunch_email()
+
+            if includes_section(sections, 'phase'):
+                performance_report['phase_type'] = None
+                performance_report['phase_start'] = None
+                performance_report['phase_budget'] = None
+                performance_report['phase_budget_overdue'] = False
+                performance_report['phase_snooze_cost_count'] = 0
+                performance_report['phase_snooze_cost_overdue'] = False
+                performance_report['phase_unnecessary_snooze_cost'] = False
+                performance_report['phase_snoozes'] = 0
+                performance_report['phase_misc_issues'] = []
+
+                current_phase = cohort.phase(participant)
+
+                if current_phase is not None:
+                    performance_report['phase_type'] = current_phase.blocker_type
+                    performance_report['phase_start'] = current_phase.start_date.isoformat()
+
+                    latest_budget = cohort.latest_since(source, 'latest_budget', current_phase.start_date)
+
+                    if latest_budget is not None:
+                        budget = json.loads(latest_budget.fetch_properties()['budget'])
+
+                        if budget:
+                            performance_report['phase_budget'] = budget
+                    elif (now.date() - current_phase.start_date).days > 0:
+                        performance_report['phase_budget_overdue'] = True
+
+                    performance_report['phase_snooze_cost_count'] = cohort.snooze_costs_since(source, current_phase.start_date)
+
+                    if performance_report['phase_snooze_cost_count'] == 0 and (now.date() - current_phase.start_date).days > 0:
+                        if current_phase.blocker_type == 'costly_snooze':
+                            performance_report['phase_snooze_cost_overdue'] = True
+                        else:
+                            performance_report['phase_unnecessary_snooze_cost'] = True
+
+                    performance_report['phase_snoozes'] = cohort.snoozes_since(source, current_phase.start_date)
+
+                    if performance_report['phase_snoozes'] > 0:
+                        if performance_report['phase_budget'] is None or len(performance_report['phase_budget']) == 0: # pylint: disable=len-as-condition
+                            performance_report['phase_misc_issues'].append('Recorded ' + str(performance_report['phase_snoozes']) + ' snooze(s) without corresponding limits being set.')
+
+                    use_summary = cohort.latest_since(source, 'latest_usage_summary', current_phase.start_date)
+
+                    if use_summary is not None:
+                        details = use_summary.fetch_properties()
+
+                        if 'day' in details['event_details'] and 'blocks' in details['event_details'] and participant.timezone is not None:
+                            report_now = arrow.Arrow.utcfromtimestamp(details['observed'] / 1000)
+
+                            local_days = participant.local_days()
+
+                            today_start, today_end = local_days.day_window(local_days.date_for(report_now.datetime))
+
+                            if performance_report['phase_budget'] is not None:
+                                for app in budget.keys():
+                                    if app in details['event_details']['day']:
+                                        if details['event_details']['day'][app]['usage_ms'] > budget[app]:
+                                            found_block = False
+
+                                            for block_ts in details['event_details']['blocks'].keys():
+                                                block_when = arrow.get(block_ts).datetime
+
+                                                if block_when >= today_start and block_when < today_end: # pylint: disable=chained-comparison
+                                                    if details['event_details']['blocks'][block_ts]['app'] == app:
+                                                        found_block = True
+
+                                            if found_block is False:
+                                                issue = 'Missing block for app "' + app + '" on ' + today_start.date().isoformat() + ' (' + str(participant.identifier) + ').'
+
+                                                performance_report['phase_misc_issues'].append(issue)
+
+        elif full_source.server.source_metadata_url is not None:
+            client = FederationClient()
+
+            try:
+                result = client.fetch_reports([(participant.identifier, full_source.server,)])[0]
+            finally:
+                client.close()
+
+            if result.succeeded():
+                performance_report = result.report
+
+                if performance_report.get('latest_ago', 0) > 24 * 60 * 60:
+                    participant.send_relaunch_email()
+            else:
+                print('Unable to fetch the report for %s from %s: %s' % (participant.identifier, full_source.server.source_metadata_url, result.error))
+
+    return performance_report
+
+
+def apply_federated_reports(participants, results, now):
+    '''
+    Saves reports gathered by FederationClient in one bulk update. Participants
+    whose fetch failed keep their previous report, but are still marked updated
+    so they move to the back of the queue.
+    '''
+
+    participants = dict((participant.identifier, participant,) for participant in participants)
+
+    updated = []
+
+    for result in results:
+        participant = participants[result.identifier]
+
+        if result.succeeded():
+            participant.performance_report = json.dumps(result.report, separators=(',', ':'))
+
+            if result.report.get('latest_ago', 0) > 24 * 60 * 60:
+                participant.send_relaunch_email()
+        else:
+            print('Unable to fetch the report for %s from %s after %d attempt(s): %s' % (result.identifier, result.server.source_metadata_url, result.attempts, result.error))
+
+        participant.performance_last_updated = now
+
+        updated.append(participant)
+
+    Participant.objects.bulk_update(updated, ['performance_report', 'performance_last_updated'])
+
+    return len([result for result in results if result.succeeded()])
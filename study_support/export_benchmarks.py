@@ -0,0 +1,346 @@
+# pylint: disable=line-too-long, no-member
+
+import datetime
+import json
+import os
+import random
+import time
+import zipfile
+
+import pytz
+
+from django.db import connection
+from django.utils import timezone
+
+from passive_data_kit.models import DataPoint, DataSource, DataSourceGroup, DataSourceReference, DataGeneratorDefinition, install_supports_jsonfield
+
+from .export_pipeline import peak_memory_usage
+from .models import Participant
+
+# Seeded sources are named <prefix>s<seed>-NNNN and marked in their participants' metadata, so a
+# cohort only ever clears or reuses the sources it seeded itself.
+
+BENCHMARK_PREFIX = 'pd-benchmark-'
+
+BENCHMARK_SECTION = 'benchmark_cohort'
+
+BENCHMARK_SETTINGS = ('participants', 'days', 'interval', 'seed',)
+
+BENCHMARK_TIMEZONES = (
+    'America/New_York',
+    'America/Chicago',
+    'America/Los_Angeles',
+    'Asia/Kolkata',
+)
+
+BENCHMARK_PACKAGES = (
+    'com.facebook.katana',
+    'com.instagram.android',
+    'com.snapchat.android',
+    'com.google.android.youtube',
+    'com.android.chrome',
+    'com.whatsapp',
+    'com.spotify.music',
+    'com.google.android.gm',
+)
+
+BENCHMARK_DEVICE = 'Passive Data Kit: Phone Dashboard (Android 12; Pixel 5)'
+
+class QueryCounter: # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+
+        return execute(sql, params, many, context)
+
+
+def current_peak_rss():
+    # On Linux, VmHWM can be reset between runs (see reset_peak_rss), so it is preferred over
+    # the lifetime high-water mark reported by getrusage.
+
+    try:
+        with open('/proc/self/status', 'r', encoding='utf-8') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+
+    return peak_memory_usage()
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf-8') as refs_file:
+            refs_file.write('5')
+    except IOError:
+        pass
+
+
+def encode_properties(properties):
+    if install_supports_jsonfield():
+        return properties
+
+    return json.dumps(properties)
+
+
+class BenchmarkCohort:
+    '''
+    Builds a reproducible synthetic cohort of benchmark sources. Every source
+    gets foreground application points at a fixed sampling interval plus the
+    system status, battery, app event and snooze delay points the custom
+    generators join against. The same seed always produces the same points.
+    '''
+
+    def __init__(self, participants=10, days=3, interval=60, seed=1, prefix=BENCHMARK_PREFIX): # pylint: disable=too-many-arguments
+        self.participants = participants
+        self.days = days
+        self.interval = interval
+        self.seed = seed
+        self.prefix = prefix
+
+        today = timezone.now().astimezone(pytz.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        self.start = today - datetime.timedelta(days=days)
+        self.end = today
+
+    def identifiers(self):
+        return [self.prefix + ('s%d-%04d' % (self.seed, index)) for index in range(0, self.participants)]
+
+    def description(self):
+        description = {
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+        }
+
+        for setting in BENCHMARK_SETTINGS:
+            description[setting] = getattr(self, setting)
+
+        return description
+
+    def seeded(self):
+        # Returns {identifier: description} for this cohort's sources seeded by a benchmark run.
+
+        seeded = {}
+
+        for participant in Participant.objects.filter(identifier__in=self.identifiers()).only('identifier', 'metadata'):
+            description = participant.fetch_metadata_section(BENCHMARK_SECTION)
+
+            if description is not None:
+                seeded[participant.identifier] = description
+
+        return seeded
+
+    def foreign_identifiers(self):
+        # Returns this cohort's identifiers already used by data a benchmark run did not seed.
+
+        identifiers = self.identifiers()
+
+        used = set(DataSource.objects.filter(identifier__in=identifiers).values_list('identifier', flat=True))
+        used.update(DataSourceReference.objects.filter(source__in=identifiers).values_list('source', flat=True))
+        used.update(Participant.objects.filter(identifier__in=identifiers).values_list('identifier', flat=True))
+
+        return sorted(used - set(self.seeded().keys()))
+
+    def reuse(self):
+        # Adopts the data window of a previous run's copy of this cohort. Returns False unless
+        # every source was seeded with the same settings.
+
+        seeded = self.seeded()
+
+        if len(seeded) != self.participants:
+            return False
+
+        for description in seeded.values():
+            for setting in BENCHMARK_SETTINGS:
+                if description.get(setting, None) != getattr(self, setting):
+                    return False
+
+        description = seeded[self.identifiers()[0]]
+
+        self.start = datetime.datetime.fromisoformat(description['start'])
+        self.end = datetime.datetime.fromisoformat(description['end'])
+
+        return True
+
+    def clear(self):
+        identifiers = list(self.seeded().keys())
+
+        DataPoint.objects.filter(source__in=identifiers).delete()
+        DataSourceReference.objects.filter(source__in=identifiers).delete()
+        DataSource.objects.filter(identifier__in=identifiers).delete()
+        Participant.objects.filter(identifier__in=identifiers).delete()
+
+    def make_point(self, reference, definition, when, properties, *, secondary_identifier=None, here_tz=None): # pylint: disable=too-many-arguments
+        properties['passive-data-metadata'] = {
+            'source': reference.source,
+            'generator-id': definition.generator_identifier,
+            'generator': BENCHMARK_DEVICE,
+            'timestamp': int(when.timestamp()),
+            'timezone': here_tz,
+        }
+
+        return DataPoint(source=reference.source, source_reference=reference, generator_identifier=definition.generator_identifier, generator_definition=definition, secondary_identifier=secondary_identifier, user_agent=BENCHMARK_DEVICE, created=when, recorded=when + datetime.timedelta(seconds=30), properties=encode_properties(properties))
+
+    def source_points(self, randomizer, reference, definitions): # pylint: disable=too-many-locals
+        here_tz = randomizer.choice(BENCHMARK_TIMEZONES)
+
+        total_seconds = int((self.end - self.start).total_seconds())
+
+        runtime = 0
+
+        for offset in range(0, total_seconds, self.interval):
+            when = self.start + datetime.timedelta(seconds=offset)
+
+            package = randomizer.choice(BENCHMARK_PACKAGES)
+
+            yield self.make_point(reference, definitions['pdk-foreground-application'], when, {
+                'application': package,
+                'duration': self.interval * 1000,
+                'screen_active': randomizer.random() < 0.6,
+            }, secondary_identifier=package, here_tz=here_tz)
+
+            runtime += self.interval * 1000
+
+            if offset % 300 == 0:
+                yield self.make_point(reference, definitions['pdk-system-status'], when, {
+                    'runtime': runtime,
+                    'system_runtime': runtime,
+                }, here_tz=here_tz)
+
+            if offset % 900 == 0:
+                yield self.make_point(reference, definitions['pdk-device-battery'], when, {
+                    'level': randomizer.randint(5, 100),
+                    'scale': 100,
+                }, here_tz=here_tz)
+
+            if offset % 3600 == 0:
+                yield self.make_point(reference, definitions['pdk-app-event'], when, {
+                    'event_name': 'app-block-warning',
+                    'event_details': {
+                        'package': package,
+                        'minutes-remaining': randomizer.randint(1, 15),
+                    },
+                }, secondary_identifier='app-block-warning', here_tz=here_tz)
+
+            if offset % 86400 == 0:
+                effective_on = int(when.timestamp() * 1000)
+
+                yield self.make_point(reference, definitions['pdk-app-event'], when, {
+                    'event_name': 'set-snooze-cost',
+                    'event_details': {
+                        'snooze-cost': randomizer.choice([0.0, 0.25, 0.5, 1.0]),
+                    },
+                }, secondary_identifier='set-snooze-cost', here_tz=here_tz)
+
+                yield self.make_point(reference, definitions['snooze-delay'], when, {
+                    'snooze_delay': randomizer.choice([0, 5, 10]),
+                    'effective_on': effective_on,
+                }, here_tz=here_tz)
+
+    def seed_database(self, batch_size=5000):
+        foreign = self.foreign_identifiers()
+
+        if foreign:
+            raise ValueError('Benchmark sources already used by other data: ' + ', '.join(foreign))
+
+        randomizer = random.Random(self.seed) # nosec
+
+        self.clear()
+
+        group = DataSourceGroup.objects.order_by('name').first()
+
+        definitions = {}
+
+        for identifier in ('pdk-foreground-application', 'pdk-system-status', 'pdk-device-battery', 'pdk-app-event', 'snooze-delay',):
+            definitions[identifier] = DataGeneratorDefinition.definition_for_identifier(identifier)
+
+        point_count = 0
+
+        for identifier in self.identifiers():
+            # The participant (and its marker) comes first, so an interrupted run can still be cleared.
+
+            Participant.objects.create(identifier=identifier, email_address=identifier + '@example.com', created=self.start, metadata=json.dumps({BENCHMARK_SECTION: self.description()}, separators=(',', ':')))
+
+            data_source = DataSource(identifier=identifier, name=identifier, group=group)
+            data_source.save()
+
+            reference = DataSourceReference.reference_for_source(identifier)
+
+            batch = []
+
+            for point in self.source_points(randomizer, reference, definitions):
+                batch.append(point)
+
+                if len(batch) >= batch_size:
+                    DataPoint.objects.bulk_create(batch)
+
+                    point_count += len(batch)
+
+                    batch = []
+
+            DataPoint.objects.bulk_create(batch)
+
+            point_count += len(batch)
+
+        return point_count
+
+
+def count_report_rows(filename):
+    if filename is None or os.path.exists(filename) is False:
+        return 0
+
+    if filename.endswith('.zip'):
+        with zipfile.ZipFile(filename) as archive:
+            return len(archive.namelist())
+
+    with open(filename, 'r', encoding='utf-8') as report_file:
+        rows = sum(1 for line in report_file if line.strip())
+
+    return max(rows - 1, 0)
+
+
+def run_benchmark(compile_function, generator, sources, data_start, data_end, **kwargs):
+    counter = QueryCounter()
+
+    reset_peak_rss()
+
+    start = time.time()
+
+    with connection.execute_wrapper(counter):
+        filename = compile_function(generator, sources, data_start=data_start, data_end=data_end, date_type='created', output_format='tsv', compression=None, **kwargs)
+
+    elapsed = time.time() - start
+
+    rows = count_report_rows(filename)
+
+    if filename is not None and os.path.exists(filename):
+        os.remove(filename)
+
+    return {
+        'seconds': elapsed,
+        'rows': rows,
+        'rows_per_second': rows / elapsed if elapsed > 0 else 0.0,
+        'queries': counter.count,
+        'peak_rss_mb': current_peak_rss(),
+    }
+
+
+def compare_results(previous, current):
+    lines = []
+
+    lines.append('GENERATOR\tSECONDS\tPREVIOUS\tCHANGE\tQUERIES\tPREVIOUS')
+
+    for generator, result in current['results'].items():
+        before = previous.get('results', {}).get(generator, None)
+
+        if before is None or before.get('seconds', 0) == 0:
+            lines.append('%s\t%.3f\t-\t-\t%d\t-' % (generator, result['seconds'], result['queries']))
+        else:
+            change = 100.0 * (result['seconds'] - before['seconds']) / before['seconds']
+
+            lines.append('%s\t%.3f\t%.3f\t%+.1f%%\t%d\t%d' % (generator, result['seconds'], before['seconds'], change, result['queries'], before['queries']))
+
+    return '\n'.join(lines)
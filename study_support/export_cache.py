@@ -0,0 +1,126 @@
+# pylint: disable=line-too-long, no-member
+
+import collections
+import datetime
+
+import pytz
+
+from django.conf import settings
+
+from passive_data_kit.generators.pdk_foreground_application import fetch_app_genre
+
+DEFAULT_GENRE_CACHE_SIZE = 4096
+
+def genre_cache_size():
+    try:
+        return int(settings.PD_EXPORT_GENRE_CACHE_SIZE)
+    except AttributeError:
+        pass
+
+    return DEFAULT_GENRE_CACHE_SIZE
+
+
+class ExportCache:
+    '''
+    Per-export cache for the lookups repeated on every row: app genres (LRU,
+    filled as packages appear), pytz zones (interned by name) and
+    UTC-to-local conversions. Conversions use a fixed offset for each zone and
+    UTC day without a transition, and fall back to pytz on transition days.
+    '''
+
+    def __init__(self, genre_size=None):
+        if genre_size is None:
+            genre_size = genre_cache_size()
+
+        self.genre_size = genre_size
+        self.genres = collections.OrderedDict()
+        self.zones = {}
+        self.windows = {}
+
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def genre(self, package):
+        if package in self.genres:
+            self.hits['genre'] += 1
+
+            self.genres.move_to_end(package)
+
+            return self.genres[package]
+
+        self.misses['genre'] += 1
+
+        genre = fetch_app_genre(package)
+
+        self.genres[package] = genre
+
+        if len(self.genres) > self.genre_size:
+            self.genres.popitem(last=False)
+
+        return genre
+
+    def timezone(self, name):
+        zone = self.zones.get(name, None)
+
+        if zone is not None:
+            self.hits['timezone'] += 1
+
+            return zone
+
+        self.misses['timezone'] += 1
+
+        zone = pytz.timezone(name)
+
+        self.zones[name] = zone
+
+        return zone
+
+    def local_time(self, when, zone):
+        day = when.astimezone(pytz.utc).date()
+
+        key = (zone.zone, day,)
+
+        if key in self.windows:
+            self.hits['offset'] += 1
+
+            fixed_zone = self.windows[key]
+        else:
+            self.misses['offset'] += 1
+
+            day_start = datetime.datetime(day.year, day.month, day.day, tzinfo=pytz.utc)
+
+            start_offset = day_start.astimezone(zone).utcoffset()
+            end_offset = (day_start + datetime.timedelta(days=1)).astimezone(zone).utcoffset()
+
+            fixed_zone = None
+
+            if start_offset == end_offset:
+                fixed_zone = datetime.timezone(start_offset)
+
+            self.windows[key] = fixed_zone
+
+        if fixed_zone is None:
+            return when.astimezone(zone)
+
+        return when.astimezone(fixed_zone)
+
+    def merge(self, other):
+        # Adds the lookup counts of a cache used elsewhere (such as a parallel export's shard).
+
+        self.hits.update(other.hits)
+        self.misses.update(other.misses)
+
+    def summary(self):
+        stats = []
+
+        for name in ('genre', 'timezone', 'offset',):
+            lookups = self.hits[name] + self.misses[name]
+
+            hit_rate = 0.0
+
+            if lookups > 0:
+                hit_rate = 100.0 * self.hits[name] / lookups
+
+            stats.append('%s: %d hits, %d misses (%.1f%%)' % (name, self.hits[name], self.misses[name], hit_rate))
+
+        return '; '.join(stats)
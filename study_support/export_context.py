@@ -0,0 +1,76 @@
+# pylint: disable=line-too-long, no-member
+
+from passive_data_kit.models import DataGeneratorDefinition, DataSource, DataSourceReference
+
+from .models import Participant
+
+LOOKUP_CHUNK_SIZE = 1000
+
+def chunked(items, size=LOOKUP_CHUNK_SIZE):
+    for index in range(0, len(items), size):
+        yield items[index:(index + size)]
+
+
+class ExportContext:
+    '''
+    Resolves the data sources, source references and participants for every
+    identifier in an export with a handful of __in queries, instead of separate
+    lookups per source. Each kind of object is fetched the first time it is
+    needed.
+    '''
+
+    def __init__(self, sources):
+        self.identifiers = sorted(set(sources))
+
+        self.data_sources = None
+        self.source_references = None
+        self.participants = None
+        self.definitions = {}
+
+    def data_source(self, identifier):
+        if self.data_sources is None:
+            self.data_sources = {}
+
+            for chunk in chunked(self.identifiers):
+                for data_source in DataSource.objects.filter(identifier__in=chunk).select_related('server'):
+                    self.data_sources[data_source.identifier] = data_source
+
+        return self.data_sources.get(identifier, None)
+
+    def is_local(self, identifier):
+        data_source = self.data_source(identifier)
+
+        return data_source is not None and data_source.server is None
+
+    def source_reference(self, identifier):
+        if self.source_references is None:
+            self.source_references = {}
+
+            for chunk in chunked(self.identifiers):
+                for reference in DataSourceReference.objects.filter(source__in=chunk):
+                    self.source_references[reference.source] = reference
+
+        reference = self.source_references.get(identifier, None)
+
+        if reference is None:
+            reference = DataSourceReference.reference_for_source(identifier)
+
+            self.source_references[identifier] = reference
+
+        return reference
+
+    def participant(self, identifier):
+        if self.participants is None:
+            self.participants = {}
+
+            for chunk in chunked(self.identifiers):
+                for participant in Participant.objects.filter(identifier__in=chunk).defer('metadata'):
+                    self.participants[participant.identifier] = participant
+
+        return self.participants.get(identifier, None)
+
+    def definition(self, generator_identifier):
+        if (generator_identifier in self.definitions) is False:
+            self.definitions[generator_identifier] = DataGeneratorDefinition.definition_for_identifier(generator_identifier)
+
+        return self.definitions[generator_identifier]
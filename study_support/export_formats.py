@@ -0,0 +1,462 @@
+# pylint: disable=line-too-long
+
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import json
+
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from django.conf import settings
+
+from .point_streams import export_batch_size
+
+OUTPUT_FORMATS = (
+    ('tsv', 'Tab-separated text',),
+    ('columnar', 'Compressed typed columns (NumPy .npz)',),
+)
+
+# Column types shared by the custom generators, keyed by column header. Headers not listed here
+# are stored as plain strings.
+
+COLUMN_TYPES = {
+    'Date Created': 'timestamp',
+    'Date Recorded': 'timestamp',
+    'Created': 'timestamp',
+    'Recorded': 'timestamp',
+    'Updated': 'timestamp',
+    'Effective Date': 'timestamp',
+    'Opt-Out Date': 'timestamp',
+    'Last Data Date': 'timestamp',
+    'Last Upload': 'timestamp',
+    'First Use': 'timestamp',
+    'Last Use': 'timestamp',
+    'Monitor Start': 'timestamp',
+    'Monitor End': 'timestamp',
+    'Facebook Start': 'timestamp',
+    'Facebook End': 'timestamp',
+    'Instagram Start': 'timestamp',
+    'Instagram End': 'timestamp',
+    'Snapchat Start': 'timestamp',
+    'Snapchat End': 'timestamp',
+    'Updated Datetime': 'timestamp',
+    'Effective Datetime': 'timestamp',
+    'Date': 'date',
+    'Duration': 'number',
+    'Usage': 'number',
+    'Usage (Milliseconds)': 'number',
+    'Device Runtime': 'number',
+    'App Runtime': 'number',
+    'Battery Level': 'number',
+    'Hour of Day': 'number',
+    'New Limit': 'number',
+    'Price Per Snooze': 'number',
+    'Initial Budget': 'number',
+    'Remaining Budget': 'number',
+    'Limit Extension': 'number',
+    'Minutes': 'number',
+    'Delay': 'number',
+    'Snooze Extension': 'number',
+    'Snooze Delay': 'number',
+    'Usage Change': 'number',
+    'App Limits': 'number',
+    'Snoozes': 'number',
+    'Last Upload Delay': 'number',
+    'Facebook Usage': 'number',
+    'Instagram Usage': 'number',
+    'Snapchat Usage': 'number',
+    'PhaseUseOverall (ms)': 'number',
+    'PhaseUseFB (ms)': 'number',
+    'PhaseUseIG (ms)': 'number',
+    'PhaseUseSnap (ms)': 'number',
+    'PhaseUseYoutube (ms)': 'number',
+    'PhaseUseBrowser (ms)': 'number',
+    'Screen Active': 'flag',
+    'Transmitting': 'flag',
+    'Active': 'flag',
+    'Opted Out': 'flag',
+    'E-Mail Enabled': 'flag',
+    'Source': 'category',
+    'App Code': 'category',
+    'App Code / Identifier': 'category',
+    'Participant': 'category',
+    'Identifier': 'category',
+    'Time Zone': 'category',
+    'Device': 'category',
+    'Foreground App': 'category',
+    'App': 'category',
+    'Package': 'category',
+    'Label': 'category',
+    'Play Store Category': 'category',
+    'App Category': 'category',
+    'Event': 'category',
+    'Group': 'category',
+    'Blocker': 'category',
+    'Snooze Cost': 'category',
+    'Server': 'category',
+    'App Version': 'category',
+    'Platform Version': 'category',
+    'Phone Model': 'category',
+    'Window Permission': 'category',
+    'App Usage Permission': 'category',
+    'User Mode': 'category',
+}
+
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.gz',
+    'xz': '.xz',
+    'zstd': '.zst',
+}
+
+DEFAULT_COMPRESSION_LEVELS = {
+    'gzip': 6,
+    'xz': 6,
+    'zstd': 3,
+}
+
+MISSING_TIMESTAMP = numpy.datetime64('NaT', 'ms')
+
+def export_output_format():
+    try:
+        return settings.PD_EXPORT_FORMAT
+    except AttributeError:
+        pass
+
+    return 'tsv'
+
+
+def export_compression():
+    try:
+        return settings.PD_EXPORT_COMPRESSION
+    except AttributeError:
+        pass
+
+    return None
+
+
+def export_compression_level(compression):
+    try:
+        return settings.PD_EXPORT_COMPRESSION_LEVEL
+    except AttributeError:
+        pass
+
+    return DEFAULT_COMPRESSION_LEVELS.get(compression, None)
+
+
+def available_compressions():
+    compressions = ['gzip']
+
+    if lzma is not None:
+        compressions.append('xz')
+
+    if zstandard is not None:
+        compressions.append('zstd')
+
+    return compressions
+
+
+def report_filename(filename, output_format, compression=None):
+    if output_format == 'columnar':
+        return filename.replace('.txt', '.npz')
+
+    if compression is not None:
+        return filename + COMPRESSION_EXTENSIONS[compression]
+
+    return filename
+
+
+def open_report_stream(filename, compression=None, level=None):
+    if compression is None:
+        return open(filename, 'w', encoding='utf-8') # pylint: disable=consider-using-with
+
+    if (compression in available_compressions()) is False:
+        raise ValueError('Unsupported or unavailable export compression: ' + str(compression))
+
+    if level is None:
+        level = export_compression_level(compression)
+
+    if compression == 'gzip':
+        return gzip.open(filename, 'wt', compresslevel=level, encoding='utf-8')
+
+    if compression == 'xz':
+        return lzma.open(filename, 'wt', preset=level, encoding='utf-8')
+
+    compressor = zstandard.ZstdCompressor(level=level)
+
+    return io.TextIOWrapper(compressor.stream_writer(open(filename, 'wb')), encoding='utf-8') # pylint: disable=consider-using-with
+
+
+def is_missing(value):
+    return value is None or value == ''
+
+
+def encode_timestamps(values):
+    instants = numpy.full(len(values), MISSING_TIMESTAMP, dtype='datetime64[ms]')
+    offsets = numpy.zeros(len(values), dtype=numpy.int16)
+
+    for value_index, value in enumerate(values):
+        if is_missing(value) is False:
+            if isinstance(value, datetime.datetime) is False:
+                value = datetime.datetime.fromisoformat(str(value))
+
+            offset = value.utcoffset()
+
+            if offset is not None:
+                offsets[value_index] = int(offset.total_seconds() / 60)
+                value = (value - offset).replace(tzinfo=None)
+
+            instants[value_index] = numpy.datetime64(value, 'ms')
+
+    return {'values': instants, 'offsets': offsets}
+
+
+def encode_dates(values):
+    dates = numpy.full(len(values), numpy.datetime64('NaT', 'D'), dtype='datetime64[D]')
+
+    for value_index, value in enumerate(values):
+        if is_missing(value) is False:
+            dates[value_index] = numpy.datetime64(str(value)[:10], 'D')
+
+    return {'values': dates}
+
+
+def encode_numbers(values):
+    # Missing values are NaN like unparseable ones, so the mask records which cells were empty.
+
+    numbers = numpy.full(len(values), numpy.nan, dtype=numpy.float64)
+    missing = numpy.zeros(len(values), dtype=numpy.bool_)
+
+    for value_index, value in enumerate(values):
+        if is_missing(value):
+            missing[value_index] = True
+        else:
+            try:
+                numbers[value_index] = float(value)
+            except ValueError:
+                pass
+
+    return {'values': numbers, 'missing': missing}
+
+
+def encode_flags(values):
+    flags = numpy.full(len(values), -1, dtype=numpy.int8)
+
+    for value_index, value in enumerate(values):
+        if is_missing(value) is False:
+            flags[value_index] = 1 if str(value) in ('1', 'True') else 0
+
+    return {'values': flags}
+
+
+def encode_categories(values, dictionary):
+    # Codes index the column's dictionary, which grows across chunks; -1 marks missing values.
+
+    codes = numpy.full(len(values), -1, dtype=numpy.int32)
+
+    for value_index, value in enumerate(values):
+        if is_missing(value) is False:
+            value = str(value)
+
+            code = dictionary.get(value, None)
+
+            if code is None:
+                code = len(dictionary)
+                dictionary[value] = code
+
+            codes[value_index] = code
+
+    return {'values': codes}
+
+
+def encode_strings(values):
+    strings = []
+
+    for value in values:
+        if is_missing(value):
+            strings.append('')
+        else:
+            strings.append(str(value))
+
+    return {'values': numpy.array(strings, dtype=str)}
+
+
+COLUMN_ENCODERS = {
+    'timestamp': encode_timestamps,
+    'date': encode_dates,
+    'number': encode_numbers,
+    'flag': encode_flags,
+    'string': encode_strings,
+}
+
+
+class ColumnarWriter: # pylint: disable=too-many-instance-attributes
+    '''
+    Drop-in replacement for csv.writer that stores each column as typed NumPy
+    arrays inside a deflated .npz archive. The first row written is the header.
+    Rows are buffered and flushed in chunks of PD_EXPORT_BATCH_SIZE, and
+    category columns are dictionary-encoded as int32 codes.
+    '''
+
+    def __init__(self, filename, chunk_size=None):
+        self.archive = ZipFile(filename, 'w', compression=ZIP_DEFLATED, allowZip64=True) # pylint: disable=consider-using-with
+
+        if chunk_size is None:
+            chunk_size = export_batch_size()
+
+        self.chunk_size = chunk_size
+        self.chunk_count = 0
+        self.row_count = 0
+
+        self.columns = None
+        self.types = None
+        self.buffers = None
+        self.dictionaries = None
+
+    def writerow(self, row):
+        if self.columns is None:
+            self.columns = [str(column) for column in row]
+            self.types = [COLUMN_TYPES.get(column, 'string') for column in self.columns]
+            self.buffers = [[] for column in self.columns]
+            self.dictionaries = [{} for column in self.columns]
+
+            return
+
+        for index, buffer in enumerate(self.buffers):
+            if index < len(row):
+                buffer.append(row[index])
+            else:
+                buffer.append(None)
+
+        self.row_count += 1
+
+        if len(self.buffers[0]) >= self.chunk_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_array(self, name, array):
+        buffer = io.BytesIO()
+
+        numpy.save(buffer, array, allow_pickle=False)
+
+        self.archive.writestr(name + '.npy', buffer.getvalue())
+
+    def encode_column(self, index, values):
+        if self.types[index] == 'category':
+            return encode_categories(values, self.dictionaries[index])
+
+        return COLUMN_ENCODERS[self.types[index]](values)
+
+    def flush(self):
+        if self.buffers is None or len(self.buffers[0]) == 0: # pylint: disable=len-as-condition
+            return
+
+        for index, values in enumerate(self.buffers):
+            for key, array in self.encode_column(index, values).items():
+                self.write_array('c%03d_%s_%06d' % (index, key, self.chunk_count), array)
+
+            self.buffers[index] = []
+
+        self.chunk_count += 1
+
+    def close(self):
+        self.flush()
+
+        if self.columns is not None:
+            for index, dictionary in enumerate(self.dictionaries):
+                if self.types[index] == 'category':
+                    categories = sorted(dictionary.keys(), key=lambda value, lookup=dictionary: lookup[value])
+
+                    self.write_array('c%03d_categories' % index, numpy.array(categories, dtype=str))
+
+            schema = {
+                'columns': self.columns,
+                'types': self.types,
+                'chunks': self.chunk_count,
+                'rows': self.row_count,
+            }
+
+            self.write_array('schema', numpy.array(json.dumps(schema)))
+
+        self.archive.close()
+
+
+@contextlib.contextmanager
+def report_writer(filename, output_format='tsv', compression=None):
+    if output_format == 'columnar':
+        writer = ColumnarWriter(filename)
+
+        try:
+            yield writer
+        finally:
+            writer.close()
+    else:
+        with open_report_stream(filename, compression) as outfile:
+            yield csv.writer(outfile, delimiter='\t')
+
+
+def load_columnar_report(filename):
+    '''
+    Loads a columnar export into a dictionary of NumPy arrays keyed by column
+    header, suitable for pandas.DataFrame(...). Timestamp columns are UTC
+    datetime64[ms] values with the original UTC offsets (in minutes) under
+    "<column> UTC Offset"; number columns are float64 with a boolean
+    "<column> Missing" mask telling empty cells from NaN values; category
+    columns are decoded to strings.
+    '''
+
+    columns = {}
+
+    with numpy.load(filename, allow_pickle=False) as archive:
+        schema = json.loads(str(archive['schema']))
+
+        for index, column in enumerate(schema['columns']):
+            column_type = schema['types'][index]
+
+            chunks = [archive['c%03d_values_%06d' % (index, chunk)] for chunk in range(0, schema['chunks'])]
+
+            if chunks:
+                values = numpy.concatenate(chunks)
+            else:
+                values = numpy.array([])
+
+            if column_type == 'category':
+                categories = numpy.append(archive['c%03d_categories' % index], '')
+
+                values = categories[values]
+
+            columns[column] = values
+
+            if column_type == 'timestamp':
+                offsets = [archive['c%03d_offsets_%06d' % (index, chunk)] for chunk in range(0, schema['chunks'])]
+
+                if offsets:
+                    columns[column + ' UTC Offset'] = numpy.concatenate(offsets)
+                else:
+                    columns[column + ' UTC Offset'] = numpy.array([], dtype=numpy.int16)
+
+            if column_type == 'number':
+                missing = [archive['c%03d_missing_%06d' % (index, chunk)] for chunk in range(0, schema['chunks'])]
+
+                if missing:
+                    columns[column + ' Missing'] = numpy.concatenate(missing)
+                else:
+                    columns[column + ' Missing'] = numpy.array([], dtype=numpy.bool_)
+
+    return columns
@@ -0,0 +1,41 @@
+# pylint: disable=line-too-long
+
+class AsOfCursor: # pylint: disable=too-few-public-methods
+    '''
+    Walks a created-ordered stream of (created, recorded, properties) tuples and
+    resolves the latest item strictly preceding a requested time. Lookups must
+    arrive in non-decreasing order, so each item is visited once.
+    '''
+
+    def __init__(self, items):
+        self.items = iter(items)
+        self.current = None
+        self.pending = next(self.items, None)
+
+    def latest_before(self, when):
+        while self.pending is not None and self.pending[0] < when:
+            self.current = self.pending
+            self.pending = next(self.items, None)
+
+        return self.current
+
+
+def as_of_join(primary, **streams):
+    '''
+    Yields (item, context) pairs for each item in the created-ordered primary
+    stream, where context maps each named stream to its latest item preceding
+    the primary item (or None).
+    '''
+
+    cursors = {}
+
+    for name, items in streams.items():
+        cursors[name] = AsOfCursor(items)
+
+    for item in primary:
+        context = {}
+
+        for name, cursor in cursors.items():
+            context[name] = cursor.latest_before(item[0])
+
+        yield item, context
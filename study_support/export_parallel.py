@@ -0,0 +1,115 @@
+# pylint: disable=line-too-long
+
+import csv
+import functools
+import multiprocessing
+import os
+
+from django.conf import settings
+from django.db import connections
+
+from .export_formats import report_writer
+
+# Generators whose output is a header row followed by independent per-source rows.
+
+PARALLEL_GENERATORS = (
+    'nyu-full-export',
+    'nyu-daily-usage-summary',
+    'nyu-app-budgets',
+    'nyu-snooze-costs',
+    'nyu-snooze-events',
+    'nyu-snooze-warnings',
+    'nyu-participant-status',
+    'nyu-snooze-delays',
+    'phone-dashboard-yesterday-summaries',
+)
+
+def export_worker_count():
+    try:
+        return int(settings.PD_EXPORT_WORKERS)
+    except AttributeError:
+        pass
+
+    return 1
+
+
+def initialize_worker():
+    # Connections were closed before forking, so each worker opens its own.
+
+    connections.close_all()
+
+
+def compile_shard(compile_function, generator, options, source):
+    # options arrive pickled with each task, so the watermarks and export_cache in them are this
+    # shard's own copies. They are returned for the parent to merge.
+
+    try:
+        shard = compile_function(generator, [source], shard=True, output_format='tsv', compression=None, **options)
+
+        return source, shard, options['watermarks'], options['export_cache']
+    finally:
+        connections.close_all()
+
+
+def merge_shards(filename, shards, output_format='tsv', compression=None):
+    header_written = False
+
+    with report_writer(filename, output_format, compression) as writer:
+        for shard in shards:
+            with open(shard, 'r', encoding='utf-8', newline='') as shard_file:
+                reader = csv.reader(shard_file, delimiter='\t')
+
+                header = next(reader, None)
+
+                if header_written is False and header is not None:
+                    writer.writerow(header)
+
+                    header_written = True
+
+                writer.writerows(reader)
+
+            os.remove(shard)
+
+    return filename
+
+
+def compile_parallel(compile_function, filename, generator, sources, *, workers=None, output_format='tsv', compression=None, watermarks=None, export_cache=None, **options): # pylint: disable=too-many-arguments, too-many-locals
+    # options (data_start, data_end, date_type) are passed through to compile_function for each
+    # source, which runs with shard=True: it neither saves watermarks nor prints statistics. The
+    # shards' pending watermarks and cache statistics are merged into watermarks and export_cache,
+    # for the caller to save and report once the merged file is written.
+
+    if workers is None:
+        workers = export_worker_count()
+
+    sources = sorted(sources)
+
+    options['watermarks'] = watermarks
+    options['export_cache'] = export_cache
+
+    connections.close_all()
+
+    shards = {}
+
+    with multiprocessing.get_context('fork').Pool(processes=workers, initializer=initialize_worker) as pool:
+        for source, shard, shard_watermarks, shard_cache in pool.imap_unordered(functools.partial(compile_shard, compile_function, generator, options), sources):
+            if shard is not None:
+                shards[source] = shard
+
+            if watermarks is not None:
+                watermarks.merge(shard_watermarks)
+
+            if export_cache is not None:
+                export_cache.merge(shard_cache)
+
+    ordered_shards = [shards[source] for source in sources if source in shards]
+
+    if len(ordered_shards) == 0: # pylint: disable=len-as-condition
+        # No source produced a shard, so a shard without sources supplies the header.
+
+        header_shard = compile_function(generator, [], shard=True, output_format='tsv', compression=None, **options)
+
+        if header_shard is not None:
+            ordered_shards.append(header_shard)
+
+    return merge_shards(filename, ordered_shards, output_format, compression)
@@ -0,0 +1,246 @@
+# pylint: disable=line-too-long, no-member
+
+import itertools
+import resource
+import sys
+
+import numpy
+
+from django.db.models import Min
+
+from passive_data_kit.models import DataGeneratorDefinition
+
+from .export_cache import ExportCache
+from .export_joins import as_of_join
+from .point_streams import export_batch_size, stream_points
+from .screen_time import to_microseconds, trimmed_durations
+
+# Streams joined to each foreground application row, resolved as of the row's creation time.
+
+FULL_EXPORT_CONTEXT_GENERATORS = (
+    ('status', 'pdk-system-status',),
+    ('battery', 'pdk-device-battery',),
+    ('user', 'pdk-user',),
+)
+
+# Position of each watermark field in decoded (created, recorded, properties) tuples.
+
+DECODED_FIELDS = {
+    'created': 0,
+    'recorded': 1,
+}
+
+def generator_points(points, generator_identifier):
+    definition = DataGeneratorDefinition.definition_for_identifier(generator_identifier)
+
+    return points.filter(generator_definition=definition)
+
+
+def fetch_points(points, generator_identifier):
+    return stream_points(generator_points(points, generator_identifier))
+
+
+def latest_point_before(points, when):
+    return points.filter(created__lt=when).order_by('-created', '-pk').first()
+
+
+def resumed_points(points, start):
+    # Streams the points created at or after start, preceded by the latest point before it, so
+    # that joins and trimming see the same predecessor a full-window read would.
+
+    previous = latest_point_before(points, start)
+
+    if previous is not None:
+        yield previous
+
+    yield from stream_points(points.filter(created__gte=start))
+
+
+def decode_points(points):
+    for point in points:
+        yield (point.created, point.recorded, point.fetch_properties(),)
+
+
+def trim_durations(joined, batch_size=None, last_seen=None):
+    '''
+    Drops rows that repeat the previous row's creation time and attaches each
+    remaining row's duration, trimmed by the shared screen-time rule against
+    the previous row. Rows are processed in batches of PD_EXPORT_BATCH_SIZE.
+    last_seen (microseconds since the epoch) is the creation time of the row
+    before the first one, when resuming part way through a source.
+    '''
+
+    if batch_size is None:
+        batch_size = export_batch_size()
+
+    while True:
+        batch = list(itertools.islice(joined, batch_size))
+
+        if len(batch) == 0: # pylint: disable=len-as-condition
+            return
+
+        created = numpy.array([to_microseconds(point[0]) for point, context in batch], dtype=numpy.int64)
+
+        previous = numpy.empty(len(created), dtype=numpy.int64)
+        previous[1:] = created[:-1]
+        previous[0] = -1 if last_seen is None else last_seen
+
+        kept = created != previous
+
+        kept_rows = [row for row, keep in zip(batch, kept.tolist()) if keep]
+
+        durations = numpy.array([point[2]['duration'] for point, context in kept_rows], dtype=numpy.float64)
+
+        trimmed, was_trimmed = trimmed_durations(created[kept], durations, last_seen)
+
+        for (point, context), duration, cut in zip(kept_rows, trimmed.tolist(), was_trimmed.tolist()):
+            if cut:
+                yield point, context, duration
+            else:
+                yield point, context, point[2]['duration']
+
+        last_seen = int(created[-1])
+
+
+def context_columns(context):
+    # Device runtime, app runtime, battery level and user mode as of a foreground row.
+
+    columns = [None, None, None, None]
+
+    last_status = context['status']
+
+    if last_status is not None:
+        columns[0] = last_status[2].get('system_runtime', None)
+        columns[1] = last_status[2]['runtime']
+
+    last_battery = context['battery']
+
+    if last_battery is not None:
+        columns[2] = 100.0 * (float(last_battery[2]['level']) / float(last_battery[2]['scale']))
+
+    last_user = context['user']
+
+    if last_user is not None:
+        columns[3] = last_user[2].get('mode', None)
+
+    return columns
+
+
+def format_full_export_rows(source, trimmed, export_cache):
+    for point, context, duration in trimmed:
+        here_tz = export_cache.timezone(point[2]['passive-data-metadata']['timezone'])
+
+        row = []
+
+        row.append(source)
+
+        created = export_cache.local_time(point[0], here_tz)
+
+        row.append(created.isoformat())
+
+        recorded = export_cache.local_time(point[1], here_tz)
+
+        row.append(recorded.isoformat())
+
+        row.append(point[2]['passive-data-metadata']['timezone'])
+
+        model = point[2]['passive-data-metadata']['generator'].split(';')[-1].strip().replace(')', '')
+
+        row.append(model)
+
+        row.append(duration)
+
+        if 'application' in point[2]:
+            row.append(point[2]['application'])
+            row.append(export_cache.genre(point[2]['application']))
+        else:
+            row.append('')
+            row.append('')
+
+        if point[2]['screen_active']:
+            row.append(1)
+        else:
+            row.append(0)
+
+        row.extend(context_columns(context))
+
+        yield row
+
+
+def joined_export_rows(source, app_points, context_points, export_cache, *, last_seen=None, after=None, field='created'): # pylint: disable=too-many-arguments
+    '''
+    Joins decoded foreground points to the decoded context streams, trims
+    durations and formats the rows. With after set, only rows whose field
+    (created or recorded) is past it are formatted; the earlier points only
+    serve as join and trimming context.
+    '''
+
+    trimmed = trim_durations(as_of_join(app_points, **context_points), last_seen=last_seen)
+
+    if after is not None:
+        index = DECODED_FIELDS[field]
+
+        trimmed = (row for row in trimmed if row[0][index] > after)
+
+    return format_full_export_rows(source, trimmed, export_cache)
+
+
+def full_export_rows(source, points, export_cache=None, after=None, field='created'):
+    '''
+    Streams nyu-full-export rows for one source: fetch (keyset pages), decode,
+    as-of join, duration trimming and row format stages are chained generators,
+    so at most one page per stream is resident regardless of the source's
+    history. With after set (an export watermark on field), only foreground
+    rows past it are written, but the context streams and the previous
+    foreground point are read from before it, so the rows match the same rows
+    of a full-window export.
+    '''
+
+    if export_cache is None:
+        export_cache = ExportCache()
+
+    if after is None:
+        app_points = decode_points(fetch_points(points, 'pdk-foreground-application'))
+
+        context_points = {}
+
+        for name, generator_identifier in FULL_EXPORT_CONTEXT_GENERATORS:
+            context_points[name] = decode_points(fetch_points(points, generator_identifier))
+
+        return joined_export_rows(source, app_points, context_points, export_cache)
+
+    foreground_points = generator_points(points, 'pdk-foreground-application')
+
+    start = foreground_points.filter(**{field + '__gt': after}).aggregate(start=Min('created'))['start']
+
+    if start is None:
+        return iter([])
+
+    last_seen = None
+
+    previous = latest_point_before(foreground_points, start)
+
+    if previous is not None:
+        last_seen = to_microseconds(previous.created)
+
+    app_points = decode_points(stream_points(foreground_points.filter(created__gte=start)))
+
+    context_points = {}
+
+    for name, generator_identifier in FULL_EXPORT_CONTEXT_GENERATORS:
+        context_points[name] = decode_points(resumed_points(generator_points(points, generator_identifier), start))
+
+    return joined_export_rows(source, app_points, context_points, export_cache, last_seen=last_seen, after=after, field=field)
+
+
+def peak_memory_usage():
+    # Returns the high-water mark of resident memory in megabytes for this process and any
+    # finished worker processes.
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage = max(usage, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    if sys.platform == 'darwin':
+        return usage / (1024.0 * 1024.0)
+
+    return usage / 1024.0
@@ -0,0 +1,217 @@
+# pylint: disable=line-too-long
+
+import asyncio
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util import Timeout
+
+from django.conf import settings
+from django.urls import reverse
+
+DEFAULT_FEDERATION_CONCURRENCY = 16
+DEFAULT_FEDERATION_PER_SERVER = 4
+DEFAULT_FEDERATION_DEADLINE = 30
+DEFAULT_FEDERATION_RETRIES = 2
+DEFAULT_FEDERATION_BACKOFF = 1.0
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504,)
+
+def federation_setting(name, default):
+    try:
+        return getattr(settings, name)
+    except AttributeError:
+        pass
+
+    return default
+
+
+def data_quality_url(server):
+    components = urlsplit(server.source_metadata_url)
+
+    return urlunsplit([components.scheme, components.netloc, reverse('fetch_participant_data_quality'), '', ''])
+
+
+class FederationTimeout(Exception):
+    pass
+
+
+def post_before(session, url, payload, deadline_at):
+    # Posts payload and reads the whole response before deadline_at (a time.monotonic() value),
+    # returning (status code, body). A plain requests timeout only bounds each socket operation,
+    # so the connection and headers get a total timeout, and the body is streamed with the
+    # deadline checked between chunks.
+
+    remaining = deadline_at - time.monotonic()
+
+    if remaining <= 0:
+        raise FederationTimeout()
+
+    response = session.post(url, data=payload, timeout=Timeout(total=remaining), stream=True)
+
+    try:
+        body = []
+
+        for chunk in response.iter_content(chunk_size=1024):
+            body.append(chunk)
+
+            if time.monotonic() > deadline_at:
+                raise FederationTimeout()
+
+        return response.status_code, b''.join(body)
+    finally:
+        response.close()
+
+
+class FederationResult: # pylint: disable=too-few-public-methods
+    def __init__(self, identifier, server, *, report=None, error=None, attempts=0, elapsed=0.0): # pylint: disable=too-many-arguments
+        self.identifier = identifier
+        self.server = server
+        self.report = report
+        self.error = error
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+    def succeeded(self):
+        return self.report is not None
+
+
+class FederationClient:
+    '''
+    Fetches participant data-quality reports from remote study servers
+    concurrently. Requests share one pooled requests.Session per DataServer and
+    run on worker threads driven by asyncio, bounded overall (concurrency) and
+    per server (per_server). Each attempt has a deadline in seconds, enforced
+    on the whole request and response, and timeouts, connection errors, and
+    429/5xx responses are retried with exponential backoff. Abandoned attempts
+    are never waited for. Servers only need name, source_metadata_url, and
+    request_key attributes, so stub servers can stand in for DataServer rows.
+    '''
+
+    def __init__(self, concurrency=None, per_server=None, deadline=None, retries=None, backoff=None): # pylint: disable=too-many-arguments
+        self.concurrency = concurrency or federation_setting('PD_FEDERATION_CONCURRENCY', DEFAULT_FEDERATION_CONCURRENCY)
+        self.per_server = per_server or federation_setting('PD_FEDERATION_PER_SERVER', DEFAULT_FEDERATION_PER_SERVER)
+        self.deadline = deadline or federation_setting('PD_FEDERATION_DEADLINE', DEFAULT_FEDERATION_DEADLINE)
+
+        if retries is None:
+            retries = federation_setting('PD_FEDERATION_RETRIES', DEFAULT_FEDERATION_RETRIES)
+
+        self.retries = retries
+
+        if backoff is None:
+            backoff = DEFAULT_FEDERATION_BACKOFF
+
+        self.backoff = backoff
+
+        self.sessions = {}
+
+    def session(self, server):
+        if (server.name in self.sessions) is False:
+            session = requests.Session()
+
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.per_server)
+
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            self.sessions[server.name] = session
+
+        return self.sessions[server.name]
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+        self.sessions = {}
+
+    async def fetch_report(self, loop, executor, limits, identifier, server): # pylint: disable=too-many-arguments, too-many-locals
+        url = data_quality_url(server)
+
+        payload = {
+            'identifier': identifier,
+            'request-key': server.request_key
+        }
+
+        session = self.session(server)
+
+        start = time.time()
+
+        error = None
+        attempts = 0
+
+        async with limits['overall'], limits['servers'][server.name]:
+            while attempts <= self.retries:
+                if attempts > 0:
+                    await asyncio.sleep(self.backoff * (2 ** (attempts - 1)))
+
+                attempts += 1
+
+                deadline_at = time.monotonic() + self.deadline
+
+                try:
+                    status_code, body = await asyncio.wait_for(loop.run_in_executor(executor, post_before, session, url, payload, deadline_at), self.deadline)
+                except (asyncio.TimeoutError, FederationTimeout):
+                    error = 'Timed out after %s seconds' % self.deadline
+
+                    continue
+                except requests.RequestException as request_error:
+                    error = 'Request failed: %s' % request_error
+
+                    continue
+
+                if 200 <= status_code < 300:
+                    try:
+                        report = json.loads(body).get('study_performance_report', None)
+                    except (ValueError, AttributeError):
+                        report = None
+
+                    if report is None:
+                        error = 'No performance report in response'
+                    else:
+                        error = None
+
+                    return FederationResult(identifier, server, report=report, error=error, attempts=attempts, elapsed=(time.time() - start))
+
+                error = 'Server code %s' % status_code
+
+                if (status_code in RETRY_STATUS_CODES) is False:
+                    break
+
+        return FederationResult(identifier, server, error=error, attempts=attempts, elapsed=(time.time() - start))
+
+    async def gather_reports(self, targets):
+        loop = asyncio.get_running_loop()
+
+        limits = {
+            'overall': asyncio.Semaphore(self.concurrency),
+            'servers': {},
+        }
+
+        for identifier, server in targets: # pylint: disable=unused-variable
+            if (server.name in limits['servers']) is False:
+                limits['servers'][server.name] = asyncio.Semaphore(self.per_server)
+
+        # Attempts abandoned at their deadline keep a thread until post_before gives up, so the
+        # pool has room for every retry, and is shut down without waiting for those threads.
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency * (self.retries + 1))
+
+        try:
+            return await asyncio.gather(*[self.fetch_report(loop, executor, limits, identifier, server) for identifier, server in targets])
+        finally:
+            executor.shutdown(wait=False)
+
+    def fetch_reports(self, targets):
+        # Fetches reports for (participant identifier, server) pairs, returning a FederationResult
+        # for each, in order.
+
+        if not targets:
+            return []
+
+        return asyncio.run(self.gather_reports(targets))
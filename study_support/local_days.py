@@ -0,0 +1,88 @@
+# pylint: disable=line-too-long
+
+import bisect
+import datetime
+import functools
+
+import pytz
+
+from django.conf import settings
+
+from .screen_time import from_microseconds, local_day_bounds, to_microseconds
+
+@functools.lru_cache(maxsize=65536)
+def zone_day_start(time_zone, date):
+    # Local midnight in the zone, as integer microseconds since the epoch.
+
+    return local_day_bounds([date], time_zone)[0][1]
+
+
+class LocalDayIndex:
+    '''
+    Maps a participant's local dates to UTC instants using the time zones their
+    device reported over time (see TimezoneSpan). A date belongs to the zone in
+    effect at UTC noon that day, and each day ends where the next one starts, so
+    days never overlap or leave gaps when a participant changes time zones.
+    Before the first reported zone, the first zone is used; without any, the
+    default zone is.
+    '''
+
+    def __init__(self, spans, default_zone=None):
+        self.starts = []
+        self.zones = []
+
+        for start, time_zone in spans:
+            self.starts.append(to_microseconds(start))
+            self.zones.append(time_zone)
+
+        if default_zone is None or default_zone == '':
+            default_zone = settings.TIME_ZONE
+
+        self.default_zone = default_zone
+
+    def zone_at(self, when):
+        if not self.zones:
+            return self.default_zone
+
+        position = bisect.bisect_right(self.starts, to_microseconds(when)) - 1
+
+        return self.zones[max(position, 0)]
+
+    def zone_for(self, date):
+        return self.zone_at(datetime.datetime(date.year, date.month, date.day, 12, 0, 0, 0, tzinfo=pytz.utc))
+
+    def day_start(self, date):
+        return zone_day_start(self.zone_for(date), date)
+
+    def day_bounds(self, dates):
+        # Returns (date, start, end) for each date, in microseconds since the epoch, in the form
+        # the screen_time helpers expect.
+
+        bounds = []
+
+        for date in dates:
+            bounds.append((date, self.day_start(date), self.day_start(date + datetime.timedelta(days=1)),))
+
+        return bounds
+
+    def day_window(self, date):
+        # Returns the day's start and end as datetimes in the zone the date belongs to.
+
+        here_tz = pytz.timezone(self.zone_for(date))
+
+        date, start, end = self.day_bounds([date])[0]
+
+        return from_microseconds(start).astimezone(here_tz), from_microseconds(end).astimezone(here_tz)
+
+    def date_for(self, when):
+        date = when.astimezone(pytz.timezone(self.zone_at(when))).date()
+
+        moment = to_microseconds(when)
+
+        if moment < self.day_start(date):
+            return date - datetime.timedelta(days=1)
+
+        if moment >= self.day_start(date + datetime.timedelta(days=1)):
+            return date + datetime.timedelta(days=1)
+
+        return date
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member,line-too-long
+
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...export_formats import available_compressions, export_compression_level, open_report_stream, COMPRESSION_EXTENSIONS
+
+class Command(BaseCommand):
+    help = 'Compares wall time and bytes written for each available export compression codec.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file',
+                            type=str,
+                            dest='file',
+                            required=True,
+                            help='Path to an uncompressed tab-separated export (for example, a nyu-full-export report)')
+
+        parser.add_argument('--level',
+                            type=int,
+                            dest='level',
+                            default=None,
+                            help='Compression level to use for every codec (defaults to PD_EXPORT_COMPRESSION_LEVEL or the codec default)')
+
+    def handle(self, *args, **options): # pylint: disable=too-many-locals
+        source_size = os.path.getsize(options['file'])
+
+        print('CODEC\tLEVEL\tSECONDS\tBYTES\tRATIO')
+
+        with open(options['file'], 'r', encoding='utf-8') as source_file:
+            start = time.time()
+
+            destination = os.path.join(tempfile.gettempdir(), 'pd_compression_benchmark.txt')
+
+            with open_report_stream(destination, None) as outfile:
+                shutil.copyfileobj(source_file, outfile)
+
+            elapsed = time.time() - start
+
+            print('none\t-\t%.3f\t%d\t%.3f' % (elapsed, os.path.getsize(destination), 1.0))
+
+            os.remove(destination)
+
+            for compression in available_compressions():
+                level = options['level']
+
+                if level is None:
+                    level = export_compression_level(compression)
+
+                source_file.seek(0)
+
+                destination = os.path.join(tempfile.gettempdir(), 'pd_compression_benchmark.txt' + COMPRESSION_EXTENSIONS[compression])
+
+                start = time.time()
+
+                with open_report_stream(destination, compression, level) as outfile:
+                    shutil.copyfileobj(source_file, outfile)
+
+                elapsed = time.time() - start
+
+                compressed_size = os.path.getsize(destination)
+
+                print('%s\t%s\t%.3f\t%d\t%.3f' % (compression, level, elapsed, compressed_size, float(compressed_size) / max(source_size, 1)))
+
+                os.remove(destination)
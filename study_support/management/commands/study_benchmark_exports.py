@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member,line-too-long
+
+import json
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...export_benchmarks import BenchmarkCohort, compare_results, run_benchmark, BENCHMARK_PREFIX
+from ...pdk_api import compile_report, CUSTOM_GENERATORS
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic cohort and records wall time, rows per second, query count, and peak RSS for the custom export generators.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants',
+                            type=int,
+                            dest='participants',
+                            default=10,
+                            help='Number of synthetic participants to seed')
+
+        parser.add_argument('--days',
+                            type=int,
+                            dest='days',
+                            default=3,
+                            help='Days of synthetic data per participant, ending yesterday')
+
+        parser.add_argument('--interval',
+                            type=int,
+                            dest='interval',
+                            default=60,
+                            help='Seconds between synthetic foreground application points')
+
+        parser.add_argument('--seed',
+                            type=int,
+                            dest='seed',
+                            default=1,
+                            help='Random seed for the synthetic cohort')
+
+        parser.add_argument('--generator',
+                            type=str,
+                            dest='generators',
+                            action='append',
+                            choices=CUSTOM_GENERATORS,
+                            help='Generator to benchmark (repeatable, defaults to all custom generators)')
+
+        parser.add_argument('--workers',
+                            type=int,
+                            dest='workers',
+                            default=1,
+                            help='Worker processes per export (query counts only cover the parent process)')
+
+        parser.add_argument('--skip-seed',
+                            dest='skip_seed',
+                            action='store_true',
+                            help='Reuse the cohort seeded by a previous run with the same settings (and --keep)')
+
+        parser.add_argument('--keep',
+                            dest='keep',
+                            action='store_true',
+                            help='Leave the synthetic cohort in the database afterwards')
+
+        parser.add_argument('--output',
+                            type=str,
+                            dest='output',
+                            default='export_benchmark.json',
+                            help='Path of the JSON results file')
+
+        parser.add_argument('--compare',
+                            type=str,
+                            dest='compare',
+                            default=None,
+                            help='Path of a previous JSON results file to compare against')
+
+    def handle(self, *args, **options): # pylint: disable=too-many-locals
+        cohort = BenchmarkCohort(participants=options['participants'], days=options['days'], interval=options['interval'], seed=options['seed'])
+
+        if options['skip_seed']:
+            if cohort.reuse() is False:
+                raise CommandError('No benchmark cohort with these settings to reuse. Run once without --skip-seed (and with --keep) first.')
+        else:
+            try:
+                point_count = cohort.seed_database()
+            except ValueError as error:
+                raise CommandError(str(error)) from error
+
+            print('Seeded %d points for %d %s* sources.' % (point_count, options['participants'], BENCHMARK_PREFIX))
+
+        generators = options['generators']
+
+        if generators is None:
+            generators = list(CUSTOM_GENERATORS)
+
+        sources = cohort.identifiers()
+
+        results = {
+            'created': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'cohort': {
+                'participants': options['participants'],
+                'days': options['days'],
+                'interval': options['interval'],
+                'seed': options['seed'],
+                'workers': options['workers'],
+            },
+            'results': {},
+        }
+
+        try:
+            for generator in generators:
+                result = run_benchmark(compile_report, generator, sources, cohort.start, cohort.end, workers=options['workers'])
+
+                results['results'][generator] = result
+
+                print('%s: %.3f s, %d rows (%.1f rows/s), %d queries, %.1f MB peak RSS' % (generator, result['seconds'], result['rows'], result['rows_per_second'], result['queries'], result['peak_rss_mb']))
+        finally:
+            if options['keep'] is False:
+                cohort.clear()
+
+        with open(options['output'], 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+        print('Results written to ' + options['output'] + '.')
+
+        if options['compare'] is not None:
+            with open(options['compare'], 'r', encoding='utf-8') as previous_file:
+                print(compare_results(json.load(previous_file), results))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member,line-too-long
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from passive_data_kit.models import DataPoint, DataGeneratorDefinition, DataSourceReference
+
+from ...export_benchmarks import BenchmarkCohort
+from ...screen_time import screen_time_for_points, iterative_screen_time
+
+class Command(BaseCommand):
+    help = 'Checks that the vectorized screen-time calculation matches the point-by-point one, and times both on a dense synthetic day.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval',
+                            type=int,
+                            dest='interval',
+                            default=5,
+                            help='Seconds between synthetic foreground application points')
+
+        parser.add_argument('--repeat',
+                            type=int,
+                            dest='repeat',
+                            default=3,
+                            help='Timed runs per implementation (the fastest is reported)')
+
+        parser.add_argument('--seed',
+                            type=int,
+                            dest='seed',
+                            default=1,
+                            help='Random seed for the synthetic day')
+
+        parser.add_argument('--keep',
+                            dest='keep',
+                            action='store_true',
+                            help='Leave the synthetic points in the database afterwards')
+
+    def handle(self, *args, **options):
+        cohort = BenchmarkCohort(participants=1, days=1, interval=options['interval'], seed=options['seed'], prefix='benchmark-screen-time-')
+
+        try:
+            cohort.seed_database()
+
+            source_reference = DataSourceReference.reference_for_source(cohort.identifiers()[0])
+            generator_definition = DataGeneratorDefinition.definition_for_identifier('pdk-foreground-application')
+
+            points = DataPoint.objects.filter(generator_definition=generator_definition, source_reference=source_reference, created__gte=cohort.start, created__lt=cohort.end)
+
+            print('Points: %d' % points.count())
+
+            results = {}
+
+            for name, implementation in (('iterative', iterative_screen_time,), ('vectorized', screen_time_for_points,),):
+                timings = []
+
+                for _ in range(0, options['repeat']):
+                    start = time.time()
+
+                    results[name] = implementation(points)
+
+                    timings.append(time.time() - start)
+
+                print('%s: %.3f s (%s ms of screen time)' % (name, min(timings), results[name]))
+
+            if results['iterative'] != results['vectorized']:
+                raise CommandError('Screen-time implementations disagree: %s (iterative) vs %s (vectorized).' % (results['iterative'], results['vectorized']))
+
+            print('Implementations agree.')
+        finally:
+            if options['keep'] is False:
+                cohort.clear()
@@ -1,11 +1,9 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=no-member,line-too-long
 
-import datetime
 import json
 
 import arrow
-import pytz
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
@@ -13,6 +11,7 @@ from django.utils import timezone
 from passive_data_kit.models import DataSourceReference, DataGeneratorDefinition, DataPoint, DeviceIssue, DataSource, Device, DeviceModel
 
 from ...models import Participant
+from ...screen_time import ForegroundSamples
 
 # Phone Dashboard/34 Passive Data Kit/1.0 (Android 8.0.0 SDK 26; samsung SM-J737U)
 
@@ -108,11 +107,9 @@ class Command(BaseCommand):
                     properties = tz_point.fetch_properties()
 
                     if 'timezone' in properties['passive-data-metadata']:
-                        my_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
                         user_agent = tz_point.fetch_user_agent()
 
-                        start_date = my_tz.localize(datetime.datetime(fetch_start_date.year, fetch_start_date.month, fetch_start_date.day, 0, 0, 0, 0))
-                        end_date = start_date + datetime.timedelta(days=1)
+                        start_date, end_date = participant.local_days().day_window(fetch_start_date.date())
 
                         blocker = participant.phases.filter(start_date__lte=start_date.date()).exclude(blocker_type='none').order_by('-start_date').first()
 
@@ -137,38 +134,18 @@ class Command(BaseCommand):
                             if budget_item is not None:
                                 limits = json.loads(budget_item['budget'])
 
+                                samples = ForegroundSamples.from_points(DataPoint.objects.filter(source_reference=source_reference, generator_definition=foreground_definition, secondary_identifier__in=list(limits.keys()), created__gte=start_date, created__lt=end_date))
+
                                 for app in limits:
                                     app_limit = limits[app]
 
                                     if app_limit >= 0:
-                                        last_usage = None
-
-                                        on_sum = 0
-                                        off_sum = 0
-
-                                        dupe_count = 0
-
-                                        for app_use in DataPoint.objects.filter(source_reference=source_reference, generator_definition=foreground_definition, secondary_identifier=app, created__gte=start_date, created__lt=end_date).order_by('created'):
-                                            app_properties = app_use.fetch_properties()
-
-                                            duration = app_properties['duration']
-
-                                            if last_usage is None:
-                                                last_usage = app_use.created
-                                            else:
-                                                delta = (app_use.created - last_usage).total_seconds() * 1000
-
-                                                if delta < duration:
-                                                    dupe_count += 1
-
-                                                    duration = delta
+                                        # Overlaps are counted between uses of the same app only.
 
-                                                last_usage = app_use.created
+                                        totals = samples.for_packages([app]).totals().get((None, None,), {'on': 0, 'off': 0, 'trimmed': 0})
 
-                                            if app_properties['screen_active']:
-                                                on_sum += duration
-                                            else:
-                                                off_sum += duration
+                                        on_sum = totals['on']
+                                        dupe_count = totals['trimmed']
 
                                         if on_sum > 0:
                                             block_count = 0
@@ -1,16 +1,65 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=no-member,line-too-long
 
+import bisect
 import datetime
 import json
 
 import arrow
-import pytz
 
 from django.core.management.base import BaseCommand
 
 from passive_data_kit.models import DataSourceReference, DataGeneratorDefinition, DataPoint
 
+from ...models import Participant, TimezoneSpan
+from ...usage_rollups import fetch_minute_rollups
+
+def budget_limits(budget, start_date):
+    # Returns the app limits in effect at start_date under the given budget point.
+
+    budgets = sorted(budget.fetch_properties()['budgets'], key=lambda budget_item: budget_item['effective_on'], reverse=True)
+
+    day_start = arrow.get(start_date).timestamp * 1000
+
+    for item in budgets:
+        if day_start >= item['effective_on']:
+            return json.loads(item['budget'])
+
+    return {}
+
+
+def daily_limits(source, budget_generator, starts):
+    # Returns the app limits for each day start, from the latest budget point created by then.
+    # The budget points for the whole range are read at once (plus the one in effect before it)
+    # instead of one query per day.
+
+    if not starts:
+        return []
+
+    budget_points = DataPoint.objects.filter(source_reference=source, generator_definition=budget_generator)
+
+    budgets = list(budget_points.filter(created__gt=starts[0], created__lte=starts[-1]).order_by('created'))
+
+    previous = budget_points.filter(created__lte=starts[0]).order_by('-created').first()
+
+    if previous is not None:
+        budgets.insert(0, previous)
+
+    created = [budget.created for budget in budgets]
+
+    limits = []
+
+    for start_date in starts:
+        position = bisect.bisect_right(created, start_date) - 1
+
+        if position < 0:
+            limits.append({})
+        else:
+            limits.append(budget_limits(budgets[position], start_date))
+
+    return limits
+
+
 class Command(BaseCommand):
     help = 'Prints participant app usage in minutes on a given date.'
 
@@ -21,6 +70,12 @@ class Command(BaseCommand):
                             required=True,
                             help='Date of app usage in YYY-MM-DD format')
 
+        parser.add_argument('--end-date',
+                            type=str,
+                            dest='end_date',
+                            default=None,
+                            help='Last date (inclusive) of app usage in YYY-MM-DD format, for reporting several days at once')
+
         parser.add_argument('--source',
                             type=str,
                             dest='source',
@@ -30,98 +85,95 @@ class Command(BaseCommand):
         parser.add_argument('--app',
                             type=str,
                             dest='app',
+                            nargs='+',
                             required=True,
-                            help='Package name of the app in use. (Example: com.google.android.youtube)')
+                            help='Package name(s) of the app(s) in use. (Example: com.google.android.youtube)')
+
+        parser.add_argument('--refresh',
+                            dest='refresh',
+                            action='store_true',
+                            help='Recompute the stored per-minute rollups instead of reusing them')
 
     def handle(self, *args, **options): # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-        app = options['app']
+        apps = options['app']
 
         source = DataSourceReference.reference_for_source(options['source'])
-        generator = DataGeneratorDefinition.objects.get(generator_identifier='pdk-foreground-application')
-        # screen_generator = DataGeneratorDefinition.objects.get(generator_identifier='pdk-screen-state')
         budget_generator = DataGeneratorDefinition.objects.get(generator_identifier='full-app-budgets')
 
-        fetch_date = arrow.get(options['date'] + 'T23:59:59+00:00')
-
-        tz_point = DataPoint.objects.filter(source_reference=source, created__lte=fetch_date.datetime).order_by('-created').first()
-
-        if tz_point is not None:
-            properties = tz_point.fetch_properties()
-
-            my_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
-            user_agent = tz_point.fetch_user_agent()
+        first_date = arrow.get(options['date']).date()
+        last_date = first_date
 
-            start_date = my_tz.localize(datetime.datetime(fetch_date.year, fetch_date.month, fetch_date.day, 0, 0, 0, 0))
-            end_date = start_date + datetime.timedelta(days=1)
+        if options['end_date'] is not None:
+            last_date = arrow.get(options['end_date']).date()
 
-            print('start_date: %s', start_date.isoformat())
-            print('end_date: %s', end_date.isoformat())
+        batch = (first_date != last_date) or (len(apps) > 1)
 
-            on_sum = 0
-            off_sum = 0
+        default_zone = Participant.objects.filter(identifier=options['source']).values_list('timezone', flat=True).first()
 
-            dupe_count = 0
+        local_days = TimezoneSpan.index_for(options['source'], default_zone=default_zone)
 
-            last_usage = None
+        # Days before the participant's first point are skipped, as they have no usage to report.
 
-            budget = DataPoint.objects.filter(source_reference=source, generator_definition=budget_generator, created__lte=start_date).order_by('-created').first()
+        first_point = DataPoint.objects.filter(source_reference=source).order_by('created').first()
 
-            budgets = sorted(budget.fetch_properties()['budgets'], key=lambda budget_item: budget_item['effective_on'], reverse=True)
+        days = []
 
-            day_start = arrow.get(start_date).timestamp * 1000
+        index_date = first_date
 
-            budget_item = None
+        while index_date <= last_date:
+            fetch_date = arrow.get(index_date.isoformat() + 'T23:59:59+00:00')
 
-            for item in budgets:
-                if budget_item is None and day_start >= item['effective_on']:
-                    budget_item = item
+            if first_point is not None and first_point.created <= fetch_date.datetime:
+                start_date, end_date = local_days.day_window(index_date)
 
-            limits = json.loads(budget_item['budget'])
+                days.append((index_date, start_date, end_date,))
 
-            app_limit = -1
+            index_date = index_date + datetime.timedelta(days=1)
 
-            if app in limits:
-                app_limit = limits[app]
+        rollups = fetch_minute_rollups(options['source'], apps, [day[0] for day in days], local_days, refresh=options['refresh'])
 
-            while start_date < end_date:
-                slice_start = start_date
-                slice_end = slice_start + datetime.timedelta(seconds=60)
+        day_limits = daily_limits(source, budget_generator, [day[1] for day in days])
 
-                for app_use in DataPoint.objects.filter(source_reference=source, generator_definition=generator, secondary_identifier=app, created__gte=slice_start, created__lt=slice_end).order_by('created'):
-                    app_properties = app_use.fetch_properties()
+        for (date, start_date, end_date,), limits in zip(days, day_limits):
+            if batch is False:
+                print('start_date: %s', start_date.isoformat())
+                print('end_date: %s', end_date.isoformat())
 
-    #                last_screen = DataPoint.objects.filter(source_reference=source, generator_definition=screen_generator, created__lt=app_use.created).order_by('-created').first()
-    #                state = last_screen.fetch_secondary_identifier()
+            for app in apps:
+                app_limit = -1
 
-                    duration = app_properties['duration']
+                if app in limits:
+                    app_limit = limits[app]
 
-                    if last_usage is None:
-                        last_usage = app_use.created
-                    else:
-                        delta = (app_use.created - last_usage).total_seconds() * 1000
+                on_sum = 0
+                off_sum = 0
 
-                        if delta < duration:
-                            dupe_count += 1
+                dupe_count = 0
 
-                            duration = delta
+                minute_totals = rollups.get((app, date,), {})
 
-                        last_usage = app_use.created
+                for minute in range(0, int((end_date - start_date).total_seconds() // 60)):
+                    totals = minute_totals.get(minute, None)
 
-                    if app_properties['screen_active']:
-                        on_sum += duration
-                    else:
-                        off_sum += duration
+                    if totals is not None:
+                        on_sum += totals[0]
+                        off_sum += totals[1]
+                        dupe_count += totals[2]
 
-                if on_sum > 0:
-                    print('SUM[%s]: %s / %s -- %s -- %s' % (start_date.isoformat(), on_sum, off_sum, (dupe_count * 5000), app_limit))
+                    if batch is False and on_sum > 0:
+                        print('SUM[%s]: %s / %s -- %s -- %s' % ((start_date + datetime.timedelta(seconds=(60 * minute))).isoformat(), on_sum, off_sum, (dupe_count * 5000), app_limit))
 
-                start_date = slice_end
+                if app_limit < 0:
+                    status = 'NO LIMIT SET'
+                elif on_sum <= app_limit:
+                    status = 'OK - DID NOT HIT LIMIT'
+                else:
+                    status = 'ERROR - EXCEEDED LIMIT'
 
-            print('UA: %s' % user_agent)
+                if batch:
+                    print('USAGE[%s][%s]: %s / %s -- %s -- %s -- %s' % (date.isoformat(), app, on_sum, off_sum, (dupe_count * 5000), app_limit, status))
+                else:
+                    tz_point = DataPoint.objects.filter(source_reference=source, created__lte=arrow.get(date.isoformat() + 'T23:59:59+00:00').datetime).order_by('-created').first()
 
-            if app_limit < 0:
-                print('NO LIMIT SET')
-            elif on_sum <= app_limit:
-                print('OK - DID NOT HIT LIMIT')
-            else:
-                print('ERROR - EXCEEDED LIMIT')
+                    print('UA: %s' % tz_point.fetch_user_agent())
+                    print(status)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member,line-too-long
+
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from ...federation import FederationClient
+
+def stub_handler(options):
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_POST(self): # pylint: disable=invalid-name
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            roll = random.random() # nosec
+
+            if roll >= options['hang_rate']:
+                time.sleep(max(0.0, random.gauss(options['latency'], options['jitter']))) # nosec
+
+                if roll < options['hang_rate'] + options['failure_rate']:
+                    self.send_response(503)
+                    self.end_headers()
+
+                    return
+
+            response = {
+                'study_performance_report': {
+                    'group': 'Stub',
+                    'latest_ago': 60,
+                    'today_observed_fraction': 1,
+                },
+            }
+
+            body = json.dumps(response).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+
+            if roll < options['hang_rate']:
+                # Trickles the body a byte at a time, so no single socket read times out.
+
+                for index in range(0, len(body)):
+                    self.wfile.write(body[index:index + 1])
+                    self.wfile.flush()
+
+                    time.sleep(options['hang'] / len(body))
+            else:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+
+    return StubHandler
+
+class Command(BaseCommand):
+    help = 'Runs a local stand-in for a remote study server\'s data-quality endpoint, with simulated latency and failures, and optionally exercises the federation client against it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port',
+                            type=int,
+                            dest='port',
+                            default=8765,
+                            help='Port to listen on (localhost only)')
+
+        parser.add_argument('--latency',
+                            type=float,
+                            dest='latency',
+                            default=0.5,
+                            help='Mean response latency in seconds')
+
+        parser.add_argument('--jitter',
+                            type=float,
+                            dest='jitter',
+                            default=0.25,
+                            help='Standard deviation of the response latency in seconds')
+
+        parser.add_argument('--failure-rate',
+                            type=float,
+                            dest='failure_rate',
+                            default=0.1,
+                            help='Fraction of requests answered with HTTP 503')
+
+        parser.add_argument('--hang-rate',
+                            type=float,
+                            dest='hang_rate',
+                            default=0.05,
+                            help='Fraction of requests that trickle their response over --hang seconds')
+
+        parser.add_argument('--hang',
+                            type=float,
+                            dest='hang',
+                            default=60,
+                            help='Seconds a trickled response takes')
+
+        parser.add_argument('--exercise',
+                            type=int,
+                            dest='exercise',
+                            default=0,
+                            help='Instead of serving until interrupted, fetch this many synthetic reports with the federation client and report the results')
+
+        parser.add_argument('--deadline',
+                            type=float,
+                            dest='deadline',
+                            default=None,
+                            help='Per-request deadline for --exercise (defaults to PD_FEDERATION_DEADLINE)')
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer(('127.0.0.1', options['port']), stub_handler(options))
+        server.daemon_threads = True
+
+        if options['exercise'] <= 0:
+            print('Serving stub data-quality endpoint on http://127.0.0.1:%d/ (Ctrl-C to stop)...' % options['port'])
+
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+
+            return
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        stub = SimpleNamespace(name='stub', source_metadata_url='http://127.0.0.1:%d/' % options['port'], request_key='stub')
+
+        client = FederationClient(deadline=options['deadline'])
+
+        try:
+            start = time.time()
+
+            results = client.fetch_reports([('stub-%d' % index, stub,) for index in range(0, options['exercise'])])
+
+            elapsed = time.time() - start
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+        succeeded = [result for result in results if result.succeeded()]
+
+        errors = {}
+
+        for result in results:
+            if result.succeeded() is False:
+                errors[result.error] = errors.get(result.error, 0) + 1
+
+        print('Fetched %d of %d report(s) in %.2f s (concurrency %d, %d per server, deadline %s s, %d retries).' % (len(succeeded), len(results), elapsed, client.concurrency, client.per_server, client.deadline, client.retries))
+        print('Attempts: %d. Slowest fetch: %.2f s.' % (sum(result.attempts for result in results), max([result.elapsed for result in results] + [0])))
+
+        for error, count in sorted(errors.items()):
+            print('  %s: %d' % (error, count))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member,line-too-long
+
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from passive_data_kit.decorators import handle_lock
+
+from ...models import ExportWatermark, Participant
+
+WATERMARK_GENERATOR = 'study-daily-usage'
+
+class Command(BaseCommand):
+    help = 'Marks cached daily usage dirty for days that received late-arriving points, and recomputes them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days',
+                            type=int,
+                            dest='days',
+                            default=14,
+                            help='How far back to scan for new points for participants without a watermark')
+
+        parser.add_argument('--skip-recompute',
+                            dest='skip_recompute',
+                            action='store_true',
+                            help='Only mark days dirty, leaving recomputation to the next request')
+
+    @handle_lock
+    def handle(self, *args, **options):
+        default_since = timezone.now() - datetime.timedelta(days=options['days'])
+
+        for participant in Participant.objects.all().order_by('identifier'):
+            watermark = ExportWatermark.objects.filter(generator=WATERMARK_GENERATOR, source=participant.identifier, date_type='recorded').first()
+
+            since = default_since
+
+            if watermark is not None:
+                since = watermark.position
+
+            latest_scanned = participant.invalidate_daily_usages(since)
+
+            if latest_scanned is not None:
+                ExportWatermark.objects.update_or_create(generator=WATERMARK_GENERATOR, source=participant.identifier, date_type='recorded', defaults={
+                    'position': latest_scanned,
+                    'updated': timezone.now(),
+                })
+
+            if options['skip_recompute'] is False:
+                dirty_dates = list(participant.daily_usages.filter(package='', dirty=True).order_by('date').values_list('date', flat=True))
+
+                if dirty_dates:
+                    participant.fetch_usage_for_dates(dirty_dates[0], dirty_dates[-1])
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member,line-too-long
+
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from passive_data_kit.decorators import handle_lock
+
+from ...models import ExportWatermark, Participant
+
+WATERMARK_GENERATOR = 'study-hourly-usage'
+
+class Command(BaseCommand):
+    help = 'Brings the hourly usage rollups behind the usage heatmaps up to date, recomputing only days that received new points.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days',
+                            type=int,
+                            dest='days',
+                            default=14,
+                            help='How far back to scan for new points for participants without a watermark')
+
+        parser.add_argument('--participant',
+                            type=str,
+                            dest='participant',
+                            default=None,
+                            help='Only update the participant with this identifier')
+
+    @handle_lock
+    def handle(self, *args, **options):
+        now = timezone.now()
+
+        default_since = now - datetime.timedelta(days=options['days'])
+
+        participants = Participant.objects.all().order_by('identifier')
+
+        if options['participant'] is not None:
+            participants = participants.filter(identifier=options['participant'])
+
+        for participant in participants:
+            watermark = ExportWatermark.objects.filter(generator=WATERMARK_GENERATOR, source=participant.identifier, date_type='recorded').first()
+
+            since = default_since
+
+            if watermark is not None:
+                since = watermark.position
+
+            newest_by_date, latest_scanned = participant.fetch_late_point_dates(since)
+
+            participant.update_hourly_usages(sorted(newest_by_date.keys()))
+
+            if latest_scanned is not None:
+                ExportWatermark.objects.update_or_create(generator=WATERMARK_GENERATOR, source=participant.identifier, date_type='recorded', defaults={
+                    'position': latest_scanned,
+                    'updated': timezone.now(),
+                })
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member,line-too-long
+
+from django.core.management.base import BaseCommand
+
+from passive_data_kit.decorators import handle_lock
+
+from ...models import Participant, TimezoneSpan
+
+class Command(BaseCommand):
+    help = 'Records the time zones each participant\'s device reported over time, used to place local-day boundaries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participant',
+                            type=str,
+                            dest='participant',
+                            default=None,
+                            help='Only update the participant with this identifier')
+
+    @handle_lock
+    def handle(self, *args, **options):
+        identifiers = Participant.objects.all().order_by('identifier').values_list('identifier', flat=True)
+
+        if options['participant'] is not None:
+            identifiers = identifiers.filter(identifier=options['participant'])
+
+        for identifier in identifiers:
+            started = TimezoneSpan.update_for_source(identifier)
+
+            if started > 0:
+                print('%s: %d time zone span(s) started' % (identifier, started))
@@ -2,223 +2,253 @@
 # pylint: disable=no-member, line-too-long
 
 import datetime
-import json
+import threading
+import time
+import traceback
 
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
-import arrow
-import pytz
-import requests
-
-from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.urls import reverse
+from django.db import connection, transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, Q
 from django.utils import timezone
 
-from passive_data_kit.decorators import handle_lock
-from passive_data_kit.models import DataSourceReference, DataGeneratorDefinition, DataPoint, DataSource
+from ...data_quality import CohortMetrics, apply_federated_reports, compile_performance_report, mark_changed_participants, report_sections
+from ...federation import FederationClient
+from ...models import Participant
 
-from ...models import Participant, TreatmentPhase
+class ParticipantQueue: # pylint: disable=too-many-instance-attributes
+    '''
+    Hands out participants whose reports predate the start of the run:
+    participants with new data first, then never updated, then oldest first.
+    Each claim locks the participant's row with SELECT ... FOR UPDATE SKIP
+    LOCKED until its report is saved, so concurrent workers (threads here or
+    other processes) never compile the same participant twice.
+    '''
 
-class Command(BaseCommand):
-    @handle_lock
-    def handle(self, *args, **options): # pylint: disable=too-many-locals, too-many-branches, too-many-statements
-        update_participants = Participant.objects.filter(performance_last_updated=None)
+    def __init__(self, limit, cohorts=None):
+        self.started = timezone.now()
+        self.limit = limit
+
+        if cohorts is None:
+            cohorts = {}
+
+        self.cohorts = cohorts
+
+        self.lock = threading.Lock()
+        self.claimed = 0
+        self.partial = 0
+        self.failed = []
+        self.skipped = []
+
+    def pending(self):
+        return Participant.objects.filter(Q(performance_last_updated=None) | Q(performance_last_updated__lt=self.started))
+
+    def ordered(self, participants):
+        unchanged = ExpressionWrapper(Q(performance_changes=None), output_field=BooleanField())
 
-        if update_participants.count() == 0:
-            update_participants = Participant.objects.all().order_by('performance_last_updated')[:50]
+        return participants.order_by(unchanged.asc(), F('performance_last_updated').asc(nulls_first=True), 'pk')
 
-        for update_participant in update_participants: # pylint: disable=too-many-nested-blocks
-            now = timezone.now()
+    def cohort_for(self, sections):
+        # Cohorts prefetched for the whole report cover partial updates too.
 
-            full_source = DataSource.objects.filter(identifier=update_participant.identifier).first()
+        return self.cohorts.get(sections, self.cohorts.get(None, None))
 
-            metadata = json.loads(update_participant.metadata)
+    def reserve(self):
+        with self.lock:
+            if self.limit is not None and self.claimed >= self.limit:
+                return False
 
-            performance_report = {}
+            self.claimed += 1
 
-            if full_source is not None:
-                if full_source.server is None:
-                    update_participant.fetch_timezone(force_recalculate=True)
-                    update_participant.fetch_last_cost(force_recalculate=True)
+            return True
 
-                    performance_report['group'] = 'Unknown'
+    def prefetch(self):
+        # Prefetches the cohort-level metrics for the participants this run expects to handle,
+        # one cohort per set of report sections, and returns those participants grouped by
+        # sections. Participants claimed outside those sets (e.g. freed by another process) fall
+        # back to their own queries.
 
-                    source = DataSourceReference.reference_for_source(update_participant.identifier)
+        candidates = self.ordered(self.pending())
 
-                    if full_source is not None:
-                        performance_report['group'] = str(full_source.group)
+        if self.limit is not None:
+            candidates = candidates[:self.limit]
 
-                    generator = DataGeneratorDefinition.definition_for_identifier('pdk-foreground-application')
+        candidate_sections = {}
 
-                    today_start = now - datetime.timedelta(days=1)
+        for participant in candidates:
+            candidate_sections.setdefault(report_sections(participant, self.started), []).append(participant)
 
-                    yesterday_start = now - datetime.timedelta(days=2)
+        for sections, participants in candidate_sections.items():
+            self.cohorts[sections] = CohortMetrics(participants, self.started, sections=sections)
 
-                    today_count = float(DataPoint.objects.filter(source_reference=source, generator_definition=generator, created__gte=today_start).count())
-                    performance_report['today_observed_count'] = today_count
+        return candidate_sections
 
-                    yesterday_count = float(DataPoint.objects.filter(source_reference=source, generator_definition=generator, created__gte=yesterday_start, created__lt=today_start).count())
-                    performance_report['yesterday_observed_count'] = yesterday_count
+    def update_federated(self, candidates):
+        # Fetches and saves the reports of the candidates whose reports come from remote study
+        # servers, setting them aside for the workers. Returns the number of federated
+        # participants and the number updated.
 
-                    if today_count == 0:
-                        performance_report['today_observed_fraction'] = 0
-                    elif yesterday_count == 0:
-                        performance_report['today_observed_fraction'] = 1
-                    else:
-                        performance_report['today_observed_fraction'] = float(today_count) / float(yesterday_count)
+        cohort = self.cohort_for(None)
 
-                    performance_report['phase_type'] = None
-                    performance_report['phase_start'] = None
-                    performance_report['phase_budget'] = None
-                    performance_report['phase_budget_overdue'] = False
-                    performance_report['phase_snooze_cost_count'] = 0
-                    performance_report['phase_snooze_cost_overdue'] = False
-                    performance_report['phase_unnecessary_snooze_cost'] = False
-                    performance_report['phase_snoozes'] = 0
-                    performance_report['phase_misc_issues'] = []
+        if cohort is None:
+            return 0, 0
 
-                    latest = DataPoint.objects.filter(source_reference=source, generator_definition=generator).order_by('-created').first()
+        federated = [participant for participant in candidates if cohort.federated_server(participant.identifier) is not None]
 
-                    if latest is not None:
-                        properties = latest.fetch_properties()
+        if not federated:
+            return 0, 0
 
-                        here_tz = pytz.timezone(settings.TIME_ZONE)
+        # The network fan-out (with retries and backoff) runs outside any transaction. Only
+        # saving the results locks the rows, skipping participants another process holds.
 
-                        if 'timezone' in properties['passive-data-metadata']:
-                            here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+        client = FederationClient()
 
-                        performance_report['latest_point'] = latest.created.astimezone(here_tz).isoformat()
-                        performance_report['latest_ago'] = (now - latest.created).total_seconds() # localize to server timezone
+        try:
+            results = client.fetch_reports([(participant.identifier, cohort.federated_server(participant.identifier),) for participant in federated])
+        finally:
+            client.close()
 
-                        if performance_report['latest_ago'] > 24 * 60 * 60:
-                            update_participant.send_relaunch_email()
+        with transaction.atomic():
+            locked = list(Participant.objects.filter(pk__in=[participant.pk for participant in federated]).select_for_update(skip_locked=True))
 
-                        # Phone Dashboard/33 Passive Data Kit/1.0 (Android 9 SDK 28; samsung SM-G973U)
+            locked_identifiers = set(participant.identifier for participant in locked)
 
-                        if latest.user_agent is not None and 'Phone Dashboard' in latest.user_agent:
-                            tokens = latest.user_agent.split(' ')
+            updated = apply_federated_reports(locked, [result for result in results if result.identifier in locked_identifiers], timezone.now())
 
-                            performance_report['app_version'] = ' '.join(tokens[:2])
-                            performance_report['platform_version'] = ' '.join(tokens[5:9]).replace('(', '').replace(';', '')
-                            performance_report['device_model'] = ' '.join(tokens[9:]).replace(')', '')
-                    else:
-                        latest = DataPoint.objects.filter(source_reference=source).order_by('-created').first()
+        self.skipped.extend([participant.pk for participant in federated])
 
-                        if latest is not None:
-                            performance_report['latest_point'] = latest.created.isoformat()
-                            performance_report['latest_ago'] = (now - latest.created).total_seconds() # localize to server timezone
+        # Federated participants count against --limit like the ones the workers update.
 
-                            if performance_report['latest_ago'] > 24 * 60 * 60:
-                                update_participant.send_relaunch_email()
+        if self.limit is not None:
+            self.limit = max(self.limit - len(federated), 0)
 
-                    current_phase = TreatmentPhase.objects.filter(participant=update_participant, start_date__lte=now.date(), treatment_active=True).order_by('-start_date').first()
+        return len(federated), updated
 
-                    if current_phase is not None:
-                        generator = DataGeneratorDefinition.definition_for_identifier('daily-app-budget')
+    def process_next(self):
+        # Returns True after handling a participant (successfully or not), or False when the
+        # queue is drained or the limit is reached.
 
-                        performance_report['phase_type'] = current_phase.blocker_type
-                        performance_report['phase_start'] = current_phase.start_date.isoformat()
+        if self.reserve() is False:
+            return False
 
-                        latest_budget = DataPoint.objects.filter(source_reference=source, generator_definition=generator, created__date__gte=current_phase.start_date).order_by('-created').first()
+        with self.lock:
+            excluded = self.failed + self.skipped
 
-                        if latest_budget is not None:
-                            budget = json.loads(latest_budget.fetch_properties()['budget'])
+        participant = None
 
-                            if budget:
-                                performance_report['phase_budget'] = budget
-                        elif (now.date() - current_phase.start_date).days > 0:
-                            performance_report['phase_budget_overdue'] = True
+        try:
+            with transaction.atomic():
+                participant = self.ordered(self.pending().exclude(pk__in=excluded)).select_for_update(skip_locked=True).first()
 
-                        if current_phase.blocker_type == 'costly_snooze':
-                            generator = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+                if participant is None:
+                    return False
 
-                            snooze_costs = DataPoint.objects.filter(source_reference=source, generator_definition=generator, secondary_identifier='set-snooze-cost', created__date__gte=current_phase.start_date).order_by('-created')
+                now = timezone.now()
 
-                            performance_report['phase_snooze_cost_count'] = snooze_costs.count()
+                sections = report_sections(participant, now)
 
-                            snooze_cost = snooze_costs.first()
+                performance_report = compile_performance_report(participant, now, cohort=self.cohort_for(sections), sections=sections)
 
-                            if snooze_cost is None and (now.date() - current_phase.start_date).days > 0:
-                                performance_report['phase_snooze_cost_overdue'] = True
-                        else:
-                            generator = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+                participant.update_performance_report(performance_report, now)
 
-                            snooze_costs = DataPoint.objects.filter(source_reference=source, generator_definition=generator, secondary_identifier='set-snooze-cost', created__date__gte=current_phase.start_date).order_by('-created')
+                if sections is not None:
+                    with self.lock:
+                        self.partial += 1
+        except: # pylint: disable=bare-except
+            traceback.print_exc()
 
-                            performance_report['phase_snooze_cost_count'] = snooze_costs.count()
+            if participant is None:
+                # Nothing was claimed (e.g. the queue query itself failed), so stop this worker
+                # instead of retrying the same failure.
 
-                            snooze_cost = snooze_costs.first()
+                return False
 
-                            if snooze_cost is None and (now.date() - current_phase.start_date).days > 0:
-                                performance_report['phase_unnecessary_snooze_cost'] = True
+            with self.lock:
+                self.failed.append(participant.pk)
 
-                        generator = DataGeneratorDefinition.definition_for_identifier('app-snooze')
+        return True
 
-                        performance_report['phase_snoozes'] = DataPoint.objects.filter(source_reference=source, generator_definition=generator, created__date__gte=current_phase.start_date).count()
+    def drain(self, workers):
+        # Processes the queue with the given number of worker threads, returning the number of
+        # participants each handled.
 
-                        if performance_report['phase_snoozes'] > 0:
-                            if performance_report['phase_budget'] is None or len(performance_report['phase_budget']) == 0: # pylint: disable=len-as-condition
-                                performance_report['phase_misc_issues'].append('Recorded ' + str(performance_report['phase_snoozes']) + ' snooze(s) without corresponding limits being set.')
+        handled = [0] * workers
+
+        def drain_worker(worker):
+            try:
+                while self.process_next():
+                    handled[worker] += 1
+            finally:
+                connection.close() # Each thread uses its own database connection.
+
+        if workers == 1:
+            drain_worker(0)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for worker in range(0, workers):
+                    executor.submit(drain_worker, worker)
+
+        return handled
+
+
+class Command(BaseCommand):
+    help = 'Compiles participant data-quality reports, stalest first.'
 
-                        event_generator = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+    def add_arguments(self, parser):
+        parser.add_argument('--workers',
+                            type=int,
+                            dest='workers',
+                            default=1,
+                            help='Number of worker threads compiling reports concurrently')
 
-                        use_summary = DataPoint.objects.filter(source_reference=source, generator_definition=event_generator, secondary_identifier='app-usage-summary', created__date__gte=current_phase.start_date).order_by('-created').first()
+        parser.add_argument('--limit',
+                            type=int,
+                            dest='limit',
+                            default=50,
+                            help='Maximum number of participants to update in this run (0 for no limit)')
 
-                        if use_summary is not None:
-                            details = use_summary.fetch_properties()
+        parser.add_argument('--changes-since',
+                            type=int,
+                            dest='changes_since',
+                            default=24,
+                            help='How many hours back to scan for new data points on the first run, before a watermark is stored')
 
-                            if 'day' in details['event_details'] and 'blocks' in details['event_details'] and update_participant.timezone is not None:
-                                report_now = arrow.Arrow.utcfromtimestamp(details['observed'] / 1000)
+    def handle(self, *args, **options):
+        limit = options['limit']
 
-                                today_start = report_now.to(update_participant.timezone).replace(hour=0, minute=0, second=0).datetime
-                                today_end = today_start + datetime.timedelta(days=1)
+        if limit <= 0:
+            limit = None
 
-                                if performance_report['phase_budget'] is not None:
-                                    for app in budget.keys():
-                                        if app in details['event_details']['day']:
-                                            if details['event_details']['day'][app]['usage_ms'] > budget[app]:
-                                                found_block = False
+        start = time.time()
 
-                                                for block_ts in details['event_details']['blocks'].keys():
-                                                    block_when = arrow.get(block_ts).datetime
+        # Record which participants received new data since the previous run (and which report
+        # sections it affects), so they are handled first and only those sections recomputed.
+        # Runs in several processes at once are safe: marking is serialized on its watermark row,
+        # and each participant is claimed by a single worker.
 
-                                                    if block_when >= today_start and block_when < today_end: # pylint: disable=chained-comparison
-                                                        if details['event_details']['blocks'][block_ts]['app'] == app:
-                                                            found_block = True
+        marked = mark_changed_participants(timezone.now() - datetime.timedelta(hours=options['changes_since']))
 
-                                                if found_block is False:
-                                                    issue = 'Missing block for app "' + app + '" on ' + today_start.date().isoformat() + ' (' + str(update_participant.identifier) + ').'
+        queue = ParticipantQueue(limit)
 
-                                                    performance_report['phase_misc_issues'].append(issue)
+        candidate_sections = queue.prefetch()
 
-                elif full_source.server.source_metadata_url is not None:
-                    components = urlparse.urlsplit(full_source.server.source_metadata_url)
+        # Reports held by remote study servers are fetched concurrently and saved together,
+        # instead of one blocking request per participant in the worker loop.
 
-                    url = urlparse.urlunsplit([components.scheme, components.netloc, reverse('fetch_participant_data_quality'), '', ''])
+        federated, federated_updated = queue.update_federated(candidate_sections.get(None, []))
 
-                    payload = {
-                        'identifier': update_participant.identifier,
-                        'request-key': full_source.server.request_key
-                    }
+        workers = max(options['workers'], 1)
 
-                    identifier_post = requests.post(url, data=payload, timeout=300)
+        handled = queue.drain(workers)
 
-                    if identifier_post.status_code >= 200 and identifier_post.status_code < 300:
-                        response = identifier_post.json()
+        elapsed = time.time() - start
 
-                        if 'study_performance_report' in response:
-                            performance_report = response['study_performance_report']
+        updated = sum(handled) - len(queue.failed) + federated_updated
 
-                            if performance_report['latest_ago'] > 24 * 60 * 60:
-                                update_participant.send_relaunch_email()
-                        else:
-                            print('Unable to find metadata for %s: %s' % (update_participant.identifier, json.dumps(response, indent=2)))
-                    else:
-                        print('Server code %s received for request for %s metadata from %s' % (identifier_post.status_code, full_source.identifier, full_source.server.source_metadata_url))
+        rate = 0.0
 
-            metadata['study_performance_report'] = performance_report
+        if elapsed > 0:
+            rate = updated / elapsed
 
-            update_participant.metadata = json.dumps(metadata, indent=2)
-            update_participant.performance_last_updated = now
-            update_participant.save()
+        print('Updated %d participant report(s) (%d in part) in %.1f s (%.2f per second) with %d worker(s) [%s] and %d of %d federated fetch(es). Participants with new data: %d. Failed: %d. Stale reports remaining: %d.' % (updated, queue.partial, elapsed, rate, workers, ', '.join(str(count) for count in handled), federated_updated, federated, marked, len(queue.failed), queue.pending().count()))
@@ -0,0 +1,28 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0025_auto_20231010_1808'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generator', models.CharField(db_index=True, max_length=128)),
+                ('source', models.CharField(db_index=True, max_length=1024)),
+                ('date_type', models.CharField(default='recorded', max_length=32)),
+                ('position', models.DateTimeField()),
+                ('updated', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('generator', 'source', 'date_type')},
+            },
+        ),
+    ]
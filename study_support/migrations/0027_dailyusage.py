@@ -0,0 +1,87 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 12:30
+
+import datetime
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def backfill_daily_usages(apps, schema_editor):
+    Participant = apps.get_model('study_support', 'Participant')
+    DailyUsage = apps.get_model('study_support', 'DailyUsage')
+
+    now = timezone.now()
+
+    for participant in Participant.objects.filter(metadata__contains='daily_usages').iterator():
+        try:
+            metadata = json.loads(participant.metadata)
+        except ValueError:
+            continue
+
+        daily_usages = metadata.pop('daily_usages', {})
+
+        usages = []
+
+        for key, usage in daily_usages.items():
+            try:
+                date = datetime.date.fromisoformat(key)
+            except ValueError:
+                continue
+
+            usages.append(DailyUsage(participant=participant, date=date, package='', usage_ms=usage, computed=now))
+
+        DailyUsage.objects.bulk_create(usages, batch_size=1000, ignore_conflicts=True)
+
+        participant.metadata = json.dumps(metadata, indent=2)
+        participant.save(update_fields=['metadata'])
+
+
+def restore_daily_usages(apps, schema_editor):
+    Participant = apps.get_model('study_support', 'Participant')
+    DailyUsage = apps.get_model('study_support', 'DailyUsage')
+
+    for participant in Participant.objects.all().iterator():
+        usages = DailyUsage.objects.filter(participant=participant, package='').order_by('date')
+
+        if usages.exists():
+            metadata = json.loads(participant.metadata)
+
+            metadata['daily_usages'] = {}
+
+            for usage in usages:
+                metadata['daily_usages'][usage.date.isoformat()] = usage.usage_ms
+
+            participant.metadata = json.dumps(metadata, indent=2)
+            participant.save(update_fields=['metadata'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0026_exportwatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('package', models.CharField(blank=True, default='', max_length=512)),
+                ('usage_ms', models.FloatField(default=0)),
+                ('computed', models.DateTimeField()),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_usages', to='study_support.participant')),
+            ],
+            options={
+                'unique_together': {('participant', 'date', 'package')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dailyusage',
+            index=models.Index(fields=['participant', 'package', 'date'], name='study_dailyusage_lookup_idx'),
+        ),
+        migrations.RunPython(backfill_daily_usages, restore_daily_usages),
+    ]
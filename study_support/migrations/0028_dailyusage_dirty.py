@@ -0,0 +1,24 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0027_dailyusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailyusage',
+            name='dirty',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='dailyusage',
+            name='latest_recorded',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
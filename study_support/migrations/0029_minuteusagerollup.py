@@ -0,0 +1,35 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0028_dailyusage_dirty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MinuteUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=1024)),
+                ('package', models.CharField(max_length=512)),
+                ('date', models.DateField(db_index=True)),
+                ('time_zone', models.CharField(max_length=128)),
+                ('minutes', models.TextField(default='{}', max_length=1048576)),
+                ('computed', models.DateTimeField()),
+                ('latest_recorded', models.DateTimeField(blank=True, null=True)),
+                ('dirty', models.BooleanField(db_index=True, default=False)),
+            ],
+            options={
+                'unique_together': {('source', 'package', 'date')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='minuteusagerollup',
+            index=models.Index(fields=['source', 'date', 'package'], name='study_minuterollup_lookup_idx'),
+        ),
+    ]
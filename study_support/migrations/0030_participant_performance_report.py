@@ -0,0 +1,52 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 14:30
+
+import json
+
+from django.db import migrations, models
+
+
+def split_performance_reports(apps, schema_editor):
+    Participant = apps.get_model('study_support', 'Participant')
+
+    for participant in Participant.objects.all().iterator():
+        try:
+            metadata = json.loads(participant.metadata)
+        except ValueError:
+            continue
+
+        report = metadata.pop('study_performance_report', None)
+
+        if report is not None:
+            participant.performance_report = json.dumps(report, separators=(',', ':'))
+
+        participant.metadata = json.dumps(metadata, separators=(',', ':'))
+        participant.save(update_fields=['metadata', 'performance_report'])
+
+
+def merge_performance_reports(apps, schema_editor):
+    Participant = apps.get_model('study_support', 'Participant')
+
+    for participant in Participant.objects.exclude(performance_report=None).iterator():
+        metadata = json.loads(participant.metadata)
+
+        metadata['study_performance_report'] = json.loads(participant.performance_report)
+
+        participant.metadata = json.dumps(metadata, indent=2)
+        participant.save(update_fields=['metadata'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0029_minuteusagerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='performance_report',
+            field=models.TextField(blank=True, max_length=1048576, null=True),
+        ),
+        migrations.RunPython(split_performance_reports, merge_performance_reports),
+    ]
@@ -0,0 +1,35 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 15:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0030_participant_performance_report'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('weekday', models.SmallIntegerField()),
+                ('hour', models.SmallIntegerField()),
+                ('usage_ms', models.FloatField(default=0)),
+                ('computed', models.DateTimeField(db_index=True)),
+                ('latest_recorded', models.DateTimeField(blank=True, null=True)),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_usages', to='study_support.participant')),
+            ],
+            options={
+                'unique_together': {('participant', 'date', 'hour')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='hourlyusagerollup',
+            index=models.Index(fields=['participant', 'date'], name='study_hourlyusage_lookup_idx'),
+        ),
+    ]
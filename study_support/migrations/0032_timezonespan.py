@@ -0,0 +1,27 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0031_hourlyusagerollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimezoneSpan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(db_index=True, max_length=1024)),
+                ('time_zone', models.CharField(max_length=128)),
+                ('start', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('source', 'start')},
+            },
+        ),
+    ]
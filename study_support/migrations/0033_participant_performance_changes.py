@@ -0,0 +1,19 @@
+# pylint: skip-file
+# Generated by Django 3.2.22 on 2026-10-17 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study_support', '0032_timezonespan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='performance_changes',
+            field=models.CharField(blank=True, max_length=256, null=True),
+        ),
+    ]
@@ -6,15 +6,18 @@ import datetime
 import hashlib
 import json
 
-import arrow
-
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
-from django.db import models
+from django.db import models, transaction
 from django.template.loader import render_to_string
 from django.utils import timezone
 
-from passive_data_kit.models import DataPoint, DataGeneratorDefinition, DataSourceReference, DataSource, DataServer
+from passive_data_kit.models import DataPoint, DataGeneratorDefinition, DataSourceReference, DataSource, DataServer, install_supports_jsonfield
+
+from .local_days import LocalDayIndex
+from .point_streams import export_batch_size, stream_points
+
+from .screen_time import ForegroundSamples, from_microseconds, hourly_screen_time, latest_recorded_by_day, screen_time_by_day, to_microseconds
 
 BLOCKER_TYPES = (
     ('none', 'No Blocker',),
@@ -24,7 +27,9 @@ BLOCKER_TYPES = (
     ('no_snooze', 'No Snooze',),
 )
 
-class Participant(models.Model):
+TIMEZONE_SPAN_WATERMARK_GENERATOR = 'study-timezone-spans'
+
+class Participant(models.Model): # pylint: disable=too-many-instance-attributes, too-many-public-methods
     email_address = models.EmailField(unique=True, db_index=True)
 
     identifier = models.CharField(max_length=1024, unique=True, db_index=True)
@@ -34,7 +39,10 @@ class Participant(models.Model):
 
     email_enabled = models.BooleanField(default=True)
 
-    metadata = models.TextField(max_length=1048576, default='{}')
+    metadata = models.TextField(max_length=1048576, default='{}') # Compact JSON for sections without their own column
+
+    performance_report = models.TextField(max_length=1048576, null=True, blank=True) # JSON written by update_participant_data_quality
+    performance_changes = models.CharField(max_length=256, null=True, blank=True) # Comma-separated report sections with new data since the report was written
 
     last_reminder_sent = models.DateTimeField(null=True, blank=True)
 
@@ -84,6 +92,52 @@ class Participant(models.Model):
 
         return sha256.hexdigest()
 
+    def fetch_performance_report(self, default=None):
+        if self.performance_report is None or self.performance_report == '':
+            return default
+
+        return json.loads(self.performance_report)
+
+    def update_performance_report(self, report, updated=None):
+        # Writes only the report columns, leaving the rest of the row untouched.
+
+        if updated is None:
+            updated = timezone.now()
+
+        self.performance_report = json.dumps(report, separators=(',', ':'))
+        self.performance_last_updated = updated
+        self.performance_changes = None
+
+        self.save(update_fields=['performance_report', 'performance_last_updated', 'performance_changes'])
+
+    def fetch_performance_changes(self):
+        if self.performance_changes is None or self.performance_changes == '':
+            return []
+
+        return self.performance_changes.split(',')
+
+    def fetch_metadata_section(self, section, default=None):
+        return json.loads(self.metadata).get(section, default)
+
+    def update_metadata_section(self, section, value):
+        # Reloads the metadata column before writing so concurrent updates to other sections are kept.
+
+        current = Participant.objects.filter(pk=self.pk).values_list('metadata', flat=True).first()
+
+        metadata = {}
+
+        if current:
+            metadata = json.loads(current)
+
+        if value is None:
+            metadata.pop(section, None)
+        else:
+            metadata[section] = value
+
+        self.metadata = json.dumps(metadata, separators=(',', ':'))
+
+        self.save(update_fields=['metadata'])
+
     def fetch_timezone(self, force_recalculate=False):
         if force_recalculate is False and self.timezone is not None and self.timezone != '':
             return self.timezone
@@ -105,6 +159,9 @@ class Participant(models.Model):
 
         return self.timezone
 
+    def local_days(self):
+        return TimezoneSpan.index_for(self.identifier, default_zone=self.timezone)
+
     def fetch_last_cost(self, force_recalculate=False):
         if force_recalculate is False and self.last_cost is not None:
             if self.last_cost < 0:
@@ -236,57 +293,187 @@ class Participant(models.Model):
 
                 DataPoint.objects.create_data_point('nyu-relaunch-email', 'update-participant-script', payload)
 
-    def fetch_usage_for_date(self, date):
-        metadata = json.loads(self.metadata)
+    def compute_usage_for_dates(self, dates):
+        # Computes several days from one streamed query over the whole range, splitting the
+        # points on each local midnight. Returns the usage, latest recorded time, and whether
+        # the day is still open for each date.
 
-        key = date.isoformat()
+        usages = {}
+        latest_recorded = {}
+        open_dates = set()
 
-        daily_usage = None
+        for date in dates:
+            usages[date] = 0
+            latest_recorded[date] = None
 
-        if ('daily_usages' in metadata) is False:
-            metadata['daily_usages'] = {}
-        elif key in metadata['daily_usages']:
-            daily_usage = metadata['daily_usages'][key]
+        if not dates:
+            return usages, latest_recorded, open_dates
 
-        if daily_usage is None: # pylint: disable=too-many-nested-blocks
-            generator_definition = DataGeneratorDefinition.objects.filter(generator_identifier='pdk-foreground-application').first()
-            source_reference = DataSourceReference.objects.filter(source=self.identifier).first()
+        bounds = self.local_days().day_bounds(sorted(dates))
 
-            if (generator_definition is not None) and (source_reference is not None):
-                duration = 0
+        # Days still in progress stay open with or without points, so points arriving later
+        # in the day are always picked up.
 
-                if DataPoint.objects.filter(generator_definition=generator_definition, source_reference=source_reference).count() > 0:
-                    here_tz = self.fetch_timezone()
+        now = to_microseconds(timezone.now())
 
-                    start = arrow.get(datetime.datetime(date.year, date.month, date.day, 0, 0, 0, 0), here_tz)
-                    end = start.shift(days=1)
+        for date, start, end in bounds: # pylint: disable=unused-variable
+            if end > now:
+                open_dates.add(date)
 
-                    points = DataPoint.objects.filter(generator_definition=generator_definition, source_reference=source_reference, created__gte=start.datetime, created__lt=end.datetime).order_by('created')
+        generator_definition = DataGeneratorDefinition.objects.filter(generator_identifier='pdk-foreground-application').first()
+        source_reference = DataSourceReference.objects.filter(source=self.identifier).first()
 
-                    last_seen = None
+        if (generator_definition is not None) and (source_reference is not None):
+            points = DataPoint.objects.filter(generator_definition=generator_definition, source_reference=source_reference, created__gte=from_microseconds(bounds[0][1]), created__lt=from_microseconds(bounds[-1][2]))
 
-                    for point in points:
-                        payload = point.fetch_properties()
+            samples = ForegroundSamples.from_points(points)
 
-                        if ('duration' in payload) and ('screen_active' in payload) and payload['screen_active']:
-                            if last_seen is None:
-                                duration += payload['duration']
-                            elif (point.created - last_seen).total_seconds() * 1000 < payload['duration']:
-                                duration += (point.created - last_seen).total_seconds() * 1000
-                            else:
-                                duration += payload['duration']
+            usages.update(screen_time_by_day(samples, bounds))
+            latest_recorded.update(latest_recorded_by_day(samples, bounds))
 
+        return usages, latest_recorded, open_dates
 
-                        last_seen = point.created
+    def fetch_usage_for_date(self, date):
+        return self.fetch_usage_for_dates(date, date)[date]
+
+    def fetch_usage_for_dates(self, start_date, end_date):
+        usages = {}
+        dirty_usages = {}
 
-                metadata['daily_usages'][key] = duration
+        for daily_usage in self.daily_usages.filter(package='', date__gte=start_date, date__lte=end_date):
+            if daily_usage.dirty:
+                dirty_usages[daily_usage.date] = daily_usage
             else:
-                metadata['daily_usages'][key] = 0
+                usages[daily_usage.date] = daily_usage.usage_ms
+
+        stale_dates = []
+
+        index_date = start_date
+
+        while index_date <= end_date:
+            if (index_date in usages) is False:
+                stale_dates.append(index_date)
+
+            index_date = index_date + datetime.timedelta(days=1)
+
+        if stale_dates:
+            computed_usages, latest_recorded, open_dates = self.compute_usage_for_dates(stale_dates)
+
+            now = timezone.now()
+
+            new_usages = []
+
+            for date, usage in computed_usages.items():
+                daily_usage = dirty_usages.get(date, None)
+
+                if daily_usage is None:
+                    daily_usage = DailyUsage(participant=self, date=date, package='')
+
+                    new_usages.append(daily_usage)
+
+                daily_usage.usage_ms = usage
+                daily_usage.latest_recorded = latest_recorded[date]
+                daily_usage.computed = now
+                daily_usage.dirty = date in open_dates # Days still in progress are recomputed on every request.
+
+            DailyUsage.objects.bulk_update(list(dirty_usages.values()), ['usage_ms', 'latest_recorded', 'computed', 'dirty'])
+            DailyUsage.objects.bulk_create(new_usages, ignore_conflicts=True)
+
+            usages.update(computed_usages)
+
+        return usages
+
+    def fetch_late_point_dates(self, since):
+        # Returns the newest recorded time of the foreground points recorded after `since`,
+        # keyed by the local date they were created on, and the latest recorded time scanned.
+
+        newest_by_date = {}
+        latest_scanned = None
+
+        generator_definition = DataGeneratorDefinition.objects.filter(generator_identifier='pdk-foreground-application').first()
+        source_reference = DataSourceReference.objects.filter(source=self.identifier).first()
+
+        if (generator_definition is None) or (source_reference is None):
+            return newest_by_date, latest_scanned
+
+        local_days = self.local_days()
+
+        points = DataPoint.objects.filter(generator_definition=generator_definition, source_reference=source_reference, recorded__gt=since)
+
+        for created, recorded in points.values_list('created', 'recorded').iterator():
+            date = local_days.date_for(created)
+
+            if (date in newest_by_date) is False or newest_by_date[date] < recorded:
+                newest_by_date[date] = recorded
+
+            if latest_scanned is None or latest_scanned < recorded:
+                latest_scanned = recorded
+
+        return newest_by_date, latest_scanned
+
+    def update_hourly_usages(self, dates):
+        # Recomputes the hourly rollups for the given local dates from one streamed query. Every
+        # day is stored as 24 rows (zero when idle), so row counts double as day counts.
+
+        if not dates:
+            return
+
+        generator_definition = DataGeneratorDefinition.objects.filter(generator_identifier='pdk-foreground-application').first()
+        source_reference = DataSourceReference.objects.filter(source=self.identifier).first()
+
+        local_days = self.local_days()
+
+        bounds = local_days.day_bounds(sorted(dates))
+
+        hourly = dict((date, [0.0] * 24,) for date, start, end in bounds)
+
+        latest_recorded = {}
+
+        if (generator_definition is not None) and (source_reference is not None):
+            samples = ForegroundSamples.from_points(DataPoint.objects.filter(generator_definition=generator_definition, source_reference=source_reference, created__gte=from_microseconds(bounds[0][1]), created__lt=from_microseconds(bounds[-1][2])))
+
+            latest_recorded = latest_recorded_by_day(samples, bounds)
+
+            hourly = hourly_screen_time(samples, bounds, local_days)
+
+        now = timezone.now()
+
+        rollups = []
+
+        for date, hours in hourly.items():
+            for hour, usage in enumerate(hours):
+                rollups.append(HourlyUsageRollup(participant=self, date=date, weekday=date.weekday(), hour=hour, usage_ms=usage, computed=now, latest_recorded=latest_recorded.get(date, None)))
 
-            self.metadata = json.dumps(metadata, indent=2)
-            self.save()
+        with transaction.atomic():
+            self.hourly_usages.filter(date__in=list(hourly.keys())).delete()
 
-        return metadata['daily_usages'][key]
+            HourlyUsageRollup.objects.bulk_create(rollups, batch_size=1000)
+
+    def invalidate_daily_usages(self, since):
+        # Marks cached days dirty when foreground points recorded after `since` belong to them
+        # and are newer than the latest recorded time the cached value saw. Returns the latest
+        # recorded time scanned, or None if there were no new points.
+
+        newest_by_date, latest_scanned = self.fetch_late_point_dates(since)
+
+        if newest_by_date:
+            dirty_ids = []
+
+            for daily_usage in self.daily_usages.filter(dirty=False, date__in=list(newest_by_date.keys())):
+                if daily_usage.latest_recorded is None or daily_usage.latest_recorded < newest_by_date[daily_usage.date]:
+                    dirty_ids.append(daily_usage.pk)
+
+            DailyUsage.objects.filter(pk__in=dirty_ids).update(dirty=True)
+
+            dirty_ids = []
+
+            for rollup in MinuteUsageRollup.objects.filter(source=self.identifier, dirty=False, date__in=list(newest_by_date.keys())):
+                if rollup.latest_recorded is None or rollup.latest_recorded < newest_by_date[rollup.date]:
+                    dirty_ids.append(rollup.pk)
+
+            MinuteUsageRollup.objects.filter(pk__in=dirty_ids).update(dirty=True)
+
+        return latest_scanned
 
 class TreatmentPhase(models.Model):
     participant = models.ForeignKey(Participant, related_name='phases', on_delete=models.CASCADE)
@@ -314,6 +501,158 @@ class TreatmentPhase(models.Model):
     def identifier(self):
         return self.participant.identifier
 
+class DailyUsage(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods, old-style-class, no-init
+        unique_together = ('participant', 'date', 'package',)
+        indexes = [
+            models.Index(fields=['participant', 'package', 'date'], name='study_dailyusage_lookup_idx'),
+        ]
+
+    participant = models.ForeignKey(Participant, related_name='daily_usages', on_delete=models.CASCADE)
+
+    date = models.DateField(db_index=True)
+    package = models.CharField(max_length=512, default='', blank=True) # Empty for all apps combined
+
+    usage_ms = models.FloatField(default=0)
+    computed = models.DateTimeField()
+
+    latest_recorded = models.DateTimeField(null=True, blank=True)
+    dirty = models.BooleanField(default=False, db_index=True)
+
+class HourlyUsageRollup(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods, old-style-class, no-init
+        unique_together = ('participant', 'date', 'hour',)
+        indexes = [
+            models.Index(fields=['participant', 'date'], name='study_hourlyusage_lookup_idx'),
+        ]
+
+    participant = models.ForeignKey(Participant, related_name='hourly_usages', on_delete=models.CASCADE)
+
+    date = models.DateField(db_index=True) # Local to the participant
+    weekday = models.SmallIntegerField() # Monday is 0
+    hour = models.SmallIntegerField()
+
+    usage_ms = models.FloatField(default=0)
+
+    computed = models.DateTimeField(db_index=True)
+    latest_recorded = models.DateTimeField(null=True, blank=True)
+
+class MinuteUsageRollup(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods, old-style-class, no-init
+        unique_together = ('source', 'package', 'date',)
+        indexes = [
+            models.Index(fields=['source', 'date', 'package'], name='study_minuterollup_lookup_idx'),
+        ]
+
+    source = models.CharField(max_length=1024)
+    package = models.CharField(max_length=512)
+    date = models.DateField(db_index=True)
+    time_zone = models.CharField(max_length=128)
+
+    # JSON object keyed by minute of the local day, holding [screen-on ms, screen-off ms, trimmed samples].
+    # Minutes without samples are omitted.
+
+    minutes = models.TextField(max_length=(1024 * 1024), default='{}') # pylint: disable=superfluous-parens
+
+    computed = models.DateTimeField()
+    latest_recorded = models.DateTimeField(null=True, blank=True)
+    dirty = models.BooleanField(default=False, db_index=True)
+
+    def minute_totals(self):
+        totals = {}
+
+        for minute, values in json.loads(self.minutes).items():
+            totals[int(minute)] = values
+
+        return totals
+
+class TimezoneSpan(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods, old-style-class, no-init
+        unique_together = ('source', 'start',)
+
+    source = models.CharField(max_length=1024, db_index=True)
+    time_zone = models.CharField(max_length=128)
+
+    start = models.DateTimeField() # Created time of the first point reporting this zone
+    last_seen = models.DateTimeField() # Created time of the latest point in this zone before the next span
+
+    @classmethod
+    def index_for(cls, source, default_zone=None):
+        spans = cls.objects.filter(source=source).order_by('start').values_list('start', 'time_zone')
+
+        return LocalDayIndex(list(spans), default_zone=default_zone)
+
+    @classmethod
+    def update_for_source(cls, source): # pylint: disable=too-many-locals
+        # Merges the zones reported in passive-data-metadata by points recorded since the last
+        # run into the source's spans. Late uploads can be created before points already scanned,
+        # so every point created from the earliest new one onwards is rescanned and the spans
+        # starting there are rebuilt; earlier spans only depend on points already seen. Returns
+        # the number of spans added.
+
+        source_reference = DataSourceReference.objects.filter(source=source).first()
+
+        if source_reference is None:
+            return 0
+
+        points = DataPoint.objects.filter(source_reference=source_reference)
+
+        watermark = ExportWatermark.objects.filter(generator=TIMEZONE_SPAN_WATERMARK_GENERATOR, source=source, date_type='recorded').first()
+
+        new_points = points
+
+        if watermark is not None:
+            new_points = points.filter(recorded__gt=watermark.position)
+
+        state = new_points.aggregate(earliest=models.Min('created'), latest=models.Max('recorded'))
+
+        if state['earliest'] is None:
+            return 0
+
+        rescanned = points.filter(created__gte=state['earliest'])
+
+        if install_supports_jsonfield():
+            rows = rescanned.order_by('created', 'pk').values_list('created', 'properties__passive-data-metadata__timezone').iterator(chunk_size=export_batch_size())
+        else:
+            rows = ((point.created, point.fetch_properties().get('passive-data-metadata', {}).get('timezone', None),) for point in stream_points(rescanned))
+
+        with transaction.atomic():
+            current = cls.objects.filter(source=source, start__lt=state['earliest']).order_by('-start').first()
+
+            existing = current
+
+            if existing is not None and existing.last_seen >= state['earliest']:
+                # The rescan goes back into this span, so it only keeps the points before the rescan.
+
+                existing.last_seen = points.filter(created__gte=existing.start, created__lt=state['earliest']).aggregate(last_seen=models.Max('created'))['last_seen']
+
+            removed = cls.objects.filter(source=source, start__gte=state['earliest']).delete()[0]
+
+            new_spans = []
+
+            for created, time_zone in rows:
+                if time_zone is None or time_zone == '':
+                    continue
+
+                if current is None or current.time_zone != time_zone:
+                    current = TimezoneSpan(source=source, time_zone=time_zone, start=created, last_seen=created)
+
+                    new_spans.append(current)
+                else:
+                    current.last_seen = created
+
+            if existing is not None:
+                existing.save(update_fields=['last_seen'])
+
+            cls.objects.bulk_create(new_spans, batch_size=1000)
+
+            ExportWatermark.objects.update_or_create(generator=TIMEZONE_SPAN_WATERMARK_GENERATOR, source=source, date_type='recorded', defaults={
+                'position': state['latest'],
+                'updated': timezone.now(),
+            })
+
+        return len(new_spans) - removed
+
 class AppVersion(models.Model):
     added = models.DateTimeField()
 
@@ -347,3 +686,15 @@ class AppPackageInfo(models.Model):
     replacement_package = models.CharField(max_length=512, null=True, blank=True)
 
     sort_order = models.IntegerField(default=100)
+
+
+class ExportWatermark(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods, old-style-class, no-init
+        unique_together = ('generator', 'source', 'date_type',)
+
+    generator = models.CharField(max_length=128, db_index=True)
+    source = models.CharField(max_length=1024, db_index=True)
+    date_type = models.CharField(max_length=32, default='recorded')
+
+    position = models.DateTimeField()
+    updated = models.DateTimeField()
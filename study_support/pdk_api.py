@@ -15,6 +15,7 @@ import traceback
 from zipfile import ZipFile
 
 import arrow
+import numpy
 import pytz
 
 from django.conf import settings
@@ -24,12 +25,36 @@ from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.text import slugify
 
-from passive_data_kit.generators.pdk_foreground_application import fetch_app_genre
-from passive_data_kit.models import DataPoint, DataSource, DataGeneratorDefinition, DataSourceReference, DataBundle, install_supports_jsonfield
+from passive_data_kit.models import DataPoint, DataGeneratorDefinition, DataBundle, install_supports_jsonfield
 
+from study_support.export_cache import ExportCache
+from study_support.export_context import ExportContext
+from study_support.export_formats import export_compression, export_output_format, report_filename, report_writer
+from study_support.export_parallel import PARALLEL_GENERATORS, compile_parallel, export_worker_count
+from study_support.export_pipeline import full_export_rows, peak_memory_usage
+from study_support.export_watermarks import WatermarkTracker, export_incremental
 from study_support.models import Participant
+from study_support.point_streams import stream_points, stream_point_properties
+from study_support.screen_time import ForegroundSamples, from_microseconds, ordered_sum, trimmed_durations
 
 
+# App families reported by nyu-violator-usage, in column order, as (column label, packages).
+# Override with settings.PD_VIOLATOR_APP_FAMILIES.
+
+VIOLATOR_APP_FAMILIES = (
+    ('Facebook', ('com.facebook.katana', 'com.facebook.lite',),),
+    ('Instagram', ('com.instagram.android',),),
+    ('Snapchat', ('com.snapchat.android',),),
+)
+
+def violator_app_families():
+    try:
+        return tuple((label, tuple(packages),) for label, packages in settings.PD_VIOLATOR_APP_FAMILIES)
+    except AttributeError:
+        pass
+
+    return VIOLATOR_APP_FAMILIES
+
 CUSTOM_GENERATORS = (
     'nyu-full-export',
     'nyu-daily-usage-summary',
@@ -71,6 +96,7 @@ class UnicodeWriter:
         # data = data.decode("utf-8")
         # data = self.encoder.encode(data)
         self.stream.write(data)
+        self.queue.seek(0)
         self.queue.truncate(0)
 
     def writerows(self, rows):
@@ -87,19 +113,58 @@ def generators_for_extra_generator(generator):
     return generators
 
 
-def compile_report(generator, sources, data_start=None, data_end=None, date_type='created'): # pylint: disable=too-many-locals, too-many-branches, too-many-statements, too-many-return-statements
+def compile_report(generator, sources, data_start=None, data_end=None, date_type='created', **kwargs): # pylint: disable=too-many-locals, too-many-branches, too-many-statements, too-many-return-statements
+    # PassiveDataKit's report jobs only pass the arguments above, so the export options default to
+    # settings: PD_EXPORT_FORMAT (output_format), PD_EXPORT_COMPRESSION (compression),
+    # PD_EXPORT_WORKERS (workers), and PD_EXPORT_INCREMENTAL (incremental). Direct callers may
+    # pass any of them, plus full_window=True to re-export the window and reset the watermarks.
+    # compile_parallel runs each source as a shard (shard=True) with copies of the parent's
+    # watermarks and export_cache; the parent saves and reports them once, after the merge.
+
+    shard = kwargs.get('shard', False)
+
+    export_cache = None
+
     try:
         if (generator in CUSTOM_GENERATORS) is False:
             return None
 
         now = arrow.get()
-        filename = tempfile.gettempdir() + '/pdk_export_' + str(now.timestamp()) + str(now.microsecond / 1e6) + '.txt'
+        filename = tempfile.gettempdir() + '/pdk_export_' + str(os.getpid()) + '_' + str(now.timestamp()) + str(now.microsecond / 1e6) + '.txt'
 
-        if generator == 'nyu-full-export':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = csv.writer(outfile, delimiter='\t')
-                # writer = UnicodeWriter(outfile, delimiter='\t')
+        output_format = kwargs.get('output_format', export_output_format())
+        compression = kwargs.get('compression', export_compression())
+
+        base_filename = filename
+        filename = report_filename(filename, output_format, compression)
+
+        export_cache = kwargs.get('export_cache', None)
+
+        if export_cache is None:
+            export_cache = ExportCache()
+
+        watermarks = kwargs.get('watermarks', None)
+
+        if watermarks is None:
+            watermarks = WatermarkTracker(generator, date_type, incremental=kwargs.get('incremental', export_incremental()), full_window=kwargs.get('full_window', False))
+
+        if shard is False and generator in PARALLEL_GENERATORS and len(sources) > 1:
+            workers = kwargs.get('workers', export_worker_count())
+
+            if workers > 1:
+                compile_parallel(compile_report, filename, generator, sources, data_start=data_start, data_end=data_end, date_type=date_type, workers=workers, output_format=output_format, compression=compression, watermarks=watermarks, export_cache=export_cache)
+
+                watermarks.save()
+
+                if generator == 'nyu-full-export':
+                    print('[nyu-full-export] Peak memory usage: %.1f MB' % peak_memory_usage())
+
+                return filename
 
+        export_context = ExportContext(sources)
+
+        if generator == 'nyu-full-export':
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'Source',
                     'Date Created',
@@ -118,11 +183,9 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                for source in sources: # pylint: disable=too-many-nested-blocks
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
-                        source_reference = DataSourceReference.reference_for_source(source)
+                for source in sorted(sources): # pylint: disable=too-many-nested-blocks
+                    if export_context.is_local(source):
+                        source_reference = export_context.source_reference(source)
 
                         points = DataPoint.objects.filter(source_reference=source_reference)
 
@@ -138,157 +201,17 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                             else:
                                 points = points.filter(created__lte=data_end)
 
-                        app_points = []
-
-                        apps_def = DataGeneratorDefinition.definition_for_identifier('pdk-foreground-application')
-
-                        point_count = points.filter(generator_definition=apps_def).count()
-                        point_index = 0
-
-                        while point_index < point_count:
-                            for point in points.filter(generator_definition=apps_def).order_by('created')[point_index:(point_index + 5000)]:
-                                properties = point.fetch_properties()
-
-                                app_points.append((point.created, point.recorded, properties,))
-
-                            point_index += 5000
-
-                        status_points = []
-
-                        status_def = DataGeneratorDefinition.definition_for_identifier('pdk-system-status')
-
-                        point_count = points.filter(generator_definition=status_def).count()
-                        point_index = 0
-
-                        while point_index < point_count:
-                            for point in points.filter(generator_definition=status_def).order_by('created')[point_index:(point_index + 5000)]:
-                                properties = point.fetch_properties()
-
-                                status_points.append((point.created, point.recorded, properties,))
-
-                            point_index += 5000
-
-                        battery_points = []
-
-                        battery_def = DataGeneratorDefinition.definition_for_identifier('pdk-device-battery')
-
-                        point_count = points.filter(generator_definition=battery_def).count()
-                        point_index = 0
-
-                        while point_index < point_count:
-                            for point in points.filter(generator_definition=battery_def).order_by('created')[point_index:(point_index + 5000)]:
-                                properties = point.fetch_properties()
-
-                                battery_points.append((point.created, point.recorded, properties,))
-
-                            point_index += 5000
-
-                        user_points = []
-
-                        user_def = DataGeneratorDefinition.definition_for_identifier('pdk-user')
+                        # Only the foreground stream drives the watermark. The context streams and the
+                        # previous foreground point are still read from before it.
 
-                        point_count = points.filter(generator_definition=user_def).count()
-                        point_index = 0
+                        points = watermarks.bound(source, points, points.filter(generator_definition=export_context.definition('pdk-foreground-application')))
 
-                        while point_index < point_count:
-                            for point in points.filter(generator_definition=user_def).order_by('created'):
-                                properties = point.fetch_properties()
+                        writer.writerows(full_export_rows(source, points, export_cache, after=watermarks.position(source), field=watermarks.field))
 
-                                user_points.append((point.created, point.recorded, properties,))
+            if shard is False:
+                watermarks.save()
 
-                            point_index += 5000
-
-                        last_seen = None
-
-                        for point in app_points:
-                            if last_seen != point[0]:
-                                here_tz = pytz.timezone(point[2]['passive-data-metadata']['timezone'])
-
-                                row = []
-
-                                row.append(source)
-
-                                created = point[0].astimezone(here_tz)
-
-                                row.append(created.isoformat())
-
-                                recorded = point[1].astimezone(here_tz)
-
-                                row.append(recorded.isoformat())
-
-                                row.append(point[2]['passive-data-metadata']['timezone'])
-
-                                model = point[2]['passive-data-metadata']['generator'].split(';')[-1].strip().replace(')', '')
-
-                                row.append(model)
-
-                                if last_seen is None:
-                                    row.append(point[2]['duration'])
-                                elif (point[0] - last_seen).total_seconds() * 1000 < point[2]['duration']:
-                                    row.append((point[0] - last_seen).total_seconds() * 1000)
-                                else:
-                                    row.append(point[2]['duration'])
-
-                                if 'application' in point[2]:
-                                    row.append(point[2]['application'])
-                                    row.append(fetch_app_genre(point[2]['application']))
-                                else:
-                                    row.append('')
-                                    row.append('')
-
-                                if point[2]['screen_active']:
-                                    row.append(1)
-                                else:
-                                    row.append(0)
-
-                                last_status = None
-
-                                for status in status_points:
-                                    if status[0] < point[0]:
-                                        last_status = status
-                                    else:
-                                        break
-
-                                if last_status is not None:
-                                    if 'system_runtime' in last_status[2]:
-                                        row.append(last_status[2]['system_runtime'])
-                                    else:
-                                        row.append(None)
-
-                                    row.append(last_status[2]['runtime'])
-                                else:
-                                    row.append(None)
-                                    row.append(None)
-
-                                last_battery = None
-
-                                for status in battery_points:
-                                    if status[0] < point[0]:
-                                        last_battery = status
-                                    else:
-                                        break
-
-                                if last_battery is not None:
-                                    row.append(100.0 * (float(last_battery[2]['level']) / float(last_battery[2]['scale'])))
-                                else:
-                                    row.append(None)
-
-                                last_user = None
-
-                                for status in user_points:
-                                    if status[0] < point[0]:
-                                        last_user = status
-                                    else:
-                                        break
-
-                                if last_user is not None and ('mode' in last_user[2]):
-                                    row.append(last_user[2]['mode'])
-                                else:
-                                    row.append(None)
-
-                                writer.writerow(row)
-
-                                last_seen = point[0]
+                print('[nyu-full-export] Peak memory usage: %.1f MB' % peak_memory_usage())
 
             return filename
 
@@ -301,9 +224,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
             if data_end is None:
                 data_end = timezone.now()
 
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'Source',
                     'Date',
@@ -312,33 +233,25 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                for source in sources:
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
+                for source in sorted(sources):
+                    if export_context.is_local(source):
                         try:
-                            participant = Participant.objects.filter(identifier=source).first()
+                            participant = export_context.participant(source)
 
                             if participant is not None:
-                                index_date = start_date
+                                usages = participant.fetch_usage_for_dates(start_date, data_end.date())
 
-                                while index_date <= data_end.date():
-                                    usage = participant.fetch_usage_for_date(index_date)
-
-                                    row = [source, index_date.isoformat(), usage]
+                                for index_date in sorted(usages.keys()):
+                                    row = [source, index_date.isoformat(), usages[index_date]]
 
                                     writer.writerow(row)
-
-                                    index_date = index_date + datetime.timedelta(days=1)
                         except: # pylint: disable=bare-except
                             traceback.print_exc()
 
             return filename
 
         if generator == 'nyu-app-budgets-daily':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'App Code',
                     'Updated',
@@ -351,13 +264,11 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                for source in sources: # pylint: disable=too-many-nested-blocks
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
+                for source in sorted(sources): # pylint: disable=too-many-nested-blocks
+                    if export_context.is_local(source):
                         try:
-                            source_reference = DataSourceReference.reference_for_source(source)
-                            budget_def = DataGeneratorDefinition.definition_for_identifier('daily-app-budget')
+                            source_reference = export_context.source_reference(source)
+                            budget_def = export_context.definition('daily-app-budget')
 
                             points = DataPoint.objects.filter(source_reference=source_reference, generator_definition=budget_def)
 
@@ -369,10 +280,8 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                             old_budget_packages = None
 
-                            for point in points.order_by('created'):
-                                properties = point.fetch_properties()
-
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                            for point, properties in stream_point_properties(points):
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
                                 budget = json.loads(properties['budget'])
 
@@ -382,10 +291,10 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                     row = []
 
                                     row.append(source)
-                                    row.append(point.created.astimezone(here_tz).isoformat())
+                                    row.append(export_cache.local_time(point.created, here_tz).isoformat())
                                     row.append(key)
-                                    row.append(fetch_app_genre(key))
-                                    row.append(datetime.datetime.fromtimestamp(properties['effective_on'] / 1000, tz=pytz.utc).astimezone(here_tz).isoformat())
+                                    row.append(export_cache.genre(key))
+                                    row.append(export_cache.local_time(datetime.datetime.fromtimestamp(properties['effective_on'] / 1000, tz=pytz.utc), here_tz).isoformat())
                                     row.append(value)
                                     row.append(properties['passive-data-metadata']['timezone'])
 
@@ -403,10 +312,10 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                         row = []
 
                                         row.append(source)
-                                        row.append(point.created.astimezone(here_tz).isoformat())
+                                        row.append(export_cache.local_time(point.created, here_tz).isoformat())
                                         row.append(package)
-                                        row.append(fetch_app_genre(package))
-                                        row.append(datetime.datetime.fromtimestamp(properties['effective_on'] / 1000, tz=pytz.utc).astimezone(here_tz).isoformat())
+                                        row.append(export_cache.genre(package))
+                                        row.append(export_cache.local_time(datetime.datetime.fromtimestamp(properties['effective_on'] / 1000, tz=pytz.utc), here_tz).isoformat())
                                         row.append(-1)
                                         row.append(properties['passive-data-metadata']['timezone'])
 
@@ -420,9 +329,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
             return filename
 
         if generator == 'nyu-app-budgets':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'App Code',
                     'Updated',
@@ -435,13 +342,11 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                budget_def = DataGeneratorDefinition.definition_for_identifier('full-app-budgets')
-
-                for source in sources: # pylint: disable=too-many-nested-blocks
-                    data_source = DataSource.objects.filter(identifier=source).first()
+                budget_def = export_context.definition('full-app-budgets')
 
-                    if data_source is not None and data_source.server is None:
-                        source_reference = DataSourceReference.reference_for_source(source)
+                for source in sorted(sources): # pylint: disable=too-many-nested-blocks
+                    if export_context.is_local(source):
+                        source_reference = export_context.source_reference(source)
 
                         try:
                             latest = DataPoint.objects.filter(source_reference=source_reference, generator_definition=budget_def).order_by('-created').first()
@@ -451,7 +356,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                             if latest is not None:
                                 properties = latest.fetch_properties()
 
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
                                 budgets = properties['budgets']
 
@@ -464,10 +369,10 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                         row = []
 
                                         row.append(source)
-                                        row.append(datetime.datetime.fromtimestamp(item['observed'] / 1000, tz=pytz.utc).astimezone(here_tz).isoformat())
+                                        row.append(export_cache.local_time(datetime.datetime.fromtimestamp(item['observed'] / 1000, tz=pytz.utc), here_tz).isoformat())
                                         row.append(key)
-                                        row.append(fetch_app_genre(key))
-                                        row.append(datetime.datetime.fromtimestamp(item['effective_on'] / 1000, tz=pytz.utc).astimezone(here_tz).isoformat())
+                                        row.append(export_cache.genre(key))
+                                        row.append(export_cache.local_time(datetime.datetime.fromtimestamp(item['effective_on'] / 1000, tz=pytz.utc), here_tz).isoformat())
                                         row.append(value)
                                         row.append(properties['passive-data-metadata']['timezone'])
 
@@ -485,10 +390,10 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                             row = []
 
                                             row.append(source)
-                                            row.append(datetime.datetime.fromtimestamp(item['observed'] / 1000, tz=pytz.utc).astimezone(here_tz).isoformat())
+                                            row.append(export_cache.local_time(datetime.datetime.fromtimestamp(item['observed'] / 1000, tz=pytz.utc), here_tz).isoformat())
                                             row.append(package)
-                                            row.append(fetch_app_genre(package))
-                                            row.append(datetime.datetime.fromtimestamp(item['effective_on'] / 1000, tz=pytz.utc).astimezone(here_tz).isoformat())
+                                            row.append(export_cache.genre(package))
+                                            row.append(export_cache.local_time(datetime.datetime.fromtimestamp(item['effective_on'] / 1000, tz=pytz.utc), here_tz).isoformat())
                                             row.append(-1)
                                             row.append(properties['passive-data-metadata']['timezone'])
 
@@ -502,9 +407,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
             return filename
 
         if generator == 'nyu-snooze-costs':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'App Code',
                     'Updated',
@@ -514,13 +417,11 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                for source in sources:
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
+                for source in sorted(sources):
+                    if export_context.is_local(source):
                         try:
-                            source_reference = DataSourceReference.reference_for_source(source)
-                            event_def = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+                            source_reference = export_context.source_reference(source)
+                            event_def = export_context.definition('pdk-app-event')
 
                             points = DataPoint.objects.filter(source_reference=source_reference, generator_definition=event_def, secondary_identifier='set-snooze-cost')
 
@@ -538,28 +439,29 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                 else:
                                     points = points.filter(created__lt=data_end)
 
-                            for point in points:
-                                properties = point.fetch_properties()
-
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                            for point, properties in stream_point_properties(watermarks.window(source, points)):
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
                                 row = []
 
                                 row.append(source)
-                                row.append(point.created.astimezone(here_tz).isoformat())
-                                row.append(point.recorded.astimezone(here_tz).isoformat())
+                                row.append(export_cache.local_time(point.created, here_tz).isoformat())
+                                row.append(export_cache.local_time(point.recorded, here_tz).isoformat())
                                 row.append(round(properties['event_details']['snooze-cost'], 2))
 
                                 writer.writerow(row)
                         except: # pylint: disable=bare-except
+                            watermarks.discard(source)
+
                             traceback.print_exc()
 
+            if shard is False:
+                watermarks.save()
+
             return filename
 
         if generator == 'nyu-snooze-events':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'App Code',
                     'Created',
@@ -574,26 +476,22 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                event_def = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
-                snooze_def = DataGeneratorDefinition.definition_for_identifier('app-snooze')
+                event_def = export_context.definition('pdk-app-event')
+                snooze_def = export_context.definition('app-snooze')
 
                 for source in sorted(sources): # pylint: disable=too-many-nested-blocks
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
+                    if export_context.is_local(source):
                         try:
-                            source_ref = DataSourceReference.reference_for_source(source)
+                            source_ref = export_context.source_reference(source)
 
                             costs = []
 
                             points = DataPoint.objects.filter(source_reference=source_ref, generator_definition=event_def, secondary_identifier='set-snooze-cost').order_by('created')
 
-                            for point in points:
-                                properties = point.fetch_properties()
-
+                            for point, properties in stream_point_properties(points):
                                 costs.append((point.created, properties['event_details']['snooze-cost']))
 
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
                             points = DataPoint.objects.filter(source_reference=source_ref, generator_definition=snooze_def)
 
@@ -611,18 +509,16 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                             points = points.order_by('created')
 
-                            for point in points:
-                                properties = point.fetch_properties()
-
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                            for point, properties in stream_point_properties(points):
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
                                 row = []
 
                                 row.append(source)
-                                row.append(point.created.astimezone(here_tz).isoformat())
-                                row.append(point.recorded.astimezone(here_tz).isoformat())
+                                row.append(export_cache.local_time(point.created, here_tz).isoformat())
+                                row.append(export_cache.local_time(point.recorded, here_tz).isoformat())
                                 row.append(properties['app_package'])
-                                row.append(fetch_app_genre(properties['app_package']))
+                                row.append(export_cache.genre(properties['app_package']))
 
                                 snooze_cost = None
 
@@ -658,9 +554,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
             return filename
 
         if generator == 'nyu-snooze-warnings':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'App Code',
                     'Created',
@@ -676,7 +570,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                event_def = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+                event_def = export_context.definition('pdk-app-event')
 
                 secondary_identifiers = [
                     'blocked_app',
@@ -715,32 +609,28 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                         query = query & Q(created__lt=data_end)
 
                 for source in sorted(sources): # pylint: disable=too-many-nested-blocks
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
+                    if export_context.is_local(source):
                         try:
-                            source_ref = DataSourceReference.reference_for_source(source)
+                            source_ref = export_context.source_reference(source)
 
                             points = DataPoint.objects.filter(source_reference=source_ref).filter(query).order_by('created')
 
-                            for point in points:
-                                properties = point.fetch_properties()
-
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                            for point, properties in stream_point_properties(watermarks.window(source, points)):
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
                                 row = []
 
                                 row.append(source)
 
-                                created = point.created.astimezone(here_tz)
+                                created = export_cache.local_time(point.created, here_tz)
 
                                 row.append(created.isoformat())
                                 row.append(created.hour)
-                                row.append(point.recorded.astimezone(here_tz).isoformat())
+                                row.append(export_cache.local_time(point.recorded, here_tz).isoformat())
 
                                 if 'package' in properties['event_details']:
                                     row.append(properties['event_details']['package'])
-                                    row.append(fetch_app_genre(properties['event_details']['package']))
+                                    row.append(export_cache.genre(properties['event_details']['package']))
                                 else:
                                     row.append('')
                                     row.append('')
@@ -809,15 +699,18 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                 writer.writerow(row)
 
                         except: # pylint: disable=bare-except
+                            watermarks.discard(source)
+
                             traceback.print_exc()
 
+            if shard is False:
+                watermarks.save()
+
             return filename
 
         if generator == 'nyu-participant-status':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                event_def = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
-
-                writer = UnicodeWriter(outfile, delimiter='\t')
+            with report_writer(filename, output_format, compression) as writer:
+                event_def = export_context.definition('pdk-app-event')
 
                 columns = [
                     'Participant',
@@ -849,15 +742,13 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                 writer.writerow(columns)
 
                 for source in sorted(sources): # pylint: disable=too-many-nested-blocks
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
+                    if export_context.is_local(source):
                         try:
-                            participant = Participant.objects.filter(identifier=source).first()
+                            participant = export_context.participant(source)
 
                             if participant is not None:
                                 try:
-                                    report = json.loads(participant.metadata)['study_performance_report']
+                                    report = participant.fetch_performance_report({}) # A missing report raises KeyError below.
 
                                     row = []
                                     row.append(participant.identifier)
@@ -896,7 +787,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                     else:
                                         row.append('')
 
-                                    source_reference = DataSourceReference.reference_for_source(source)
+                                    source_reference = export_context.source_reference(source)
 
                                     points = DataPoint.objects.filter(source_reference=source_reference, generator_definition=event_def, secondary_identifier='app-opt-out')
 
@@ -1002,9 +893,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                                     missing_permissions = set()
 
-                                    for point in points:
-                                        properties = point.fetch_properties()
-
+                                    for point, properties in stream_point_properties(points):
                                         if 'issues' in properties['event_details']:
                                             issues_str = properties['event_details']['issues']
 
@@ -1047,219 +936,102 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
             start = end - datetime.timedelta(minutes=(12 * 60)) # pylint: disable=superfluous-parens
 
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
+            app_families = violator_app_families()
+
+            tracked_packages = sorted(set(package for label, packages in app_families for package in packages))
 
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'Participant',
-                    'Facebook Usage',
-                    'Instagram Usage',
-                    'Snapchat Usage',
+                ]
+
+                for family, apps in app_families: # pylint: disable=unused-variable
+                    columns.append(family + ' Usage')
+
+                columns.extend([
                     'First Use',
                     'Last Use',
                     'Monitor Start',
                     'Monitor End',
-                    'Facebook Start',
-                    'Facebook End',
-                    'Instagram Start',
-                    'Instagram End',
-                    'Snapchat Start',
-                    'Snapchat End',
-                ]
+                ])
+
+                for family, apps in app_families: # pylint: disable=unused-variable
+                    columns.append(family + ' Start')
+                    columns.append(family + ' End')
 
                 writer.writerow(columns)
 
-                app_def = DataGeneratorDefinition.definition_for_identifier('pdk-foreground-application')
+                app_def = export_context.definition('pdk-foreground-application')
 
                 for source in sorted(sources): # pylint: disable=too-many-nested-blocks
-                    data_source = DataSource.objects.filter(identifier=source).first()
-
-                    if data_source is not None and data_source.server is None:
+                    if export_context.is_local(source):
                         try:
-                            participant = Participant.objects.filter(identifier=source).first()
+                            participant = export_context.participant(source)
 
                             if participant is not None:
-                                source_ref = DataSourceReference.reference_for_source(source)
+                                source_ref = export_context.source_reference(source)
 
                                 points = DataPoint.objects.filter(source_reference=source_ref, generator_definition=app_def)
 
                                 points = points.filter(recorded__gte=start, recorded__lt=end)
 
-                                earliest = None
-                                latest = None
+                                # One ordered scan over every tracked package feeds all of the families.
 
-                                facebook_apps = [
-                                    'com.facebook.katana',
-                                    'com.facebook.lite',
-                                ]
+                                samples = ForegroundSamples.from_points(points.filter(secondary_identifier__in=tracked_packages))
 
-                                facebook_usage = 0.0
+                                # Screen-off samples are ignored entirely, so only screen-on samples count as the previous sample.
 
-                                facebook_start = None
-                                facebook_end = None
+                                samples = samples.subset(samples.screen_on())
 
-                                for app in facebook_apps:
-                                    last_seen = None
+                                package_durations = {}
 
-                                    for point in points.filter(secondary_identifier=app):
-                                        properties = point.fetch_properties()
+                                for package in tracked_packages:
+                                    package_samples = samples.for_packages([package])
 
-                                        if properties['screen_active']:
-                                            if last_seen is None:
-                                                facebook_usage += properties['duration']
-                                            elif (point.created - last_seen).total_seconds() * 1000 < properties['duration']:
-                                                facebook_usage += (point.created - last_seen).total_seconds() * 1000
-                                            else:
-                                                facebook_usage += properties['duration']
+                                    package_durations[package] = (package_samples.created, trimmed_durations(package_samples.created, package_samples.durations)[0],)
 
-                                            last_seen = point.created
-
-                                            created = point.created.astimezone(server_tz)
-
-                                            if earliest is None:
-                                                earliest = created
-                                            elif created < earliest:
-                                                earliest = created
-
-                                            if latest is None:
-                                                latest = created
-                                            elif point.created > latest:
-                                                latest = created
-
-                                            if facebook_start is None:
-                                                facebook_start = created
-                                            elif point.created < facebook_start:
-                                                facebook_start = created
-
-                                            if facebook_end is None:
-                                                facebook_end = created
-                                            elif point.created > facebook_end:
-                                                facebook_end = created
-
-                                instagram_apps = [
-                                    'com.instagram.android',
-                                ]
-
-                                instagram_usage = 0.0
-
-                                instagram_start = None
-                                instagram_end = None
-
-                                for app in instagram_apps:
-                                    last_seen = None
-
-                                    for point in points.filter(secondary_identifier=app):
-                                        properties = point.fetch_properties()
-
-                                        if properties['screen_active']:
-                                            if last_seen is None:
-                                                instagram_usage += properties['duration']
-                                            elif (point.created - last_seen).total_seconds() * 1000 < properties['duration']:
-                                                instagram_usage += (point.created - last_seen).total_seconds() * 1000
-                                            else:
-                                                instagram_usage += properties['duration']
-
-                                            last_seen = point.created
-
-                                            created = point.created.astimezone(server_tz)
-
-                                            if earliest is None:
-                                                earliest = created
-                                            elif created < earliest:
-                                                earliest = created
-
-                                            if latest is None:
-                                                latest = created
-                                            elif point.created > latest:
-                                                latest = created
-
-                                            if instagram_start is None:
-                                                instagram_start = created
-                                            elif point.created < instagram_start:
-                                                instagram_start = created
-
-                                            if instagram_end is None:
-                                                instagram_end = created
-                                            elif point.created > instagram_end:
-                                                instagram_end = created
-
-                                snapchat_apps = [
-                                    'com.snapchat.android',
-                                ]
-
-                                snapchat_usage = 0.0
-
-                                snapchat_start = None
-                                snapchat_end = None
-
-                                for app in snapchat_apps:
-                                    last_seen = None
-
-                                    for point in points.filter(secondary_identifier=app):
-                                        properties = point.fetch_properties()
+                                earliest = None
+                                latest = None
 
-                                        if properties['screen_active']:
-                                            if last_seen is None:
-                                                snapchat_usage += properties['duration']
-                                            elif (point.created - last_seen).total_seconds() * 1000 < properties['duration']:
-                                                snapchat_usage += (point.created - last_seen).total_seconds() * 1000
-                                            else:
-                                                snapchat_usage += properties['duration']
+                                usages = {}
+                                family_starts = {}
+                                family_ends = {}
 
-                                            created = point.created.astimezone(server_tz)
+                                for family, apps in app_families:
+                                    family_created = numpy.concatenate([package_durations[app][0] for app in apps])
 
-                                            if earliest is None:
-                                                earliest = created
-                                            elif created < earliest:
-                                                earliest = created
+                                    usages[family] = 0.0 + ordered_sum(numpy.concatenate([package_durations[app][1] for app in apps]))
 
-                                            if latest is None:
-                                                latest = created
-                                            elif point.created > latest:
-                                                latest = created
+                                    if len(family_created) > 0: # pylint: disable=len-as-condition
+                                        family_starts[family] = from_microseconds(family_created.min()).astimezone(server_tz)
+                                        family_ends[family] = from_microseconds(family_created.max()).astimezone(server_tz)
 
-                                            if snapchat_start is None:
-                                                snapchat_start = created
-                                            elif point.created < snapchat_start:
-                                                snapchat_start = created
+                                        if earliest is None or family_starts[family] < earliest:
+                                            earliest = family_starts[family]
 
-                                            if snapchat_end is None:
-                                                snapchat_end = created
-                                            elif point.created > snapchat_end:
-                                                snapchat_end = created
+                                        if latest is None or family_ends[family] > latest:
+                                            latest = family_ends[family]
 
                                 if earliest is not None and latest is not None:
                                     row = []
 
                                     row.append(participant.identifier)
-                                    row.append(facebook_usage / 60000)
-                                    row.append(instagram_usage / 60000)
-                                    row.append(snapchat_usage / 60000)
+
+                                    for family, apps in app_families: # pylint: disable=unused-variable
+                                        row.append(usages[family] / 60000)
+
                                     row.append(earliest.isoformat())
                                     row.append(latest.isoformat())
                                     row.append(start.isoformat())
                                     row.append(end.isoformat())
 
-                                    if (facebook_start is not None) and (facebook_end is not None):
-                                        row.append(facebook_start.isoformat())
-                                        row.append(facebook_end.isoformat())
-                                    else:
-                                        row.append('')
-                                        row.append('')
-
-                                    if (instagram_start is not None) and (instagram_end is not None):
-                                        row.append(instagram_start.isoformat())
-                                        row.append(instagram_end.isoformat())
-                                    else:
-                                        row.append('')
-                                        row.append('')
-
-                                    if (snapchat_start is not None) and (snapchat_end is not None):
-                                        row.append(snapchat_start.isoformat())
-                                        row.append(snapchat_end.isoformat())
-                                    else:
-                                        row.append('')
-                                        row.append('')
+                                    for family, apps in app_families: # pylint: disable=unused-variable
+                                        if family in family_starts:
+                                            row.append(family_starts[family].isoformat())
+                                            row.append(family_ends[family].isoformat())
+                                        else:
+                                            row.append('')
+                                            row.append('')
 
                                     writer.writerow(row)
                         except: # pylint: disable=bare-except
@@ -1268,9 +1040,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
             return filename
 
         if generator == 'nyu-participant-opt-out':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = UnicodeWriter(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'Participant',
                     'Opt-Out Date',
@@ -1279,17 +1049,15 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                event_def = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+                event_def = export_context.definition('pdk-app-event')
 
                 points = DataPoint.objects.filter(generator_definition=event_def, secondary_identifier='app-opt-out').order_by('created')
 
-                for point in points:
-                    properties = point.fetch_properties()
-
+                for point, properties in stream_point_properties(points):
                     here_tz = settings.TIME_ZONE
 
                     if 'timezone' in properties['passive-data-metadata']:
-                        here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                        here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
                     row = []
 
@@ -1307,19 +1075,17 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
         if generator == 'nyu-latest-usage-summaries':
             try:
-                filename = filename.replace('.txt', '.zip')
+                filename = base_filename.replace('.txt', '.zip')
 
                 files_written = 0
 
                 with ZipFile(filename, 'w', allowZip64=True) as export_file:
                     for source in sorted(sources): # pylint: disable=too-many-nested-blocks
-                        data_source = DataSource.objects.filter(identifier=source).first()
-
-                        if data_source is not None and data_source.server is None:
+                        if export_context.is_local(source):
                             gc.collect()
 
-                            source_ref = DataSourceReference.reference_for_source(source)
-                            event_def = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+                            source_ref = export_context.source_reference(source)
+                            event_def = export_context.definition('pdk-app-event')
 
                             points = DataPoint.objects.filter(source_reference=source_ref, generator_definition=event_def, secondary_identifier='app-usage-summary')
 
@@ -1348,9 +1114,9 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                             if latest_point is not None:
                                 properties = latest_point.fetch_properties()
 
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
-                                latest_created = latest_point.created.astimezone(here_tz)
+                                latest_created = export_cache.local_time(latest_point.created, here_tz)
 
                                 earliest_created = points.order_by('created').first().created
 
@@ -1365,9 +1131,9 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                     if point is not None:
                                         properties = point.fetch_properties()
 
-                                        here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                                        here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
-                                        created = point.created.astimezone(here_tz)
+                                        created = export_cache.local_time(point.created, here_tz)
 
                                         created_date = created.date()
 
@@ -1390,9 +1156,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
         if generator == 'nyu-active-users':
             try:
-                with open(filename, 'w', encoding='utf-8') as outfile:
-                    writer = csv.writer(outfile, delimiter='\t')
-
+                with report_writer(filename, output_format, compression) as writer:
                     when = arrow.now().replace(hour=0, minute=0, microsecond=0).shift(days=-1).datetime
 
                     columns = [
@@ -1404,7 +1168,11 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                     writer.writerow(columns)
 
-                    for participant in Participant.objects.all().order_by('identifier'):
+                    participants = list(Participant.objects.all().order_by('identifier'))
+
+                    export_context = ExportContext([participant.identifier for participant in participants])
+
+                    for participant in participants:
                         row = []
 
                         row.append(participant.identifier)
@@ -1413,10 +1181,10 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                         active = 0
                         last_data_date = None
 
-                        source_ref = DataSourceReference.reference_for_source(participant.identifier)
-                        app_def = DataGeneratorDefinition.definition_for_identifier('pdk-foreground-application')
+                        source_ref = export_context.source_reference(participant.identifier)
+                        app_def = export_context.definition('pdk-foreground-application')
 
-                        for point in DataPoint.objects.filter(source_reference=source_ref, generator_definition=app_def, created__gte=when).order_by('-created'):
+                        for point in stream_points(DataPoint.objects.filter(source_reference=source_ref, generator_definition=app_def, created__gte=when), descending=True):
                             if transmitted == 0:
                                 transmitted = 1
 
@@ -1445,9 +1213,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                 traceback.print_exc()
 
         if generator == 'nyu-participants':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = csv.writer(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'E-Mail',
                     'App Code / Identifier',
@@ -1457,14 +1223,18 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                for participant in Participant.objects.all().order_by('-created'):
+                participants = list(Participant.objects.all().order_by('-created'))
+
+                export_context = ExportContext([participant.identifier for participant in participants])
+
+                for participant in participants:
                     row = []
 
                     row.append(participant.email_address)
                     row.append(participant.identifier)
                     row.append(participant.created.isoformat())
 
-                    source = DataSource.objects.filter(identifier=participant.identifier).first()
+                    source = export_context.data_source(participant.identifier)
 
                     if source is not None:
                         row.append(str(source.server))
@@ -1474,9 +1244,7 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
             return filename
 
         if generator == 'nyu-snooze-delays':
-            with open(filename, 'w', encoding='utf-8') as outfile:
-                writer = csv.writer(outfile, delimiter='\t')
-
+            with report_writer(filename, output_format, compression) as writer:
                 columns = [
                     'App Code',
                     'Snooze Delay',
@@ -1486,33 +1254,34 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
 
                 writer.writerow(columns)
 
-                delay_definition = DataGeneratorDefinition.definition_for_identifier('snooze-delay')
+                delay_definition = export_context.definition('snooze-delay')
 
                 for source in sorted(sources): # pylint: disable=too-many-nested-blocks
-                    source_reference = DataSourceReference.reference_for_source(source)
+                    source_reference = export_context.source_reference(source)
 
-                    for point in DataPoint.objects.filter(generator_definition=delay_definition, source_reference=source_reference).order_by('created'):
-                        properties = point.fetch_properties()
+                    points = DataPoint.objects.filter(generator_definition=delay_definition, source_reference=source_reference)
 
+                    for point, properties in stream_point_properties(watermarks.window(source, points)):
                         row = []
 
                         row.append(point.source)
                         row.append(properties['snooze_delay'])
 
-                        here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                        here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
-                        row.append(point.created.astimezone(here_tz).isoformat())
-                        row.append(datetime.datetime.fromtimestamp(properties['effective_on'] / 1000, tz=pytz.utc).astimezone(here_tz).isoformat())
+                        row.append(export_cache.local_time(point.created, here_tz).isoformat())
+                        row.append(export_cache.local_time(datetime.datetime.fromtimestamp(properties['effective_on'] / 1000, tz=pytz.utc), here_tz).isoformat())
 
                         writer.writerow(row)
 
+            if shard is False:
+                watermarks.save()
+
             return filename
 
         if generator == 'phone-dashboard-yesterday-summaries':
             try:
-                with open(filename, 'w', encoding='utf-8') as outfile:
-                    writer = csv.writer(outfile, delimiter='\t')
-
+                with report_writer(filename, output_format, compression) as writer:
                     columns = [
                         'Participant',
                         'Date',
@@ -1526,13 +1295,11 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                     for source in sorted(sources): # pylint: disable=too-many-nested-blocks
                         print('SOURCE: %s' % source)
 
-                        data_source = DataSource.objects.filter(identifier=source).first()
-
-                        if data_source is not None and data_source.server is None:
+                        if export_context.is_local(source):
                             gc.collect()
 
-                            source_ref = DataSourceReference.reference_for_source(source)
-                            event_def = DataGeneratorDefinition.definition_for_identifier('pdk-app-event')
+                            source_ref = export_context.source_reference(source)
+                            event_def = export_context.definition('pdk-app-event')
 
                             points = DataPoint.objects.filter(source_reference=source_ref, generator_definition=event_def, secondary_identifier='app-usage-summary')
 
@@ -1563,9 +1330,9 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                             if latest_point is not None:
                                 properties = latest_point.fetch_properties()
 
-                                here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                                here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
-                                latest_created = latest_point.created.astimezone(here_tz)
+                                latest_created = export_cache.local_time(latest_point.created, here_tz)
 
                                 earliest_created = points.order_by('created').first().created
 
@@ -1585,9 +1352,9 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
                                         yesterday_summary = properties.get('event_details', {}).get('yesterday-summary', {}).get('apps-usage', {})
 
                                         if len(yesterday_summary) > 0:
-                                            here_tz = pytz.timezone(properties['passive-data-metadata']['timezone'])
+                                            here_tz = export_cache.timezone(properties['passive-data-metadata']['timezone'])
 
-                                            created = point.created.astimezone(here_tz)
+                                            created = export_cache.local_time(point.created, here_tz)
 
                                             created_date = created.date()
 
@@ -1616,23 +1383,26 @@ def compile_report(generator, sources, data_start=None, data_end=None, date_type
         print(generator + ': ' + str(sources))
 
         traceback.print_exc()
+    finally:
+        if export_cache is not None and shard is False:
+            print('[' + generator + '] Cache statistics: ' + export_cache.summary())
 
     return None
 
 def pdk_custom_home_header():
     participants = []
 
-    for participant in Participant.objects.all():
-        try:
-            report = json.loads(participant.metadata)['study_performance_report']
+    for participant in Participant.objects.all().only('identifier', 'performance_report'):
+        report = participant.fetch_performance_report()
 
+        if report is not None:
             row = {
                 'identifier': participant.identifier,
                 'performance': report
             }
 
             participants.append(row)
-        except KeyError:
+        else:
             print('No performance metadata for: ' + participant.identifier)
 
     context = {}
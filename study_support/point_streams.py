@@ -0,0 +1,57 @@
+# pylint: disable=line-too-long
+
+from django.conf import settings
+from django.db.models import Q
+
+DEFAULT_BATCH_SIZE = 5000
+
+def export_batch_size():
+    try:
+        return settings.PD_EXPORT_BATCH_SIZE
+    except AttributeError:
+        pass
+
+    return DEFAULT_BATCH_SIZE
+
+
+def stream_points(points, field='created', batch_size=None, descending=False):
+    '''
+    Iterates over a DataPoint queryset in (field, pk) order, paging on the last
+    seen keyset instead of OFFSET slices so that each page is an indexed range
+    scan and only one page is held in memory at a time.
+    '''
+
+    if batch_size is None:
+        batch_size = export_batch_size()
+
+    if descending:
+        points = points.order_by('-' + field, '-pk')
+    else:
+        points = points.order_by(field, 'pk')
+
+    last_value = None
+    last_pk = None
+
+    while True:
+        page = points
+
+        if last_pk is not None:
+            if descending:
+                page = page.filter(Q(**{field + '__lt': last_value}) | Q(**{field: last_value, 'pk__lt': last_pk}))
+            else:
+                page = page.filter(Q(**{field + '__gt': last_value}) | Q(**{field: last_value, 'pk__gt': last_pk}))
+
+        page = list(page[:batch_size])
+
+        yield from page
+
+        if len(page) < batch_size:
+            return
+
+        last_value = getattr(page[-1], field)
+        last_pk = page[-1].pk
+
+
+def stream_point_properties(points, field='created', batch_size=None, descending=False):
+    for point in stream_points(points, field=field, batch_size=batch_size, descending=descending):
+        yield point, point.fetch_properties()
@@ -0,0 +1,341 @@
+# pylint: disable=line-too-long, no-member
+
+import datetime
+
+import arrow
+import numpy
+import pytz
+
+from passive_data_kit.models import install_supports_jsonfield
+
+from .point_streams import export_batch_size, stream_points
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+BUCKET_SIZES = {
+    'minute': 60 * 1000000,
+    'hour': 60 * 60 * 1000000,
+    'day': 24 * 60 * 60 * 1000000,
+}
+
+def to_microseconds(when):
+    return (when - EPOCH) // ONE_MICROSECOND
+
+
+def from_microseconds(microseconds):
+    return EPOCH + (int(microseconds) * ONE_MICROSECOND)
+
+
+def utc_offsets(created, here_tz):
+    # Returns each time's UTC offset in here_tz, in microseconds. Zones from pytz list their
+    # transitions, so the offset is looked up once per stretch between transitions (which need
+    # not fall on a UTC hour, as in America/St_Johns); other zones are looked up per distinct time.
+
+    fixed_offset = here_tz.utcoffset(None)
+
+    if fixed_offset is not None:
+        return numpy.full(len(created), fixed_offset // ONE_MICROSECOND, dtype=numpy.int64)
+
+    transitions = getattr(here_tz, '_utc_transition_times', None)
+
+    if transitions:
+        boundaries = numpy.array([to_microseconds(pytz.utc.localize(transition)) for transition in transitions], dtype=numpy.int64)
+
+        stretches = numpy.searchsorted(boundaries, created, side='right')
+    else:
+        stretches = created
+
+    _, first, inverse = numpy.unique(stretches, return_index=True, return_inverse=True)
+
+    stretch_offsets = [from_microseconds(when).astimezone(here_tz).utcoffset() // ONE_MICROSECOND for when in created[first].tolist()]
+
+    return numpy.array(stretch_offsets, dtype=numpy.int64)[inverse]
+
+
+def trimmed_durations(created, durations, previous=None):
+    '''
+    Applies the overlap rule shared by every usage calculation: each sample's
+    duration is cut to the time since the previous sample when that gap is
+    shorter. The first sample is only trimmed against `previous` (microseconds
+    since the epoch), if given. Returns the trimmed durations and a mask of the
+    samples that were cut.
+    '''
+
+    gaps = numpy.empty(len(created), dtype=numpy.float64)
+
+    if len(created) > 0: # pylint: disable=len-as-condition
+        if previous is None:
+            gaps[0] = numpy.inf
+        else:
+            gaps[0] = ((created[0] - previous) / 1e6) * 1000
+
+        gaps[1:] = (numpy.diff(created) / 1e6) * 1000
+
+    was_trimmed = gaps < durations
+
+    return numpy.where(was_trimmed, gaps, durations), was_trimmed
+
+
+def ordered_sum(values):
+    # Summed in order as Python floats so totals match the point-by-point calculations exactly.
+
+    return sum(values.tolist())
+
+
+def sample_rows(points):
+    # Yields (created, duration, screen_active, package, recorded) for each point in creation
+    # order, with times in microseconds since the epoch, missing durations as NaN and missing
+    # packages as empty strings.
+
+    points = points.order_by('created', 'pk')
+
+    if install_supports_jsonfield():
+        rows = points.values_list('created', 'properties__duration', 'properties__screen_active', 'secondary_identifier', 'recorded').iterator(chunk_size=export_batch_size())
+    else:
+        rows = []
+
+        for point in stream_points(points):
+            payload = point.fetch_properties()
+
+            rows.append((point.created, payload.get('duration', None), payload.get('screen_active', None), point.secondary_identifier, point.recorded,))
+
+    for when, duration, screen_active, package, recorded_when in rows:
+        if duration is None:
+            duration = numpy.nan
+
+        if package is None:
+            package = ''
+
+        yield to_microseconds(when), duration, bool(screen_active), package, to_microseconds(recorded_when)
+
+
+class ForegroundSamples:
+    '''
+    Time-ordered pdk-foreground-application samples held as parallel arrays:
+    created (integer microseconds since the epoch), duration (milliseconds, NaN
+    when missing), screen_active, package and recorded. Callers pick the samples
+    that count as "the previous sample" for their rule (all apps, one app,
+    active only) with subset() or for_packages() before trimming.
+    '''
+
+    def __init__(self, created, durations, active, packages, recorded): # pylint: disable=too-many-arguments
+        self.created = created
+        self.durations = durations
+        self.active = active
+        self.packages = packages
+        self.recorded = recorded
+
+    @classmethod
+    def from_points(cls, points):
+        columns = list(zip(*sample_rows(points)))
+
+        if not columns:
+            columns = [[], [], [], [], []]
+
+        return cls(numpy.array(columns[0], dtype=numpy.int64), numpy.array(columns[1], dtype=numpy.float64), numpy.array(columns[2], dtype=bool), numpy.array(columns[3], dtype=str), numpy.array(columns[4], dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.created)
+
+    def subset(self, mask):
+        return ForegroundSamples(self.created[mask], self.durations[mask], self.active[mask], self.packages[mask], self.recorded[mask])
+
+    def for_packages(self, packages):
+        return self.subset(numpy.isin(self.packages, list(packages)))
+
+    def screen_on(self):
+        return self.active & numpy.isfinite(self.durations)
+
+    def screen_off(self):
+        return numpy.logical_not(self.active) & numpy.isfinite(self.durations)
+
+    def bucket_keys(self, bucket, here_tz=None):
+        # Returns local bucket starts (aware datetimes) for minute and hour buckets, or local
+        # dates for day buckets.
+
+        if len(self) == 0: # pylint: disable=len-as-condition
+            return []
+
+        if here_tz is None:
+            here_tz = pytz.utc
+
+        offsets = utc_offsets(self.created, here_tz)
+
+        local = self.created + offsets
+
+        if bucket == 'day':
+            return [datetime.date(1970, 1, 1) + datetime.timedelta(days=day) for day in (local // BUCKET_SIZES['day']).tolist()]
+
+        starts = local - (local % BUCKET_SIZES[bucket]) - offsets
+
+        return [from_microseconds(start).astimezone(here_tz) for start in starts.tolist()]
+
+    def totals(self, bucket=None, by_package=False, here_tz=None, previous=None):
+        '''
+        Trims the samples against each other and returns screen-on and screen-off
+        totals (milliseconds) and the number of trimmed samples, keyed by
+        (package, bucket). Each part of the key is None unless requested.
+        '''
+
+        durations, was_trimmed = trimmed_durations(self.created, self.durations, previous)
+
+        packages = [None] * len(self)
+        buckets = [None] * len(self)
+
+        if by_package:
+            packages = self.packages.tolist()
+
+        if bucket is not None:
+            buckets = self.bucket_keys(bucket, here_tz)
+
+        return self.group_totals(list(zip(packages, buckets)), durations, was_trimmed)
+
+    def group_totals(self, keys, durations, was_trimmed):
+        # Sums the trimmed durations and trimmed counts of the samples sharing each key.
+
+        index = {}
+
+        for key in keys:
+            if (key in index) is False:
+                index[key] = len(index)
+
+        groups = numpy.array([index[key] for key in keys], dtype=numpy.int64)
+
+        on_totals = numpy.zeros(len(index), dtype=numpy.float64)
+        off_totals = numpy.zeros(len(index), dtype=numpy.float64)
+        trimmed_counts = numpy.zeros(len(index), dtype=numpy.int64)
+
+        # numpy.add.at accumulates element by element in sample order, so each total equals the
+        # sequential sum.
+
+        on_mask = self.screen_on()
+        off_mask = self.screen_off()
+
+        numpy.add.at(on_totals, groups[on_mask], durations[on_mask])
+        numpy.add.at(off_totals, groups[off_mask], durations[off_mask])
+        numpy.add.at(trimmed_counts, groups, was_trimmed.astype(numpy.int64))
+
+        results = {}
+
+        for key, position in index.items():
+            results[key] = {
+                'on': float(on_totals[position]),
+                'off': float(off_totals[position]),
+                'trimmed': int(trimmed_counts[position]),
+            }
+
+        return results
+
+    def screen_time(self):
+        # Screen-on total, where every sample (on or off) counts as the previous sample.
+
+        if len(self) == 0: # pylint: disable=len-as-condition
+            return 0
+
+        durations = trimmed_durations(self.created, self.durations)[0]
+
+        return ordered_sum(durations[self.screen_on()])
+
+
+def screen_time_for_points(points):
+    return ForegroundSamples.from_points(points).screen_time()
+
+
+def iterative_screen_time(points):
+    # Point-by-point reference implementation, kept for equivalence checks and benchmarks.
+
+    duration = 0
+
+    last_seen = None
+
+    for point in points.order_by('created', 'pk'):
+        payload = point.fetch_properties()
+
+        if ('duration' in payload) and ('screen_active' in payload) and payload['screen_active']:
+            if last_seen is None:
+                duration += payload['duration']
+            elif (point.created - last_seen).total_seconds() * 1000 < payload['duration']:
+                duration += (point.created - last_seen).total_seconds() * 1000
+            else:
+                duration += payload['duration']
+
+        last_seen = point.created
+
+    return duration
+
+
+def local_day_bounds(dates, here_tz):
+    '''
+    Returns (date, start, end) for each date, with start and end as integer
+    microseconds since the epoch for local midnight in here_tz. Local midnights
+    are resolved individually, so days spanning DST transitions are 23 or 25
+    hours long.
+    '''
+
+    bounds = []
+
+    for date in dates:
+        start = arrow.get(datetime.datetime(date.year, date.month, date.day, 0, 0, 0, 0), here_tz)
+        end = start.shift(days=1)
+
+        bounds.append((date, to_microseconds(start.datetime), to_microseconds(end.datetime),))
+
+    return bounds
+
+
+def day_slices(samples, bounds):
+    for date, start, end in bounds:
+        first = numpy.searchsorted(samples.created, start, side='left')
+        last = numpy.searchsorted(samples.created, end, side='left')
+
+        yield date, samples.subset(slice(first, last))
+
+
+def screen_time_by_day(samples, bounds):
+    '''
+    Splits samples into the given local days and computes each day's screen
+    time independently, as fetch_usage_for_date does for a single day.
+    '''
+
+    usages = {}
+
+    for date, day_samples in day_slices(samples, bounds):
+        usages[date] = day_samples.screen_time()
+
+    return usages
+
+
+def hourly_screen_time(samples, bounds, local_days):
+    '''
+    Splits samples into the given local days and returns each day's screen
+    time by local hour (in the zone the LocalDayIndex local_days places the
+    day in), as {date: [24 hourly totals]}.
+    '''
+
+    hourly = {}
+
+    for date, day_samples in day_slices(samples, bounds):
+        here_tz = pytz.timezone(local_days.zone_for(date))
+
+        hours = [0.0] * 24
+
+        for key, totals in day_samples.totals(bucket='hour', here_tz=here_tz).items():
+            hours[key[1].astimezone(here_tz).hour] += totals['on']
+
+        hourly[date] = hours
+
+    return hourly
+
+
+def latest_recorded_by_day(samples, bounds):
+    latest = {}
+
+    for date, day_samples in day_slices(samples, bounds):
+        latest[date] = None
+
+        if len(day_samples) > 0: # pylint: disable=len-as-condition
+            latest[date] = from_microseconds(day_samples.recorded.max())
+
+    return latest
@@ -1,6 +1,1236 @@
 # -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, no-member, too-many-lines
 from __future__ import unicode_literals
 
-# from django.test import TestCase
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+import arrow
+import numpy
+import pytz
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from passive_data_kit.generators.pdk_foreground_application import fetch_app_genre
+from passive_data_kit.models import DataPoint, DataGeneratorDefinition, DataSource, DataSourceReference
+
+from .data_quality import CohortMetrics, compile_performance_report, report_sections
+from .export_cache import ExportCache
+from .export_formats import ColumnarWriter, load_columnar_report, report_writer
+from .export_joins import as_of_join
+from .export_parallel import compile_parallel
+from .export_pipeline import full_export_rows
+from .export_watermarks import WatermarkTracker
+from .federation import FederationClient
+from .management.commands import update_participant_data_quality
+from .management.commands.study_federation_stub_server import stub_handler
+from .local_days import LocalDayIndex
+from .models import ExportWatermark, HourlyUsageRollup, MinuteUsageRollup, Participant, TimezoneSpan, TreatmentPhase
+from .pdk_api import compile_report
+from .point_streams import stream_points
+from .screen_time import ForegroundSamples, from_microseconds, iterative_screen_time, local_day_bounds, screen_time_by_day, screen_time_for_points
+from .usage_rollups import fetch_minute_rollups
+
+TEST_SOURCE = 'study-support-test'
+
+def create_point(generator_identifier, created, recorded, properties, source=TEST_SOURCE):
+    properties = dict(properties)
+
+    properties['passive-data-metadata'] = {
+        'generator': 'Phone Dashboard/33 Passive Data Kit/1.0 (Android 9 SDK 28; samsung SM-G973U)',
+        'generator-id': generator_identifier,
+        'source': source,
+        'timezone': 'America/New_York',
+    }
+
+    return DataPoint.objects.create(source=source, generator=generator_identifier, generator_identifier=generator_identifier, created=created, recorded=recorded, properties=properties, source_reference=DataSourceReference.reference_for_source(source), generator_definition=DataGeneratorDefinition.definition_for_identifier(generator_identifier))
+
+
+def nested_loop_export_rows(source, points): # pylint: disable=too-many-locals, too-many-branches
+    # The nyu-full-export rows as the original implementation built them: whole streams loaded
+    # into lists, and each context stream scanned from the start for every foreground row.
+
+    streams = {}
+
+    for generator_identifier in ('pdk-foreground-application', 'pdk-system-status', 'pdk-device-battery', 'pdk-user',):
+        generator_points = points.filter(generator_definition=DataGeneratorDefinition.definition_for_identifier(generator_identifier)).order_by('created', 'pk')
+
+        streams[generator_identifier] = [(point.created, point.recorded, point.fetch_properties(),) for point in generator_points]
+
+    rows = []
+
+    last_seen = None
+
+    for point in streams['pdk-foreground-application']:
+        if last_seen == point[0]:
+            continue
+
+        here_tz = pytz.timezone(point[2]['passive-data-metadata']['timezone'])
+
+        row = [source, point[0].astimezone(here_tz).isoformat(), point[1].astimezone(here_tz).isoformat(), point[2]['passive-data-metadata']['timezone'], point[2]['passive-data-metadata']['generator'].split(';')[-1].strip().replace(')', '')]
+
+        if last_seen is not None and (point[0] - last_seen).total_seconds() * 1000 < point[2]['duration']:
+            row.append((point[0] - last_seen).total_seconds() * 1000)
+        else:
+            row.append(point[2]['duration'])
+
+        if 'application' in point[2]:
+            row.extend([point[2]['application'], fetch_app_genre(point[2]['application'])])
+        else:
+            row.extend(['', ''])
+
+        row.append(1 if point[2]['screen_active'] else 0)
+
+        latest = {}
+
+        for generator_identifier in ('pdk-system-status', 'pdk-device-battery', 'pdk-user',):
+            latest[generator_identifier] = None
+
+            for context_point in streams[generator_identifier]:
+                if context_point[0] < point[0]:
+                    latest[generator_identifier] = context_point
+                else:
+                    break
+
+        last_status = latest['pdk-system-status']
+
+        if last_status is not None:
+            row.extend([last_status[2].get('system_runtime', None), last_status[2]['runtime']])
+        else:
+            row.extend([None, None])
+
+        last_battery = latest['pdk-device-battery']
+
+        if last_battery is not None:
+            row.append(100.0 * (float(last_battery[2]['level']) / float(last_battery[2]['scale'])))
+        else:
+            row.append(None)
+
+        last_user = latest['pdk-user']
+
+        if last_user is not None and ('mode' in last_user[2]):
+            row.append(last_user[2]['mode'])
+        else:
+            row.append(None)
+
+        rows.append(row)
+
+        last_seen = point[0]
+
+    return rows
+
+
+def read_report(generator, sources, **options):
+    # Compiles a report in this process as TSV and returns its rows, header first.
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        filename = compile_report(generator, sources, workers=1, output_format='tsv', compression=None, **options)
+
+    try:
+        with open(filename, 'r', encoding='utf-8', newline='') as report_file:
+            return list(csv.reader(report_file, delimiter='\t'))
+    finally:
+        os.remove(filename)
+
+
+def compile_test_shard(generator, sources, **options): # pylint: disable=unused-argument
+    handle, filename = tempfile.mkstemp(suffix='.txt')
+
+    with os.fdopen(handle, 'w', encoding='utf-8') as shard:
+        shard.write('Source\tValue\n')
+
+        for source in sources:
+            if source != 'empty':
+                shard.write('%s\t%s\n' % (source, generator))
+
+    return filename
+
+
+def compile_tracked_shard(generator, sources, shard=False, watermarks=None, export_cache=None, **options):
+    # Leaves a pending watermark and a cache lookup for each source, as compile_report does.
+
+    for source in sources:
+        watermarks.pending[source] = shard
+        export_cache.hits['genre'] += 1
+
+    return compile_test_shard(generator, sources, **options)
+
+
+class IncrementalFullExportTests(TestCase):
+    def setUp(self):
+        self.start = datetime.datetime(2026, 3, 1, 12, 0, tzinfo=pytz.utc)
+
+        for index in range(0, 12):
+            created = self.start + datetime.timedelta(seconds=60 * index)
+
+            # Recorded out of creation order, as uploads arrive in bundles.
+
+            recorded = self.start + datetime.timedelta(hours=1, seconds=60 * ((index * 5) % 12))
+
+            create_point('pdk-foreground-application', created, recorded, {
+                'duration': 90000 if index % 3 == 0 else 30000,
+                'screen_active': index % 4 != 0,
+            })
+
+            create_point('pdk-system-status', created - datetime.timedelta(seconds=25), recorded, {
+                'runtime': index * 1000,
+                'system_runtime': index * 2000,
+            })
+
+            if index % 5 == 0:
+                create_point('pdk-device-battery', created - datetime.timedelta(seconds=40), recorded, {
+                    'level': 50 + index,
+                    'scale': 100,
+                })
+
+        create_point('pdk-user', self.start - datetime.timedelta(days=1), self.start, {
+            'mode': 'normal',
+        })
+
+        self.points = DataPoint.objects.filter(source_reference=DataSourceReference.reference_for_source(TEST_SOURCE))
+
+    def assert_matches_full_export(self, field, column, after):
+        full_rows = list(full_export_rows(TEST_SOURCE, self.points))
+
+        expected = [row for row in full_rows if arrow.get(row[column]) > after]
+
+        incremental_rows = list(full_export_rows(TEST_SOURCE, self.points, after=after, field=field))
+
+        self.assertTrue(0 < len(expected) < len(full_rows))
+        self.assertEqual(incremental_rows, expected)
+
+        # The first incremental row still has its context columns and a trimmed duration.
+
+        self.assertIsNotNone(incremental_rows[0][9])
+        self.assertIsNotNone(incremental_rows[0][11])
+
+    def test_created_watermark(self):
+        self.assert_matches_full_export('created', 1, self.start + datetime.timedelta(seconds=60 * 6))
+
+    def test_recorded_watermark(self):
+        self.assert_matches_full_export('recorded', 2, self.start + datetime.timedelta(hours=1, seconds=60 * 5))
+
+    def test_nothing_new(self):
+        self.assertEqual(list(full_export_rows(TEST_SOURCE, self.points, after=self.start + datetime.timedelta(days=1))), [])
+
+    def test_shard_leaves_watermarks(self):
+        DataSource.objects.create(identifier=TEST_SOURCE, name=TEST_SOURCE)
+
+        watermarks = WatermarkTracker('nyu-full-export', incremental=True)
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            filename = compile_report('nyu-full-export', [TEST_SOURCE], shard=True, watermarks=watermarks, output_format='tsv', compression=None)
+
+        self.addCleanup(os.remove, filename)
+
+        with open(filename, 'r', encoding='utf-8') as shard_file:
+            self.assertEqual(len(shard_file.read().splitlines()), 1 + 12)
+
+        # A shard neither saves its watermarks nor prints statistics; that is left to the parent.
+
+        self.assertEqual(output.getvalue(), '')
+        self.assertFalse(ExportWatermark.objects.exists())
+
+        watermarks.save()
+
+        self.assertEqual(ExportWatermark.objects.get(generator='nyu-full-export', source=TEST_SOURCE).position, self.start + datetime.timedelta(seconds=60 * 11))
+
+
+class ExportQueryTests(TestCase):
+    def setUp(self):
+        self.start = datetime.datetime(2026, 3, 1, 12, 0, tzinfo=pytz.utc)
+        self.sources = ['export-query-a', 'export-query-b']
+
+        for source in self.sources:
+            DataSource.objects.create(identifier=source, name=source)
+
+        # Generator definitions are created on first use, so they exist before anything is counted.
+
+        for generator_identifier in ('pdk-foreground-application', 'pdk-system-status', 'pdk-device-battery', 'pdk-user',):
+            DataGeneratorDefinition.definition_for_identifier(generator_identifier)
+
+    def add_points(self, first, last):
+        for source in self.sources:
+            for index in range(first, last):
+                created = self.start + datetime.timedelta(seconds=60 * index)
+
+                create_point('pdk-foreground-application', created, created, {'duration': 90000, 'screen_active': index % 3 != 0, 'application': 'com.example.app%d' % (index % 4)}, source=source)
+                create_point('pdk-system-status', created - datetime.timedelta(seconds=20), created, {'runtime': index * 1000, 'system_runtime': index * 2000}, source=source)
+
+    def export(self):
+        return read_report('nyu-full-export', self.sources)
+
+    def test_queries_flat_across_rows(self):
+        self.add_points(0, 5)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.export()), 1 + 2 * 5)
+
+        # Four times the rows, still within one page per stream, take the same queries.
+
+        self.add_points(5, 20)
+
+        with self.assertNumQueries(len(queries.captured_queries)):
+            self.assertEqual(len(self.export()), 1 + 2 * 20)
+
+    def test_matches_list_building(self):
+        self.add_points(0, 12)
+
+        create_point('pdk-device-battery', self.start + datetime.timedelta(seconds=150), self.start, {'level': 40, 'scale': 50}, source=self.sources[1])
+
+        expected = []
+
+        for source in self.sources:
+            for row in nested_loop_export_rows(source, DataPoint.objects.filter(source=source)):
+                expected.append(['' if value is None else str(value) for value in row])
+
+        self.assertEqual(self.export()[1:], expected)
+
+
+class ViolatorUsageTests(TestCase):
+    def setUp(self):
+        Participant.objects.create(identifier='violator-test', email_address='violator@example.com', created=timezone.now())
+        DataSource.objects.create(identifier='violator-test', name='violator-test')
+
+        # Inside the 12 hours before the top of the current hour.
+
+        recorded = timezone.now() - datetime.timedelta(hours=2)
+        start = recorded - datetime.timedelta(hours=1)
+
+        samples = [
+            (0, 'com.facebook.katana', True,),
+            (10, 'com.facebook.lite', True,), # Another package, so not cut by the sample before.
+            (20, 'com.instagram.android', False,), # Screen off, so ignored.
+            (30, 'com.snapchat.android', True,),
+            (60, 'com.snapchat.android', True,), # Cut to 30 seconds.
+            (70, 'com.example.other', True,),
+        ]
+
+        for offset, package, screen_active in samples:
+            point = create_point('pdk-foreground-application', start + datetime.timedelta(seconds=offset), recorded, {'duration': 60000, 'screen_active': screen_active}, source='violator-test')
+
+            point.secondary_identifier = package
+            point.save()
+
+        self.start = start.astimezone(pytz.timezone(settings.TIME_ZONE))
+
+    def moment(self, seconds):
+        return (self.start + datetime.timedelta(seconds=seconds)).isoformat()
+
+    def test_default_families(self):
+        rows = read_report('nyu-violator-usage', ['violator-test'])
+
+        # The original columns, with Snapchat's overlapping samples now trimmed like the others.
+
+        self.assertEqual(rows[0], ['Participant', 'Facebook Usage', 'Instagram Usage', 'Snapchat Usage', 'First Use', 'Last Use', 'Monitor Start', 'Monitor End', 'Facebook Start', 'Facebook End', 'Instagram Start', 'Instagram End', 'Snapchat Start', 'Snapchat End'])
+
+        self.assertEqual(rows[1][:6], ['violator-test', '2.0', '0.0', '1.5', self.moment(0), self.moment(60)])
+        self.assertEqual(rows[1][8:], [self.moment(0), self.moment(10), '', '', self.moment(30), self.moment(60)])
+
+    @override_settings(PD_VIOLATOR_APP_FAMILIES=[('Meta', ['com.instagram.android', 'com.facebook.lite', 'com.facebook.katana']), ('Other', ['com.example.other'])])
+    def test_configured_families(self):
+        rows = read_report('nyu-violator-usage', ['violator-test'])
+
+        self.assertEqual(rows[0][:3], ['Participant', 'Meta Usage', 'Other Usage'])
+        self.assertEqual(rows[0][7:], ['Meta Start', 'Meta End', 'Other Start', 'Other End'])
+
+        self.assertEqual(rows[1][:5], ['violator-test', '2.0', '1.0', self.moment(0), self.moment(70)])
+        self.assertEqual(rows[1][7:], [self.moment(0), self.moment(10), self.moment(70), self.moment(70)])
+
+
+class StreamPointsTests(TestCase):
+    def setUp(self):
+        start = datetime.datetime(2026, 3, 1, 12, 0, tzinfo=pytz.utc)
+
+        # Five points share a created time, so pages of three split the tie.
+
+        for seconds in [0, 60, 60, 60, 60, 60, 120]:
+            created = start + datetime.timedelta(seconds=seconds)
+
+            create_point('pdk-foreground-application', created, start - datetime.timedelta(seconds=seconds), {})
+
+        self.points = DataPoint.objects.filter(source=TEST_SOURCE)
+
+    def test_ties_across_pages(self):
+        expected = list(self.points.order_by('created', 'pk').values_list('pk', flat=True))
+
+        with self.assertNumQueries(3):
+            streamed = [point.pk for point in stream_points(self.points, batch_size=3)]
+
+        self.assertEqual(streamed, expected)
+
+        descending = [point.pk for point in stream_points(self.points, batch_size=3, descending=True)]
+
+        self.assertEqual(descending, list(reversed(expected)))
+
+    def test_other_field(self):
+        expected = list(self.points.order_by('recorded', 'pk').values_list('pk', flat=True))
+
+        self.assertEqual([point.pk for point in stream_points(self.points, field='recorded', batch_size=2)], expected)
+
+
+class AsOfJoinTests(SimpleTestCase):
+    def join(self, primary, context):
+        return [(item[0], joined['context'],) for item, joined in as_of_join(primary, context=context)]
+
+    def test_exact_match_excluded(self):
+        # Context items created at the same instant as the primary item are not yet in effect.
+
+        primary = [(10, 10, 'a',), (20, 20, 'b',)]
+        context = [(5, 5, 'x',), (10, 10, 'y',), (20, 20, 'z',)]
+
+        self.assertEqual(self.join(primary, context), [(10, (5, 5, 'x',),), (20, (10, 10, 'y',),)])
+
+    def test_before_first_context(self):
+        primary = [(1, 1, 'a',), (3, 3, 'b',)]
+        context = [(2, 2, 'x',)]
+
+        self.assertEqual(self.join(primary, context), [(1, None,), (3, (2, 2, 'x',),)])
+
+    def test_equal_timestamp_ties(self):
+        # Among context items sharing a timestamp, the last in stream order wins, and primary
+        # items sharing a timestamp see the same context.
+
+        primary = [(5, 5, 'a',), (5, 5, 'b',), (9, 9, 'c',)]
+        context = [(4, 4, 'x',), (4, 4, 'y',), (9, 9, 'z',)]
+
+        self.assertEqual(self.join(primary, context), [(5, (4, 4, 'y',),), (5, (4, 4, 'y',),), (9, (4, 4, 'y',),)])
+
+    def test_empty_context(self):
+        self.assertEqual(self.join([(1, 1, 'a',)], []), [(1, None,)])
+
+
+class FullExportJoinTests(TestCase):
+    def setUp(self):
+        start = datetime.datetime(2026, 3, 1, 12, 0, tzinfo=pytz.utc)
+
+        def moment(seconds):
+            return start + datetime.timedelta(seconds=seconds)
+
+        for seconds, duration in ((0, 30000,), (60, 90000,), (120, 30000,), (120, 45000,), (180, 30000,), (300, 60000,)):
+            create_point('pdk-foreground-application', moment(seconds), moment(seconds + 30), {
+                'application': 'com.example.app%d' % (seconds % 2),
+                'duration': duration,
+                'screen_active': seconds != 180,
+            })
+
+        # Created with a foreground row (so not yet in effect for it), tied with each other, and
+        # without system_runtime.
+
+        create_point('pdk-system-status', moment(60), moment(90), {'runtime': 1000, 'system_runtime': 2000})
+        create_point('pdk-system-status', moment(110), moment(130), {'runtime': 3000, 'system_runtime': 4000})
+        create_point('pdk-system-status', moment(110), moment(130), {'runtime': 5000, 'system_runtime': 6000})
+        create_point('pdk-system-status', moment(240), moment(250), {'runtime': 7000})
+
+        # Starts after the first foreground rows.
+
+        create_point('pdk-device-battery', moment(150), moment(160), {'level': 40, 'scale': 50})
+        create_point('pdk-device-battery', moment(300), moment(310), {'level': 30, 'scale': 50})
+
+        create_point('pdk-user', moment(90), moment(100), {'mode': 'normal'})
+        create_point('pdk-user', moment(210), moment(220), {})
+
+        self.points = DataPoint.objects.filter(source_reference=DataSourceReference.reference_for_source(TEST_SOURCE))
+
+    def test_context_matches_reference(self):
+        rows = list(full_export_rows(TEST_SOURCE, self.points))
+        expected = nested_loop_export_rows(TEST_SOURCE, self.points)
+
+        self.assertEqual([row[9:] for row in rows], [row[9:] for row in expected])
+
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0][9:], [None, None, None, None])
+        self.assertEqual(rows[1][9:], [None, None, None, None])
+        self.assertEqual(rows[2][9:], [6000, 5000, None, 'normal'])
+        self.assertEqual(rows[3][9:], [6000, 5000, 80.0, 'normal'])
+        self.assertEqual(rows[4][9:], [None, 7000, 80.0, None])
+
+    @override_settings(PD_EXPORT_BATCH_SIZE=2)
+    def test_rows_match_across_pages(self):
+        # Whole rows (times, trimmed durations, apps, genres and context) match the list-building
+        # export when every stream is read in pages of two, splitting the tied points.
+
+        expected = nested_loop_export_rows(TEST_SOURCE, self.points)
+
+        self.assertEqual([row[5] for row in expected], [30000, 60000.0, 30000, 30000, 60000])
+
+        self.assertEqual(list(full_export_rows(TEST_SOURCE, self.points)), expected)
+
+
+class CompileParallelTests(SimpleTestCase):
+    def compile(self, sources, compile_function=compile_test_shard, **options):
+        handle, filename = tempfile.mkstemp(suffix='.txt')
+        os.close(handle)
+
+        self.addCleanup(os.remove, filename)
+
+        self.assertEqual(compile_parallel(compile_function, filename, 'test-generator', sources, workers=2, **options), filename)
+
+        with open(filename, 'r', encoding='utf-8') as merged:
+            return merged.read().splitlines()
+
+    def test_merges_in_source_order(self):
+        self.assertEqual(self.compile(['b', 'empty', 'a']), ['Source\tValue', 'a\ttest-generator', 'b\ttest-generator'])
+
+    def test_header_without_shards(self):
+        self.assertEqual(self.compile([]), ['Source\tValue'])
+
+    def test_merges_shard_state(self):
+        watermarks = WatermarkTracker('nyu-full-export', incremental=True)
+        export_cache = ExportCache()
+
+        self.assertEqual(self.compile(['b', 'a'], compile_tracked_shard, watermarks=watermarks, export_cache=export_cache), ['Source\tValue', 'a\ttest-generator', 'b\ttest-generator'])
+
+        # Each shard ran with shard=True on its own copies, which were merged back in the parent.
+
+        self.assertEqual(watermarks.pending, {'a': True, 'b': True})
+        self.assertEqual(export_cache.hits['genre'], 2)
+
+
+class ColumnarReportTests(SimpleTestCase):
+    columns = ['Source', 'Date Created', 'Date', 'Duration', 'Screen Active', 'Foreground App', 'Notes']
+
+    rows = [
+        ['source-a', '2026-03-01T07:00:00-05:00', '2026-03-01', 0, 1, 'com.example.one', 'first'],
+        ['source-a', '2026-03-01T08:30:15.250000-05:00', '2026-03-01', None, 0, None, None],
+        ['source-b', '2026-06-01T09:00:00+02:00', '', 1500.5, None, 'com.example.two', ''],
+        ['source-b', None, '2026-06-02', '', 1, 'com.example.one', 'last'],
+        ['source-a', '2026-06-02T00:00:00+00:00', '2026-06-02', 42, 0, 'com.example.two'],
+    ]
+
+    def export(self, output_format):
+        handle, filename = tempfile.mkstemp(suffix='.' + output_format)
+        os.close(handle)
+
+        self.addCleanup(os.remove, filename)
+
+        if output_format == 'columnar':
+            writer = ColumnarWriter(filename, chunk_size=2) # Several chunks, sharing category codes.
+
+            writer.writerow(self.columns)
+            writer.writerows(self.rows)
+            writer.close()
+        else:
+            with report_writer(filename, output_format) as writer:
+                writer.writerow(self.columns)
+                writer.writerows(self.rows)
+
+        return filename
+
+    def columnar_text(self, columns, column, index): # pylint: disable=too-many-return-statements
+        # Renders a loaded columnar value the way the TSV writer writes it.
+
+        value = columns[column][index]
+
+        if column == 'Date Created':
+            if numpy.isnat(value):
+                return ''
+
+            offset = datetime.timedelta(minutes=int(columns['Date Created UTC Offset'][index]))
+
+            return (value.astype(datetime.datetime) + offset).replace(tzinfo=datetime.timezone(offset)).isoformat()
+
+        if column == 'Date':
+            return '' if numpy.isnat(value) else str(value)
+
+        if column == 'Duration':
+            return '' if columns['Duration Missing'][index] else float(value)
+
+        if column == 'Screen Active':
+            return '' if value < 0 else str(value)
+
+        return str(value)
+
+    def test_round_trip_matches_tsv(self):
+        with open(self.export('tsv'), 'r', encoding='utf-8', newline='') as tsv_file:
+            tsv_rows = list(csv.reader(tsv_file, delimiter='\t'))
+
+        columns = load_columnar_report(self.export('columnar'))
+
+        self.assertEqual(tsv_rows[0], self.columns)
+
+        for index, tsv_row in enumerate(tsv_rows[1:]):
+            for column, text in zip(self.columns, tsv_row + [''] * (len(self.columns) - len(tsv_row))):
+                if column == 'Duration' and text != '':
+                    text = float(text)
+
+                self.assertEqual(self.columnar_text(columns, column, index), text, '%s, row %d' % (column, index))
+
+    def test_missing_numbers_masked(self):
+        columns = load_columnar_report(self.export('columnar'))
+
+        self.assertEqual(columns['Duration Missing'].tolist(), [False, True, False, True, False])
+        self.assertEqual(columns['Duration'][0], 0.0)
+
+
+class FederationClientTests(SimpleTestCase):
+    def start_stub(self, **options):
+        stub_options = {
+            'latency': 0.0,
+            'jitter': 0.0,
+            'failure_rate': 0.0,
+            'hang_rate': 0.0,
+            'hang': 0.0,
+        }
+
+        stub_options.update(options)
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), stub_handler(stub_options))
+        server.daemon_threads = True
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        return SimpleNamespace(name='stub', source_metadata_url='http://127.0.0.1:%d/' % server.server_address[1], request_key='stub')
+
+    def fetch(self, server, count, **client_options):
+        client = FederationClient(**client_options)
+
+        try:
+            start = time.monotonic()
+
+            results = client.fetch_reports([('stub-%d' % index, server,) for index in range(0, count)])
+
+            return results, time.monotonic() - start
+        finally:
+            client.close()
+
+    def test_fetches_reports(self):
+        results, elapsed = self.fetch(self.start_stub(latency=0.05), 12, concurrency=4, per_server=4, deadline=5, retries=0) # pylint: disable=unused-variable
+
+        self.assertEqual([result.identifier for result in results], ['stub-%d' % index for index in range(0, 12)])
+
+        for result in results:
+            self.assertTrue(result.succeeded())
+            self.assertEqual(result.report['group'], 'Stub')
+            self.assertEqual(result.attempts, 1)
+
+    def test_retries_server_errors(self):
+        results, elapsed = self.fetch(self.start_stub(failure_rate=1.0), 3, deadline=5, retries=2, backoff=0.01) # pylint: disable=unused-variable
+
+        for result in results:
+            self.assertFalse(result.succeeded())
+            self.assertEqual(result.error, 'Server code 503')
+            self.assertEqual(result.attempts, 3)
+
+    def test_enforces_deadline(self):
+        # Responses trickled too slowly for any single read to time out are abandoned at the
+        # deadline, and fetch_reports returns without waiting for their threads.
+
+        results, elapsed = self.fetch(self.start_stub(hang_rate=1.0, hang=4.0), 4, concurrency=4, per_server=4, deadline=0.5, retries=1, backoff=0.01)
+
+        self.assertLess(elapsed, 2.5)
+
+        for result in results:
+            self.assertFalse(result.succeeded())
+            self.assertEqual(result.error, 'Timed out after 0.5 seconds')
+            self.assertEqual(result.attempts, 2)
+
+
+class ReportSectionsTests(SimpleTestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2026, 3, 2, 18, 0, tzinfo=pytz.utc)
+
+    def participant(self, changes, updated):
+        return Participant(identifier='sections-test', performance_report='{}', performance_last_updated=updated, performance_changes=changes)
+
+    def test_unchanged_rebuilt(self):
+        self.assertIsNone(report_sections(self.participant(None, self.now - datetime.timedelta(hours=1)), self.now))
+
+    def test_activity_in_part(self):
+        self.assertEqual(report_sections(self.participant('activity', self.now - datetime.timedelta(hours=1)), self.now), ('activity',))
+
+    def test_phase_recomputes_activity(self):
+        # Recency fields are never left as they were in the earlier report.
+
+        self.assertIsNone(report_sections(self.participant('phase', self.now - datetime.timedelta(hours=1)), self.now))
+
+    def test_earlier_day_rebuilt(self):
+        self.assertIsNone(report_sections(self.participant('activity', self.now - datetime.timedelta(days=1)), self.now))
+
+
+class CohortMetricsTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+
+        self.participants = []
+
+        for index in range(0, 3):
+            identifier = 'cohort-test-%d' % index
+
+            participant = Participant.objects.create(email_address='%s@example.com' % identifier, identifier=identifier, created=self.now)
+
+            DataSource.objects.create(identifier=identifier, name=identifier)
+
+            TreatmentPhase.objects.create(participant=participant, start_date=self.now.date() - datetime.timedelta(days=3), blocker_type='costly_snooze', treatment_active=True)
+
+            # index + 1 foreground points in the last day, two the day before.
+
+            for hours in list(range(1, index + 2)) + [30, 40]:
+                self.create(identifier, 'pdk-foreground-application', hours, {'duration': 60000, 'screen_active': True})
+
+            for hours in range(0, index):
+                self.create(identifier, 'app-snooze', hours + 2, {})
+
+            self.participants.append(participant)
+
+        self.create('cohort-test-0', 'pdk-app-event', 5, {'event_details': {'snooze-cost': 5}, 'observed': 0}, secondary_identifier='set-snooze-cost')
+        self.create('cohort-test-1', 'daily-app-budget', 6, {'budget': json.dumps({'com.example.app': 3600000})})
+
+    def create(self, identifier, generator_identifier, hours, properties, secondary_identifier=None):
+        created = self.now - datetime.timedelta(hours=hours)
+
+        point = create_point(generator_identifier, created, created, properties, source=identifier)
+
+        point.secondary_identifier = secondary_identifier
+        point.save()
+
+    def test_matches_single_reports(self):
+        with CaptureQueriesContext(connection) as single:
+            CohortMetrics(self.participants[:1], self.now)
+
+        # The whole cohort takes the queries one participant does.
+
+        with self.assertNumQueries(len(single.captured_queries)):
+            cohort = CohortMetrics(self.participants, self.now)
+
+        for index, participant in enumerate(self.participants):
+            reference = cohort.reference(participant.identifier)
+
+            self.assertEqual(cohort.observed(reference), (index + 1, 2,))
+            self.assertEqual(cohort.snoozes_since(reference, self.now.date() - datetime.timedelta(days=3)), index)
+
+            self.assertEqual(compile_performance_report(participant, self.now, cohort), compile_performance_report(participant, self.now))
+
+        report = compile_performance_report(self.participants[1], self.now, cohort)
+
+        self.assertEqual(report['phase_budget'], {'com.example.app': 3600000})
+        self.assertTrue(report['phase_snooze_cost_overdue'])
+        self.assertEqual(compile_performance_report(self.participants[0], self.now, cohort)['phase_snooze_cost_count'], 1)
+
+
+def create_participants(count, prefix='queue-test'):
+    for index in range(0, count):
+        Participant.objects.create(email_address='%s-%d@example.com' % (prefix, index), identifier='%s-%d' % (prefix, index), created=timezone.now())
+
+
+class ParticipantQueueTests(TestCase):
+    def test_queues_claim_different(self):
+        # Two queues started together, as by two processes, never compile the same participant.
+
+        create_participants(2)
+
+        first = update_participant_data_quality.ParticipantQueue(None)
+        second = update_participant_data_quality.ParticipantQueue(None)
+
+        self.assertTrue(first.process_next())
+
+        claimed = set(Participant.objects.exclude(performance_last_updated=None).values_list('identifier', flat=True))
+
+        self.assertTrue(second.process_next())
+
+        self.assertEqual(Participant.objects.filter(performance_last_updated=None).count(), 0)
+        self.assertEqual(Participant.objects.filter(identifier__in=claimed).count(), 1)
+
+        self.assertFalse(first.process_next())
+        self.assertFalse(second.process_next())
+
+    def test_command_runs_unlocked(self):
+        create_participants(3)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('update_participant_data_quality', limit=2)
+            call_command('update_participant_data_quality', limit=0)
+
+        self.assertEqual(Participant.objects.filter(performance_last_updated=None).count(), 0)
+
+
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+class ParticipantQueueLockTests(TransactionTestCase):
+    def test_skips_locked_participant(self):
+        # While one worker holds its participant's row lock, another worker (on its own
+        # connection, like another process) claims the other participant.
+
+        create_participants(2)
+
+        holding = threading.Event()
+        release = threading.Event()
+
+        claimed = []
+
+        def hold_first(participant, *args, **kwargs):
+            claimed.append(participant.identifier)
+
+            if len(claimed) == 1:
+                holding.set()
+                release.wait(10)
+
+            return compile_performance_report(participant, *args, **kwargs)
+
+        def work(queue):
+            try:
+                queue.process_next()
+            finally:
+                connection.close()
+
+        with mock.patch.object(update_participant_data_quality, 'compile_performance_report', side_effect=hold_first):
+            first = threading.Thread(target=work, args=(update_participant_data_quality.ParticipantQueue(None),))
+            first.start()
+
+            self.assertTrue(holding.wait(10))
+
+            second = threading.Thread(target=work, args=(update_participant_data_quality.ParticipantQueue(None),))
+            second.start()
+            second.join(10)
+
+            release.set()
+            first.join(10)
+
+        self.assertEqual(sorted(claimed), ['queue-test-0', 'queue-test-1'])
+        self.assertEqual(Participant.objects.filter(performance_last_updated=None).count(), 0)
+
+
+class DailyUsageTests(TestCase):
+    def test_empty_today_stays_dirty(self):
+        # A day in progress without points is recomputed on the next request, so points
+        # arriving later in the day are counted.
+
+        participant = Participant.objects.create(email_address='daily-usage@example.com', identifier='daily-usage-test', created=timezone.now())
+
+        local_days = participant.local_days()
+
+        today = local_days.date_for(timezone.now())
+        yesterday = today - datetime.timedelta(days=1)
+
+        self.assertEqual(participant.fetch_usage_for_dates(yesterday, today), {yesterday: 0, today: 0})
+
+        self.assertFalse(participant.daily_usages.get(date=yesterday).dirty)
+        self.assertTrue(participant.daily_usages.get(date=today).dirty)
+
+    def test_closed_days_read_once(self):
+        participant = Participant.objects.create(email_address='daily-usage@example.com', identifier=TEST_SOURCE, created=timezone.now())
+
+        morning = pytz.timezone('America/New_York').localize(datetime.datetime(2026, 3, 2, 10, 0))
+
+        for offset in [0, 30]:
+            create_point('pdk-foreground-application', morning + datetime.timedelta(seconds=offset), morning, {'duration': 60000, 'screen_active': True})
+
+        start = datetime.date(2026, 3, 1)
+        end = datetime.date(2026, 3, 3)
+
+        usages = participant.fetch_usage_for_dates(start, end)
+
+        self.assertEqual(usages, {start: 0, datetime.date(2026, 3, 2): 60000 + 30000, end: 0})
+
+        # The days are stored as table rows, not in the participant's metadata, and read back with one query.
+
+        self.assertEqual(participant.daily_usages.filter(package='', dirty=False).count(), 3)
+        self.assertIsNone(Participant.objects.get(pk=participant.pk).fetch_metadata_section('daily_usages'))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(participant.fetch_usage_for_dates(start, end), usages)
+
+    def test_days_computed_together(self):
+        participant = Participant.objects.create(email_address='daily-usage@example.com', identifier=TEST_SOURCE, created=timezone.now(), timezone='America/New_York')
+
+        here_tz = pytz.timezone('America/New_York')
+
+        # Samples every 40 minutes (some overlapping) from 6 to 11 March, across the 23-hour 8 March.
+
+        first = here_tz.localize(datetime.datetime(2026, 3, 6, 22, 0))
+
+        for index in range(0, 6 * 36):
+            created = first + datetime.timedelta(minutes=40 * index)
+
+            create_point('pdk-foreground-application', created, created + datetime.timedelta(hours=index % 5), {'duration': 1800000 + (index % 4) * 600000, 'screen_active': index % 7 != 0})
+
+        dates = [datetime.date(2026, 3, 7), datetime.date(2026, 3, 8), datetime.date(2026, 3, 10)]
+
+        with CaptureQueriesContext(connection) as one_day:
+            participant.compute_usage_for_dates(dates[:1])
+
+        # Every day costs the same queries as one, and matches the point-by-point calculation on
+        # the points of its own local day (9 March's points are read but not counted).
+
+        with self.assertNumQueries(len(one_day.captured_queries)):
+            usages, latest_recorded, open_dates = participant.compute_usage_for_dates(dates)
+
+        self.assertEqual(open_dates, set())
+
+        for date in dates:
+            day_start = here_tz.localize(datetime.datetime(date.year, date.month, date.day))
+            day_end = here_tz.localize(datetime.datetime(date.year, date.month, date.day) + datetime.timedelta(days=1))
+
+            day_points = DataPoint.objects.filter(source=TEST_SOURCE, created__gte=day_start, created__lt=day_end)
+
+            self.assertEqual(usages[date], iterative_screen_time(day_points), date)
+            self.assertEqual(latest_recorded[date], max(day_points.values_list('recorded', flat=True)), date)
+
+        self.assertEqual(sorted(usages.keys()), dates)
+
+
+class TimezoneSpanTests(TestCase):
+    def setUp(self):
+        self.start = datetime.datetime(2026, 3, 1, 12, 0, tzinfo=pytz.utc)
+
+    def upload(self, hours, time_zone, recorded_hours):
+        point = create_point('pdk-foreground-application', self.start + datetime.timedelta(hours=hours), self.start + datetime.timedelta(hours=recorded_hours), {})
+
+        point.properties['passive-data-metadata']['timezone'] = time_zone
+        point.save()
+
+    def spans(self):
+        return [(int((span.start - self.start).total_seconds() // 3600), span.time_zone, int((span.last_seen - self.start).total_seconds() // 3600),) for span in TimezoneSpan.objects.filter(source=TEST_SOURCE).order_by('start')]
+
+    def test_merges_late_uploads(self):
+        for hours in [0, 2, 3]:
+            self.upload(hours, 'America/New_York', 3)
+
+        self.upload(6, 'America/Chicago', 7)
+
+        self.assertEqual(TimezoneSpan.update_for_source(TEST_SOURCE), 2)
+        self.assertEqual(self.spans(), [(0, 'America/New_York', 3,), (6, 'America/Chicago', 6,)])
+
+        # Uploaded late, but created between spans already recorded.
+
+        self.upload(4, 'America/Los_Angeles', 8)
+
+        self.assertEqual(TimezoneSpan.update_for_source(TEST_SOURCE), 1)
+        self.assertEqual(self.spans(), [(0, 'America/New_York', 3,), (4, 'America/Los_Angeles', 4,), (6, 'America/Chicago', 6,)])
+
+        # A late point inside a span splits it.
+
+        self.upload(1, 'America/Denver', 9)
+
+        self.assertEqual(TimezoneSpan.update_for_source(TEST_SOURCE), 2)
+        self.assertEqual(self.spans(), [(0, 'America/New_York', 0,), (1, 'America/Denver', 1,), (2, 'America/New_York', 3,), (4, 'America/Los_Angeles', 4,), (6, 'America/Chicago', 6,)])
+
+        self.assertEqual(TimezoneSpan.update_for_source(TEST_SOURCE), 0)
+
+        self.assertEqual(TimezoneSpan.index_for(TEST_SOURCE).zone_for(datetime.date(2026, 3, 1)), 'America/New_York')
+
+
+@override_settings(PDK_REQUEST_KEY='test-key')
+class DataQualityViewTests(TestCase):
+    def test_wrapped_report(self):
+        # Federated servers read the report from the same document the metadata used to hold.
+
+        participant = Participant.objects.create(email_address='data-quality@example.com', identifier='data-quality-test', created=timezone.now(), metadata='{"study_participant_status":"active"}')
+
+        participant.update_performance_report({'group': 'Test'})
+
+        response = self.client.post('/data-quality.json', {'identifier': 'data-quality-test', 'request-key': 'test-key'})
+
+        self.assertEqual(response.json(), {'study_participant_status': 'active', 'study_performance_report': {'group': 'Test'}})
+
+    def batch(self, data, **headers):
+        response = self.client.post('/data-quality-batch.json', data, **headers)
+
+        body = b''.join(response.streaming_content)
+
+        if response.get('Content-Encoding', None) == 'gzip':
+            body = gzip.decompress(body)
+
+        return response, json.loads(body.decode('utf-8'))
+
+    def test_batch_rejects_requests(self):
+        self.assertEqual(self.client.post('/data-quality-batch.json', {'identifier': 'batch-1'}).status_code, 403)
+        self.assertEqual(self.client.post('/data-quality-batch.json', {'identifier': 'batch-1', 'request-key': 'wrong'}).status_code, 403)
+        self.assertEqual(self.client.post('/data-quality-batch.json', {'request-key': 'test-key'}).status_code, 400)
+        self.assertEqual(self.client.post('/data-quality-batch.json', {'request-key': 'test-key', 'since': 'yesterday'}).status_code, 400)
+
+    def test_batch_encoding_and_since(self):
+        updated = datetime.datetime(2026, 3, 1, 12, 0, tzinfo=pytz.utc)
+
+        for index in range(0, 3):
+            participant = Participant.objects.create(email_address='batch-%d@example.com' % index, identifier='batch-%d' % index, created=timezone.now())
+
+            participant.update_performance_report({'index': index}, updated=updated + datetime.timedelta(hours=index))
+
+        response, document = self.batch({'identifier': ['batch-0', 'batch-2'], 'request-key': 'test-key'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(document, {'reports': {'batch-0': {'index': 0}, 'batch-2': {'index': 2}}, 'latest_update': (updated + datetime.timedelta(hours=2)).isoformat()})
+
+        # Without gzip in Accept-Encoding, the same document is sent uncompressed.
+
+        response, document = self.batch({'since': (updated + datetime.timedelta(minutes=30)).isoformat(), 'request-key': 'test-key'})
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(sorted(document['reports'].keys()), ['batch-1', 'batch-2'])
+
+        response, document = self.batch({'since': (updated + datetime.timedelta(hours=3)).isoformat(), 'request-key': 'test-key'}, HTTP_ACCEPT_ENCODING='identity')
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(document, {'reports': {}, 'latest_update': None})
+
+
+class UsageHeatmapViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('heatmap-staff', password=None, is_staff=True))
+
+        self.participant = Participant.objects.create(email_address='heatmap@example.com', identifier='heatmap-test', created=timezone.now())
+
+    def test_etag_revalidation(self):
+        response = self.client.get('/usage-heatmap.json', {'participant': 'heatmap-test'})
+
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+
+        self.assertEqual(self.client.get('/usage-heatmap.json', {'participant': 'heatmap-test'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # A different selection, or a new rollup row, changes the ETag.
+
+        self.assertEqual(self.client.get('/usage-heatmap.json', {'participant': 'heatmap-test', 'breakdown': 'participant'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        HourlyUsageRollup.objects.create(participant=self.participant, date=datetime.date(2026, 3, 2), weekday=0, hour=9, usage_ms=60000, computed=timezone.now())
+
+        response = self.client.get('/usage-heatmap.json', {'participant': 'heatmap-test'}, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['heatmap']['usage_ms'][0][9], 60000)
+
+        self.assertEqual(self.client.get('/usage-heatmap.json', {'start': 'March'}).status_code, 400)
+
+
+class MinuteRollupTests(TestCase):
+    def setUp(self):
+        self.local_days = LocalDayIndex([], default_zone='America/New_York')
+        self.dates = [datetime.date(2026, 3, 1), datetime.date(2026, 3, 2), datetime.date(2026, 3, 3)]
+
+        for date in self.dates:
+            start = self.local_days.day_window(date)[0]
+
+            for index in range(0, 3):
+                created = start + datetime.timedelta(hours=10, minutes=index)
+
+                point = create_point('pdk-foreground-application', created, created, {
+                    'application': 'com.example.app',
+                    'duration': 30000,
+                    'screen_active': True,
+                })
+
+                DataPoint.objects.filter(pk=point.pk).update(secondary_identifier='com.example.app')
+
+    def test_reuses_stored_rollups(self):
+        computed = fetch_minute_rollups(TEST_SOURCE, ['com.example.app'], self.dates, self.local_days)
+
+        self.assertEqual(MinuteUsageRollup.objects.filter(source=TEST_SOURCE, dirty=False).count(), 3)
+
+        # Every day is stored and closed, so the whole range is read back with one query.
+
+        with self.assertNumQueries(1):
+            stored = fetch_minute_rollups(TEST_SOURCE, ['com.example.app'], self.dates, self.local_days)
+
+        self.assertEqual(stored, computed)
+
+        for date in self.dates:
+            self.assertEqual(sorted(stored[('com.example.app', date,)].keys()), [600, 601, 602])
+
+
+class ScreenTimeTests(TestCase):
+    def setUp(self):
+        self.here_tz = pytz.timezone('America/New_York')
+
+        # Local days around the start of daylight saving time (8 March 2026 is 23 hours long).
+
+        self.bounds = local_day_bounds([datetime.date(2026, 3, 7), datetime.date(2026, 3, 8), datetime.date(2026, 3, 9)], self.here_tz)
+
+        midnight = self.here_tz.localize(datetime.datetime(2026, 3, 8))
+
+        samples = [
+            (-3600, 30000, True,),
+            (-20, 30000, True,),
+            (-5, 4000, False,),
+            (5, 30000, True,), # Cut to 10 seconds by the screen-off sample, except on its own day.
+            (12.5, 60000, True,), # Overlaps the previous sample, so cut to 7.5 seconds.
+            (13, None, True,), # No duration, but still the previous sample for the next one.
+            (14, 30000, True,), # Cut to 1 second.
+            (86400 - 10, 60000, True,), # Falls on 9 March, as 8 March is 23 hours long.
+            (86400 + 30, 30000, False,),
+            (86400 + 31, 30000, True,), # Cut to 1 second.
+        ]
+
+        for offset, duration, screen_active in samples:
+            created = midnight + datetime.timedelta(seconds=offset)
+
+            properties = {
+                'screen_active': screen_active,
+            }
+
+            if duration is not None:
+                properties['duration'] = duration
+
+            create_point('pdk-foreground-application', created, created, properties)
+
+        self.points = DataPoint.objects.filter(source_reference=DataSourceReference.reference_for_source(TEST_SOURCE))
+
+    def test_matches_iterative(self):
+        self.assertEqual(screen_time_for_points(self.points), iterative_screen_time(self.points))
+        self.assertEqual(iterative_screen_time(self.points), 30000 + 30000 + 10000 + 7500 + 1000 + 60000 + 1000)
+
+    def test_days_match_iterative(self):
+        usages = screen_time_by_day(ForegroundSamples.from_points(self.points), self.bounds)
+
+        for date, start, end in self.bounds:
+            day_points = self.points.filter(created__gte=from_microseconds(start), created__lt=from_microseconds(end))
+
+            self.assertEqual(usages[date], iterative_screen_time(day_points), date)
+
+        # Each day starts untrimmed, so the samples before midnight do not cut the first one after.
+
+        self.assertEqual(usages[datetime.date(2026, 3, 8)], 30000 + 7500 + 1000)
+
+
+    def test_totals_match_loop(self):
+        # Totals by package and local hour match a point-by-point loop over the same trimming rule,
+        # across the skipped hour on 8 March.
+
+        start = self.here_tz.localize(datetime.datetime(2026, 3, 8, 1, 40))
+
+        for index in range(0, 80):
+            properties = {
+                'screen_active': index % 5 != 0,
+            }
+
+            if index % 9 != 4:
+                properties['duration'] = 60000 + (index % 3) * 90000
+
+            point = create_point('pdk-foreground-application', start + datetime.timedelta(seconds=97 * index), start, properties, source='engine-test')
+
+            point.secondary_identifier = 'com.example.app%d' % (index % 2)
+            point.save()
+
+        points = DataPoint.objects.filter(source='engine-test')
+
+        expected = {}
+        last_seen = None
+
+        for point in points.order_by('created', 'pk'):
+            properties = point.fetch_properties()
+
+            key = (point.secondary_identifier, point.created.astimezone(self.here_tz).replace(minute=0, second=0, microsecond=0),)
+
+            totals = expected.setdefault(key, {'on': 0, 'off': 0, 'trimmed': 0})
+
+            if 'duration' in properties:
+                duration = properties['duration']
+
+                if last_seen is not None and (point.created - last_seen).total_seconds() * 1000 < duration:
+                    duration = (point.created - last_seen).total_seconds() * 1000
+
+                    totals['trimmed'] += 1
+
+                if properties['screen_active']:
+                    totals['on'] += duration
+                else:
+                    totals['off'] += duration
+
+            last_seen = point.created
+
+        computed = ForegroundSamples.from_points(points).totals(bucket='hour', by_package=True, here_tz=self.here_tz)
+
+        self.assertEqual(len(expected), 6)
+        self.assertEqual(computed, expected)
+
+    def test_half_hour_transition(self):
+        # St. John's moves its clocks forward at 05:30 UTC, half way through a UTC hour.
+
+        st_johns = pytz.timezone('America/St_Johns')
+        transition = datetime.datetime(2026, 3, 8, 5, 30, tzinfo=pytz.utc)
+
+        for offset in [-40 * 60, -10 * 60, 15 * 60]:
+            create_point('pdk-foreground-application', transition + datetime.timedelta(seconds=offset), transition, {'screen_active': True, 'duration': 60000}, source='st-johns-test')
+
+        samples = ForegroundSamples.from_points(DataPoint.objects.filter(source='st-johns-test'))
+
+        hours = [(start.hour, start.minute, start.utcoffset(),) for start in samples.bucket_keys('hour', st_johns)]
+
+        self.assertEqual(hours, [(1, 0, -datetime.timedelta(hours=3, minutes=30),), (1, 0, -datetime.timedelta(hours=3, minutes=30),), (3, 0, -datetime.timedelta(hours=2, minutes=30),)])
+
+        totals = samples.totals(bucket='hour', here_tz=st_johns)
+
+        self.assertEqual(sorted((key[1].hour, value['on'],) for key, value in totals.items()), [(1, 120000,), (3, 60000,)])
+
+        # Tehran set its clocks back from midnight to 23:00 on 21 September 2022, at 19:30 UTC.
+
+        tehran = pytz.timezone('Asia/Tehran')
+        transition = datetime.datetime(2022, 9, 21, 19, 30, tzinfo=pytz.utc)
+
+        for offset in [-10 * 60, 15 * 60]:
+            create_point('pdk-foreground-application', transition + datetime.timedelta(seconds=offset), transition, {'screen_active': True, 'duration': 60000}, source='tehran-test')
+
+        samples = ForegroundSamples.from_points(DataPoint.objects.filter(source='tehran-test'))
+
+        self.assertEqual(samples.bucket_keys('day', tehran), [datetime.date(2022, 9, 21), datetime.date(2022, 9, 21)])
+
+class BenchmarkExportsTests(TestCase):
+    def benchmark(self, **options):
+        handle, filename = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+
+        self.addCleanup(os.remove, filename)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('study_benchmark_exports', participants=2, days=1, interval=900, generators=['nyu-full-export'], output=filename, **options)
+
+        with open(filename, 'r', encoding='utf-8') as results_file:
+            return json.load(results_file)
+
+    def test_leaves_other_sources(self):
+        Participant.objects.create(identifier='pd-benchmark-pilot', email_address='pilot@example.com', created=timezone.now())
+
+        results = self.benchmark()
+
+        self.assertEqual(results['results']['nyu-full-export']['rows'], 2 * 96)
+        self.assertEqual(list(Participant.objects.values_list('identifier', flat=True)), ['pd-benchmark-pilot'])
+
+    def test_refuses_foreign_sources(self):
+        Participant.objects.create(identifier='pd-benchmark-s1-0001', email_address='foreign@example.com', created=timezone.now())
+
+        with self.assertRaises(CommandError):
+            self.benchmark()
+
+        self.assertEqual(list(Participant.objects.values_list('identifier', flat=True)), ['pd-benchmark-s1-0001'])
+
+    def test_skip_seed_reuses_cohort(self):
+        with self.assertRaises(CommandError):
+            self.benchmark(skip_seed=True)
+
+        self.benchmark(keep=True)
+
+        points = DataPoint.objects.count()
+
+        with self.assertRaises(CommandError):
+            self.benchmark(skip_seed=True, seed=2)
+
+        self.assertEqual(self.benchmark(skip_seed=True)['results']['nyu-full-export']['rows'], 2 * 96)
+
+        # Without --keep, the reused cohort is cleared afterwards.
+
+        self.assertTrue(points > 0)
+        self.assertEqual(DataPoint.objects.count(), 0)
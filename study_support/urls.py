@@ -5,12 +5,14 @@ from django.urls import re_path
 from .views import enroll_email, study_configuration, treatment_phases, treatment_phases_txt, \
                    activate_treatments, deactivate_treatments, activate_treatments_json, \
                    deactivate_treatments_json, latest_version, email_opt_out, app_codes_txt, \
-                   fetch_participant_data_quality
+                   fetch_participant_data_quality, fetch_data_quality_batch, usage_heatmap_json
 
 urlpatterns = [
     re_path(r'^latest-version.json', latest_version, name='latest_version'),
     re_path(r'^enroll-email.json', enroll_email, name='enroll_email'),
+    re_path(r'^data-quality-batch.json', fetch_data_quality_batch, name='fetch_participant_data_quality_batch'),
     re_path(r'^data-quality.json', fetch_participant_data_quality, name='fetch_participant_data_quality'),
+    re_path(r'^usage-heatmap.json', usage_heatmap_json, name='usage_heatmap_json'),
     re_path(r'^config.json', study_configuration, name='study_configuration'),
     re_path(r'^treatment-phases.txt$', treatment_phases_txt, name='treatment_phases_txt'),
     re_path(r'^app-codes.txt$', app_codes_txt, name='app_codes_txt'),
@@ -0,0 +1,106 @@
+# pylint: disable=line-too-long, no-member
+
+import datetime
+import hashlib
+
+from django.db.models import Count, Max, Sum
+
+from passive_data_kit.models import DataSource
+
+from .models import HourlyUsageRollup
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def heatmap_selection(request):
+    '''
+    Resolves the participant (repeatable), group, start, and end (YYYY-MM-DD,
+    inclusive) query parameters to the matching hourly rollup rows. Returns the
+    queryset and a description of the selection (including the optional
+    breakdown parameter), or raises ValueError for malformed dates.
+    '''
+
+    identifiers = request.GET.getlist('participant')
+    group = request.GET.get('group', None)
+
+    if group is not None:
+        identifiers.extend(DataSource.objects.filter(group__name=group).values_list('identifier', flat=True))
+
+    rollups = HourlyUsageRollup.objects.all()
+
+    if identifiers or group is not None:
+        rollups = rollups.filter(participant__identifier__in=identifiers)
+
+    selection = {
+        'participants': sorted(set(identifiers)),
+        'group': group,
+        'start': None,
+        'end': None,
+        'breakdown': request.GET.get('breakdown', None),
+    }
+
+    if request.GET.get('start', None):
+        selection['start'] = datetime.date.fromisoformat(request.GET['start']).isoformat()
+
+        rollups = rollups.filter(date__gte=selection['start'])
+
+    if request.GET.get('end', None):
+        selection['end'] = datetime.date.fromisoformat(request.GET['end']).isoformat()
+
+        rollups = rollups.filter(date__lte=selection['end'])
+
+    return rollups, selection
+
+
+def heatmap_etag(rollups, selection):
+    # Rollup rows are only ever replaced, so the newest computed time and the row count change
+    # whenever the matrix could.
+
+    state = rollups.aggregate(computed=Max('computed'), rows=Count('pk'))
+
+    fingerprint = '%s|%s|%s|%s|%s|%s|%s' % (','.join(selection['participants']), selection['group'], selection['start'], selection['end'], selection['breakdown'], state['computed'], state['rows'])
+
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+def matrices_for_cells(cells):
+    '''
+    Arranges summed (weekday, hour) cells into weekday-by-hour matrices (Monday
+    first): total screen-on milliseconds, the number of participant-days
+    observed, and the mean milliseconds per observed participant-day.
+    '''
+
+    usage = [[0.0] * 24 for weekday in WEEKDAYS]
+    days = [[0] * 24 for weekday in WEEKDAYS]
+    mean = [[None] * 24 for weekday in WEEKDAYS]
+
+    for cell in cells:
+        usage[cell['weekday']][cell['hour']] = cell['usage_ms']
+        days[cell['weekday']][cell['hour']] = cell['days']
+
+        if cell['days'] > 0:
+            mean[cell['weekday']][cell['hour']] = cell['usage_ms'] / cell['days']
+
+    return {
+        'weekdays': WEEKDAYS,
+        'usage_ms': usage,
+        'days': days,
+        'mean_usage_ms': mean,
+    }
+
+
+def heatmap_matrices(rollups):
+    return matrices_for_cells(rollups.order_by().values('weekday', 'hour').annotate(usage_ms=Sum('usage_ms'), days=Count('pk')))
+
+
+def participant_heatmaps(rollups):
+    cells = {}
+
+    for cell in rollups.order_by().values('participant__identifier', 'weekday', 'hour').annotate(usage_ms=Sum('usage_ms'), days=Count('pk')):
+        cells.setdefault(cell['participant__identifier'], []).append(cell)
+
+    heatmaps = {}
+
+    for identifier, participant_cells in cells.items():
+        heatmaps[identifier] = matrices_for_cells(participant_cells)
+
+    return heatmaps
@@ -0,0 +1,175 @@
+# pylint: disable=line-too-long, no-member
+
+import json
+
+import pytz
+
+from django.utils import timezone
+
+from passive_data_kit.models import DataGeneratorDefinition, DataPoint, DataSourceReference
+
+from .models import MinuteUsageRollup
+from .screen_time import BUCKET_SIZES, ForegroundSamples, day_slices, from_microseconds, to_microseconds
+
+def compute_minute_rollups(source, packages, dates, local_days):
+    '''
+    Computes per-minute usage for each package on each date, with days placed
+    by the LocalDayIndex local_days, from a single range scan. Samples are
+    trimmed against earlier samples of the same package on the same local day,
+    as study_daily_usage always has.
+    Returns {(package, date): (minutes, latest_recorded, is_open)}.
+    '''
+
+    results = {}
+
+    bounds = {}
+
+    for date in dates:
+        bounds[date] = local_days.day_bounds([date])[0]
+
+        for package in packages:
+            results[(package, date,)] = ({}, None, False,)
+
+    samples = range_samples(source, packages, bounds)
+
+    if samples is None:
+        return results
+
+    now = to_microseconds(timezone.now())
+
+    for package in packages:
+        package_samples = samples.for_packages([package])
+
+        for date in dates:
+            for day_date, day_samples in day_slices(package_samples, [bounds[date]]):
+                results[(package, day_date,)] = day_rollup(day_samples, bounds[date], pytz.timezone(local_days.zone_for(date)), now)
+
+    return results
+
+
+def range_samples(source, packages, bounds):
+    # Reads the packages' foreground samples spanning all of the day bounds with one range scan,
+    # or returns None when there is nothing to read.
+
+    generator_definition = DataGeneratorDefinition.objects.filter(generator_identifier='pdk-foreground-application').first()
+    source_reference = DataSourceReference.objects.filter(source=source).first()
+
+    if (generator_definition is None) or (source_reference is None) or (not bounds) or (not packages):
+        return None
+
+    range_start = from_microseconds(min(day_bounds[1] for day_bounds in bounds.values()))
+    range_end = from_microseconds(max(day_bounds[2] for day_bounds in bounds.values()))
+
+    points = DataPoint.objects.filter(source_reference=source_reference, generator_definition=generator_definition, secondary_identifier__in=list(packages), created__gte=range_start, created__lt=range_end)
+
+    return ForegroundSamples.from_points(points)
+
+
+def day_rollup(day_samples, day_bounds, here_tz, now):
+    # Returns (minutes, latest_recorded, is_open) for one package's samples on one local day.
+
+    minutes = {}
+    latest_recorded = None
+
+    for key, totals in day_samples.totals(bucket='minute', here_tz=here_tz).items():
+        minute = (to_microseconds(key[1]) - day_bounds[1]) // BUCKET_SIZES['minute']
+
+        minutes[minute] = [totals['on'], totals['off'], totals['trimmed']]
+
+    if len(day_samples) > 0: # pylint: disable=len-as-condition
+        latest_recorded = from_microseconds(day_samples.recorded.max())
+
+    return minutes, latest_recorded, day_bounds[2] > now
+
+
+def stored_rollups(source, packages, time_zones):
+    # Reads the stored rollups for the packages and dates with one query, returning the current
+    # ones as {(package, date): minutes} and the dirty or re-zoned ones as {(package, date): rollup}.
+
+    rollups = {}
+    stale = {}
+
+    for rollup in MinuteUsageRollup.objects.filter(source=source, package__in=list(packages), date__in=list(time_zones.keys())):
+        if rollup.dirty or rollup.time_zone != time_zones[rollup.date]:
+            stale[(rollup.package, rollup.date,)] = rollup
+        else:
+            rollups[(rollup.package, rollup.date,)] = rollup.minute_totals()
+
+    return rollups, stale
+
+
+def save_rollups(source, computed_rollups, stale, time_zones):
+    # Stores the computed rollups, updating the stale rows and creating the rest, and returns them
+    # as {(package, date): minutes}.
+
+    now = timezone.now()
+
+    rollups = {}
+    new_rollups = []
+
+    for key, computed in computed_rollups.items():
+        minutes, latest_recorded, is_open = computed
+
+        rollup = stale.get(key, None)
+
+        if rollup is None:
+            rollup = MinuteUsageRollup(source=source, package=key[0], date=key[1])
+
+            new_rollups.append(rollup)
+
+        rollup.time_zone = time_zones[key[1]]
+        rollup.minutes = json.dumps(minutes)
+        rollup.computed = now
+        rollup.latest_recorded = latest_recorded
+        rollup.dirty = is_open
+
+        rollups[key] = minutes
+
+    MinuteUsageRollup.objects.bulk_update(list(stale.values()), ['time_zone', 'minutes', 'computed', 'latest_recorded', 'dirty'])
+    MinuteUsageRollup.objects.bulk_create(new_rollups, ignore_conflicts=True)
+
+    return rollups
+
+
+def fetch_minute_rollups(source, packages, dates, local_days, refresh=False):
+    '''
+    Returns {(package, date): {minute: [on, off, trimmed]}} for the given
+    packages and dates (placed by the LocalDayIndex local_days), reading stored
+    rollups with one query and computing only the ones that are missing, dirty,
+    stored in another time zone, or requested with refresh=True. Days still in progress are stored
+    dirty, so they are recomputed on the next request.
+    '''
+
+    time_zones = {}
+
+    for date in dates:
+        time_zones[date] = local_days.zone_for(date)
+
+    rollups = {}
+    stale = {}
+
+    if refresh is False:
+        rollups, stale = stored_rollups(source, packages, time_zones)
+
+    missing_packages = set()
+    missing_days = set()
+
+    for package in packages:
+        for date in time_zones:
+            if ((package, date,) in rollups) is False:
+                missing_packages.add(package)
+                missing_days.add(date)
+
+    if missing_packages:
+        if refresh:
+            for rollup in MinuteUsageRollup.objects.filter(source=source, package__in=list(missing_packages), date__in=list(missing_days)):
+                stale[(rollup.package, rollup.date,)] = rollup
+
+        computed_rollups = compute_minute_rollups(source, sorted(missing_packages), sorted(missing_days), local_days)
+
+        for key in rollups:
+            computed_rollups.pop(key, None)
+
+        rollups.update(save_rollups(source, computed_rollups, stale, time_zones))
+
+    return rollups
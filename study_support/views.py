@@ -6,23 +6,28 @@ import csv
 import datetime
 import json
 import io
+import re
 import time
 import traceback
+import zlib
 
+import arrow
 import pytz
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.core.management import call_command
 from django.db import IntegrityError
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from django.views.decorators.csrf import csrf_exempt
 
 from passive_data_kit.models import DataPoint, DataSourceReference, DataGeneratorDefinition
 
 from .models import Participant, TreatmentPhase, AppVersion, AppCode, AppPackageInfo
+from .usage_heatmaps import heatmap_etag, heatmap_matrices, heatmap_selection, participant_heatmaps
 
 @csrf_exempt
 def enroll_email(request, repeats_remaining=10):
@@ -447,11 +452,145 @@ def fetch_participant_data_quality(request):
     if 'identifier' in request.POST and 'request-key' in request.POST:
         try:
             if request.POST['request-key'] == settings.PDK_REQUEST_KEY:
-                participant = Participant.objects.filter(identifier=request.POST['identifier']).first()
+                participant = Participant.objects.filter(identifier=request.POST['identifier']).only('identifier', 'metadata', 'performance_report').first()
 
                 if participant is not None:
+                    # Same document as before the report moved to its own column, which federated
+                    # servers read "study_performance_report" from.
+
                     metadata = json.loads(participant.metadata)
+
+                    report = participant.fetch_performance_report()
+
+                    if report is not None:
+                        metadata['study_performance_report'] = report
         except AttributeError:
             pass
 
     return JsonResponse(metadata, safe=False, json_dumps_params={'indent': 2})
+
+def data_quality_batch_chunks(participants):
+    # Yields {"reports": {identifier: report, ...}, "latest_update": ...} in pieces, writing the
+    # stored report JSON through without parsing it.
+
+    latest_update = None
+
+    yield b'{"reports": {'
+
+    separator = b''
+
+    for identifier, report, last_updated in participants.values_list('identifier', 'performance_report', 'performance_last_updated').iterator(chunk_size=500):
+        if report is None or report == '':
+            continue
+
+        if latest_update is None or (last_updated is not None and last_updated > latest_update):
+            latest_update = last_updated
+
+        yield separator + json.dumps(identifier).encode('utf-8') + b': ' + report.encode('utf-8')
+
+        separator = b', '
+
+    if latest_update is not None:
+        latest_update = latest_update.isoformat()
+
+    yield ('}, "latest_update": %s}' % json.dumps(latest_update)).encode('utf-8')
+
+
+def stream_data_quality_batch(participants):
+    # Streams data_quality_batch_chunks as gzip.
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    for chunk in data_quality_batch_chunks(participants):
+        compressed = compressor.compress(chunk)
+
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+@csrf_exempt
+def fetch_data_quality_batch(request):
+    '''
+    Returns the performance reports of the participants named by the
+    "identifier" parameter (repeatable) and/or updated after the "since"
+    parameter (ISO 8601), as one streamed JSON document, gzip-compressed when
+    the client accepts it.
+    '''
+
+    authorized = False
+
+    try:
+        authorized = 'request-key' in request.POST and request.POST['request-key'] == settings.PDK_REQUEST_KEY
+    except AttributeError:
+        pass
+
+    if authorized is False:
+        return HttpResponse(json.dumps({}, indent=2), content_type='application/json', status=403)
+
+    identifiers = request.POST.getlist('identifier')
+    since = request.POST.get('since', None)
+
+    if (not identifiers) and since is None:
+        response = {
+            'error': 'Provide one or more "identifier" values, a "since" timestamp, or both.'
+        }
+
+        return HttpResponse(json.dumps(response, indent=2), content_type='application/json', status=400)
+
+    participants = Participant.objects.all().order_by('pk')
+
+    if identifiers:
+        participants = participants.filter(identifier__in=identifiers)
+
+    if since is not None:
+        try:
+            participants = participants.filter(performance_last_updated__gt=arrow.get(since).datetime)
+        except (arrow.parser.ParserError, ValueError):
+            response = {
+                'error': '"since" must be an ISO 8601 timestamp.'
+            }
+
+            return HttpResponse(json.dumps(response, indent=2), content_type='application/json', status=400)
+
+    if re.search(r'\bgzip\b', request.META.get('HTTP_ACCEPT_ENCODING', '')) is None:
+        http_resp = StreamingHttpResponse(data_quality_batch_chunks(participants), content_type='application/json')
+    else:
+        http_resp = StreamingHttpResponse(stream_data_quality_batch(participants), content_type='application/json')
+        http_resp['Content-Encoding'] = 'gzip'
+
+    patch_vary_headers(http_resp, ('Accept-Encoding',))
+
+    return http_resp
+
+@staff_member_required
+def usage_heatmap_json(request):
+    try:
+        rollups, selection = heatmap_selection(request)
+    except ValueError:
+        response = {
+            'error': 'Dates must be in YYYY-MM-DD format.'
+        }
+
+        return HttpResponse(json.dumps(response, indent=2), content_type='application/json', status=400)
+
+    etag = '"%s"' % heatmap_etag(rollups, selection)
+
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        http_resp = HttpResponseNotModified()
+        http_resp['ETag'] = etag
+
+        return http_resp
+
+    response = dict(selection)
+    response['heatmap'] = heatmap_matrices(rollups)
+
+    if selection['breakdown'] == 'participant':
+        response['participant_heatmaps'] = participant_heatmaps(rollups)
+
+    http_resp = HttpResponse(json.dumps(response, indent=2), content_type='application/json', status=200)
+    http_resp['ETag'] = etag
+    http_resp['Cache-Control'] = 'private, no-cache'
+
+    return http_resp